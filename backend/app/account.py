@@ -1,23 +1,13 @@
 # backend/app/account.py
-from fastapi import APIRouter, HTTPException, Header, Response
+from fastapi import APIRouter, Depends, HTTPException, Response
 from fastapi.responses import JSONResponse
-from typing import Optional, Dict, Any
+from typing import Dict, Any
 import requests
 from .config import settings
-from .supa import get_user_from_token
+from .auth import current_uid
 
 router = APIRouter(prefix="/api/v1", tags=["account"])
 
-def _require_uid(authorization: Optional[str]) -> str:
-    if not authorization or not authorization.lower().startswith("bearer "):
-        raise HTTPException(401, "auth")
-    token = authorization.split(" ", 1)[1].strip()
-    user = get_user_from_token(token)
-    uid = user.get("id")
-    if not uid:
-        raise HTTPException(401, "auth")
-    return uid
-
 def _sr_headers(extra: Dict[str, str] | None = None) -> Dict[str, str]:
     h = {
         "apikey": settings.SUPABASE_SERVICE_ROLE,
@@ -38,8 +28,7 @@ def _get_user_rows(table: str, uid: str) -> list[dict]:
     return r.json()
 
 @router.get("/export")
-def export_account(authorization: Optional[str] = Header(None)):
-    uid = _require_uid(authorization)
+def export_account(uid: str = Depends(current_uid)):
 
     # users_public separat (single row)
     pub = requests.get(
@@ -57,6 +46,7 @@ def export_account(authorization: Optional[str] = Header(None)):
         "templates": _get_user_rows("templates", uid),
         "planner_slots": _get_user_rows("planner_slots", uid),
         "usage_log": _get_user_rows("usage_log", uid),
+        "usage_counters": _get_user_rows("usage_counters", uid) if settings.SUPABASE_URL else [],
         "daily_ideas": _get_user_rows("daily_ideas", uid) if settings.SUPABASE_URL else [],
         "prompt_cache": _get_user_rows("prompt_cache", uid) if settings.SUPABASE_URL else [],
     }
@@ -67,8 +57,7 @@ def export_account(authorization: Optional[str] = Header(None)):
     )
 
 @router.post("/delete_account")
-def delete_account(authorization: Optional[str] = Header(None)):
-    uid = _require_uid(authorization)
+def delete_account(uid: str = Depends(current_uid)):
 
     # Reihenfolge: Kindtabellen -> users_public -> auth user
     def _del(table: str):
@@ -81,7 +70,7 @@ def delete_account(authorization: Optional[str] = Header(None)):
         if r.status_code >= 400:
             raise HTTPException(400, f"delete {table} failed: {r.text}")
 
-    for table in ["planner_slots", "generations", "templates", "usage_log", "prompt_cache", "daily_ideas"]:
+    for table in ["planner_slots", "generations", "templates", "usage_log", "usage_counters", "prompt_cache", "daily_ideas"]:
         try:
             _del(table)
         except Exception:
@@ -3,21 +3,12 @@ from datetime import datetime, timedelta, timezone
 from typing import Any, Dict, List
 from fastapi import APIRouter, HTTPException, Request, Query
 from . import supa
+from .auth import current_uid
 
 router = APIRouter()
 
 # -------- Helpers ------------------------------------------------------------
 
-async def _uid_from_request(request: Request) -> str:
-    auth = request.headers.get("authorization") or request.headers.get("Authorization") or ""
-    token = auth.replace("Bearer", "").strip()
-    if not token:
-        raise HTTPException(401, "missing bearer token")
-    user = await supa.get_user_from_token(token)
-    uid = (user.get("user") or {}).get("id") or user.get("id")
-    if not uid:
-        raise HTTPException(401, "invalid token")
-    return uid
 
 # -------- Routes -------------------------------------------------------------
 
@@ -27,7 +18,7 @@ async def usage_event(request: Request, payload: Dict[str, Any]):
     Loggt ein Usage-Event für den eingeloggten User.
     expected payload: { "event": "save" | "favorite_toggle" | "login" | "...", "meta": {...} }
     """
-    uid = await _uid_from_request(request)
+    uid = await current_uid(request)
     ev = (payload or {}).get("event")
     meta = (payload or {}).get("meta") or {}
     if not ev or not isinstance(ev, str):
@@ -55,7 +46,7 @@ async def stats(request: Request, days: int = Query(30, ge=1, le=180)):
     Aggregiert Events der letzten N Tage für den eingeloggten User.
     Output: totals_by_event + daily (Datum -> Count)
     """
-    uid = await _uid_from_request(request)
+    uid = await current_uid(request)
     now = datetime.now(timezone.utc)
     since = now - timedelta(days=days)
 
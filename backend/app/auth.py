@@ -0,0 +1,219 @@
+# app/auth.py
+# Zweck: Eine Auth-Dependency für alle Router. Supabase-JWTs werden lokal geprüft
+# (HS256 mit SUPABASE_JWT_SECRET oder asymmetrisch via JWKS), die Claims pro Token
+# bis `exp` gecacht. /auth/v1/user wird nur noch als Fallback angefragt.
+
+from __future__ import annotations
+import time
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import httpx
+import jwt
+from fastapi import HTTPException, Request
+
+from . import supa
+from .config import settings
+
+logger = logging.getLogger("uvicorn.error")
+
+JWKS_TTL = 600.0          # Sekunden, JWKS neu laden
+JWKS_MIN_REFRESH = 60.0   # unbekannte kid → höchstens 1x/min nachladen
+
+# token -> (user, exp)
+_cache: "OrderedDict[str, tuple[Dict[str, Any], float]]" = OrderedDict()
+# token -> bis wann abgelehnt (ungültige Tokens kosten so keinen JWKS-/Remote-Call pro Request)
+_rejected: "OrderedDict[str, float]" = OrderedDict()
+_jwks: Dict[str, Any] = {"keys": {}, "fetched_at": 0.0}
+_stats = {"hits": 0, "misses": 0, "local": 0, "remote": 0, "rejected": 0, "rejected_cached": 0}
+
+
+class _Unverifiable(Exception):
+    """Token lässt sich lokal nicht prüfen (kein Secret / Key) → ggf. Remote-Fallback."""
+
+
+# ---------------------------------------------------------------------------
+# Token-Cache
+# ---------------------------------------------------------------------------
+def _cache_get(token: str) -> Optional[Dict[str, Any]]:
+    item = _cache.get(token)
+    if not item:
+        return None
+    user, exp = item
+    if exp <= time.time():
+        _cache.pop(token, None)
+        return None
+    _cache.move_to_end(token)
+    return user
+
+def _cache_put(token: str, user: Dict[str, Any], exp: float) -> None:
+    if exp <= time.time():
+        return
+    _cache[token] = (user, exp)
+    _cache.move_to_end(token)
+    while len(_cache) > settings.AUTH_CACHE_SIZE:
+        _cache.popitem(last=False)
+
+def _reject(token: str) -> None:
+    _stats["rejected"] += 1
+    _rejected[token] = time.time() + settings.AUTH_REJECT_TTL
+    _rejected.move_to_end(token)
+    while len(_rejected) > settings.AUTH_CACHE_SIZE:
+        _rejected.popitem(last=False)
+
+def _is_rejected(token: str) -> bool:
+    until = _rejected.get(token)
+    if until is None:
+        return False
+    if until <= time.time():
+        _rejected.pop(token, None)
+        return False
+    return True
+
+def auth_stats() -> Dict[str, Any]:
+    return {**_stats, "cached_tokens": len(_cache), "rejected_tokens": len(_rejected), "jwks_keys": len(_jwks["keys"])}
+
+
+# ---------------------------------------------------------------------------
+# Lokale Verifikation
+# ---------------------------------------------------------------------------
+async def _load_jwks(force: bool = False) -> Dict[str, Any]:
+    # nur am Zeitpunkt des letzten Abrufs festmachen: auch ein leeres JWKS (reine
+    # HS256-Projekte) gilt bis JWKS_TTL bzw. JWKS_MIN_REFRESH
+    age = time.time() - _jwks["fetched_at"]
+    if not force and age < JWKS_TTL:
+        return _jwks["keys"]
+    if force and age < JWKS_MIN_REFRESH:
+        return _jwks["keys"]
+    _jwks["fetched_at"] = time.time()
+    try:
+        data = await supa._get("/auth/v1/.well-known/jwks.json")
+        keys = {}
+        for jwk in (data or {}).get("keys", []):
+            try:
+                keys[jwk.get("kid")] = jwt.PyJWK(jwk)
+            except Exception:
+                continue
+        _jwks["keys"] = keys
+    except Exception as e:
+        logger.warning("[auth] JWKS fetch failed: %s", e)
+    return _jwks["keys"]
+
+async def _verify_local(token: str) -> Dict[str, Any]:
+    try:
+        header = jwt.get_unverified_header(token)
+    except jwt.PyJWTError as e:
+        raise jwt.InvalidTokenError(str(e))
+    alg = header.get("alg")
+    opts = {"require": ["exp", "sub"]}
+
+    if alg == "HS256":
+        if not settings.SUPABASE_JWT_SECRET:
+            raise _Unverifiable("no SUPABASE_JWT_SECRET")
+        return jwt.decode(token, settings.SUPABASE_JWT_SECRET, algorithms=["HS256"],
+                          audience=settings.SUPABASE_JWT_AUD, options=opts)
+
+    if alg in ("RS256", "ES256") and settings.AUTH_JWKS.lower() == "on":
+        kid = header.get("kid")
+        keys = await _load_jwks()
+        if kid not in keys:
+            keys = await _load_jwks(force=True)
+        if kid not in keys:
+            raise _Unverifiable(f"unknown kid {kid}")
+        return jwt.decode(token, keys[kid].key, algorithms=[alg],
+                          audience=settings.SUPABASE_JWT_AUD, options=opts)
+
+    raise _Unverifiable(f"alg {alg} not verifiable locally")
+
+def _user_from_claims(claims: Dict[str, Any]) -> Dict[str, Any]:
+    # gleiche Form wie /auth/v1/user: "id" + "email"
+    return {**claims, "id": claims.get("sub"), "email": claims.get("email")}
+
+
+# ---------------------------------------------------------------------------
+# Öffentliche API
+# ---------------------------------------------------------------------------
+def bearer_token(authorization: Optional[str]) -> Optional[str]:
+    if not authorization or not authorization.lower().startswith("bearer "):
+        return None
+    return authorization.split(" ", 1)[1].strip() or None
+
+async def user_from_token(token: Optional[str], remote: bool = True) -> Optional[Dict[str, Any]]:
+    """
+    Liefert den User (dict mit "id"/"email") oder None, wenn der Token ungültig ist.
+    Reihenfolge: Cache → lokale Prüfung → (optional) Remote /auth/v1/user.
+    remote=False (Middleware): nur lokal; nicht lokal prüfbare Tokens → None, ohne sie
+    als abgelehnt zu merken (der Endpoint prüft dann ggf. remote).
+    """
+    if not token:
+        return None
+    user = _cache_get(token)
+    if user is not None:
+        _stats["hits"] += 1
+        return user
+    if _is_rejected(token):
+        _stats["rejected_cached"] += 1
+        return None
+    _stats["misses"] += 1
+
+    try:
+        claims = await _verify_local(token)
+        user = _user_from_claims(claims)
+        _stats["local"] += 1
+        _cache_put(token, user, float(claims["exp"]))
+        return user
+    except _Unverifiable:
+        if settings.AUTH_REMOTE_FALLBACK.lower() != "on":
+            _reject(token)
+            return None
+        if not remote:
+            return None
+    except jwt.PyJWTError:
+        _reject(token)
+        return None
+
+    # Remote-Fallback (Supabase Auth); Ergebnis ebenfalls bis exp cachen
+    try:
+        user = await supa.get_user_from_token(token)
+    except httpx.HTTPStatusError as e:
+        if 400 <= e.response.status_code < 500:
+            _reject(token)  # Supabase lehnt ab → merken; 5xx/Netzfehler nicht (sonst sperrt ein Ausfall)
+        else:
+            _stats["rejected"] += 1
+        return None
+    except Exception:
+        _stats["rejected"] += 1
+        return None
+    if not user or not user.get("id"):
+        _reject(token)
+        return None
+    _stats["remote"] += 1
+    try:
+        exp = float(jwt.decode(token, options={"verify_signature": False}).get("exp") or 0)
+    except jwt.PyJWTError:
+        exp = 0.0
+    _cache_put(token, user, exp)
+    return user
+
+
+# ---------------------------------------------------------------------------
+# FastAPI-Dependencies (request-scoped, Ergebnis liegt auf request.state)
+# ---------------------------------------------------------------------------
+async def optional_user(request: Request) -> Optional[Dict[str, Any]]:
+    if hasattr(request.state, "user"):
+        return request.state.user
+    token = bearer_token(request.headers.get("authorization"))
+    user = await user_from_token(token)
+    request.state.user = user
+    return user
+
+async def current_user(request: Request) -> Dict[str, Any]:
+    user = await optional_user(request)
+    if not user or not user.get("id"):
+        raise HTTPException(401, "auth")
+    return user
+
+async def current_uid(request: Request) -> str:
+    user = await current_user(request)
+    return user["id"]
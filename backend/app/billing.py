@@ -1,6 +1,6 @@
 # backend/app/billing.py
-from fastapi import APIRouter, HTTPException, Header, Request
-from typing import Optional, Dict
+from fastapi import APIRouter, Depends, HTTPException, Request
+from typing import Dict
 import os, requests, stripe
 
 # Konfig aus config.py (du hast die STRIPE_* dort bereits exportiert)
@@ -12,7 +12,9 @@ from .config import (
     FRONTEND_BASE_URL,
     settings,
 )
-from .supa import get_user_from_token, _get_sync
+from . import supa
+from .supa import _get_sync
+from .auth import current_user
 
 router = APIRouter(prefix="/api/v1/billing", tags=["billing"])
 
@@ -49,16 +51,16 @@ def _sb_patch(table: str, patch: dict, eq: Dict[str, str]) -> None:
     if r.status_code >= 400:
         raise RuntimeError(f"supabase patch error {r.status_code}: {r.text}")
 
-def _require_user_profile(authorization: Optional[str]) -> dict:
+async def _sb_apatch(table: str, patch: dict, eq: Dict[str, str]) -> None:
     """
-    Liest den Supabase-User (JWT) und holt dazu das Profil aus users_public.
+    Async-Variante von _sb_patch für async-Handler (Webhook) – über den Supabase-Pool.
+    """
+    await supa._patch(f"/rest/v1/{table}", params={k: f"eq.{v}" for k, v in eq.items()}, json=patch)
+
+def _require_user_profile(user: dict) -> dict:
+    """
+    Nimmt den (bereits verifizierten) Supabase-User und holt dazu das Profil aus users_public.
     """
-    if not authorization or not authorization.lower().startswith("bearer "):
-        raise HTTPException(401, "auth")
-    token = authorization.split(" ", 1)[1].strip()
-    user = get_user_from_token(token)
-    if not user or not user.get("id"):
-        raise HTTPException(401, "auth")
     uid = user["id"]
 
     rows, _ = _get_sync("/rest/v1/users_public", {
@@ -85,14 +87,14 @@ def plans():
 
 
 @router.post("/create-checkout-session")
-def create_checkout_session(payload: dict, authorization: Optional[str] = Header(None)):
+def create_checkout_session(payload: dict, auth_user: dict = Depends(current_user)):
     """
     Startet Stripe Checkout für Abo (Pro default). Erwartet Bearer-Token.
     """
     if not STRIPE_SECRET_KEY or not (STRIPE_PRICE_PRO or payload.get("price_id")):
         raise HTTPException(400, "billing disabled")
 
-    user = _require_user_profile(authorization)
+    user = _require_user_profile(auth_user)
     uid = str(user["user_id"])
     email = user.get("email")
 
@@ -165,7 +167,7 @@ async def webhook(req: Request):
                 raise ValueError("no customer in event")
 
             # Planeinstellung: hier pauschal 'pro'. Optional: am Preis-Objekt unterscheiden.
-            _sb_patch("users_public", {
+            await _sb_apatch("users_public", {
                 "plan": "pro",
                 "stripe_subscription_id": sub_id,
                 "stripe_status": status,
@@ -175,7 +177,7 @@ async def webhook(req: Request):
             customer_id = data.get("customer")
             if not customer_id:
                 raise ValueError("no customer in event")
-            _sb_patch("users_public", {
+            await _sb_apatch("users_public", {
                 "plan": "free",
                 "stripe_status": "canceled",
                 "pro_until": None,
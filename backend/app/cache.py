@@ -1,6 +1,10 @@
 # app/cache.py
-import hashlib, json
-from typing import Any, Dict
+import asyncio, hashlib, json, time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from .config import settings
+from .state import key as state_key, shared_backend
 
 CANON_KEYS = ("topic","niche","tone","voice","hashtags_base","forbidden","cta","emojis")
 
@@ -26,3 +30,134 @@ def make_cache_key(user_id: str, typ: str, payload: Dict[str, Any]) -> str:
     norm = normalize_payload(payload)
     blob = f"{user_id}|{typ}|{json.dumps(norm, sort_keys=True, separators=(',',':'))}"
     return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+# ---------------------------------------------------------------------------
+# In-Process LRU vor prompt_cache (TTL + Byte-Cap, kompakte Tupel-Einträge)
+# Nur aus dem Event-Loop benutzen (kein Lock nötig).
+# ---------------------------------------------------------------------------
+_ENTRY_OVERHEAD = 120  # grobe Schätzung: Tupel + Key-String + OrderedDict-Slot
+
+class LRUCache:
+    def __init__(self, max_items: int, max_bytes: int, ttl: float):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # key -> (expires_at, size, output, model, variants)
+        self._data: "OrderedDict[str, Tuple[float, int, str, Optional[str], Optional[List[str]]]]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expires_at, size, output, model, variants = item
+        if expires_at <= time.monotonic():
+            self._drop(key, size)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return {"cache_key": key, "output": output, "model": model, "variants": variants}
+
+    def put(self, key: str, output: str, model: Optional[str] = None, variants: Optional[List[str]] = None) -> None:
+        if self.max_items <= 0 or not output:
+            return
+        size = len(key) + len(output.encode("utf-8")) + len(model or "") + _ENTRY_OVERHEAD
+        if variants:
+            size += sum(len(v.encode("utf-8")) for v in variants)
+        if size > self.max_bytes:
+            return
+        old = self._data.pop(key, None)
+        if old is not None:
+            self._bytes -= old[1]
+        self._data[key] = (time.monotonic() + self.ttl, size, output, model, variants or None)
+        self._bytes += size
+        while self._data and (len(self._data) > self.max_items or self._bytes > self.max_bytes):
+            _, (_, old_size, *_) = self._data.popitem(last=False)
+            self._bytes -= old_size
+            self.evictions += 1
+
+    def discard(self, key: str) -> None:
+        item = self._data.get(key)
+        if item is not None:
+            self._drop(key, item[1])
+
+    def _drop(self, key: str, size: int) -> None:
+        del self._data[key]
+        self._bytes -= size
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "items": len(self._data),
+            "bytes": self._bytes,
+            "max_items": self.max_items,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+prompt_lru = LRUCache(
+    max_items=settings.PROMPT_CACHE_LRU_ITEMS,
+    max_bytes=settings.PROMPT_CACHE_LRU_MB * 1024 * 1024,
+    ttl=settings.PROMPT_CACHE_LRU_TTL,
+)
+
+
+# ---------------------------------------------------------------------------
+# Geteilte Stufe zwischen LRU und DB (STATE_BACKEND=mmap|redis): Treffer eines
+# Workers sind für alle sichtbar. Schreiben läuft als Hintergrund-Task.
+# ---------------------------------------------------------------------------
+_share_tasks: "set[asyncio.Task]" = set()
+shared_stats = {"hits": 0, "misses": 0, "puts": 0, "errors": 0}
+
+
+async def shared_get(key: str) -> Optional[Dict[str, Any]]:
+    backend = shared_backend("cache")
+    if backend is None:
+        return None
+    try:
+        raw = await backend.get(state_key("pc", key))
+    except Exception:
+        shared_stats["errors"] += 1
+        return None
+    if raw is None:
+        shared_stats["misses"] += 1
+        return None
+    shared_stats["hits"] += 1
+    item = json.loads(raw)
+    prompt_lru.put(key, item.get("output") or "", item.get("model"), item.get("variants"))
+    return {"cache_key": key, **item}
+
+
+async def _share(backend: Any, key: str, raw: bytes) -> None:
+    try:
+        await backend.set(state_key("pc", key), raw, settings.PROMPT_CACHE_LRU_TTL)
+        shared_stats["puts"] += 1
+    except Exception:
+        shared_stats["errors"] += 1
+
+
+def shared_put(key: str, output: str, model: Optional[str] = None, variants: Optional[List[str]] = None) -> None:
+    backend = shared_backend("cache")
+    if backend is None or not output:
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    raw = json.dumps({"output": output, "model": model, "variants": variants or None}, separators=(",", ":")).encode("utf-8")
+    task = loop.create_task(_share(backend, key, raw))
+    _share_tasks.add(task)
+    task.add_done_callback(_share_tasks.discard)
@@ -0,0 +1,88 @@
+# app/coalesce.py
+# Zweck: Token-Coalescing für SSE und WebSocket. Aufeinanderfolgende "chunk"-Events
+# werden zu einem Frame zusammengefasst, bis STREAM_COALESCE_MS vergangen oder
+# STREAM_COALESCE_BYTES erreicht sind. Andere Events (start/warn/end/…) flushen sofort.
+# Der erste Chunk geht ohne Verzögerung raus (Time-to-first-Token bleibt gleich).
+# `until` (z. B. Disconnect-Watcher) beendet den Stream sofort und schließt die Quelle.
+
+from __future__ import annotations
+import asyncio
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from .config import settings
+
+
+def _chunk(parts: List[str]) -> Dict[str, Any]:
+    return {"status": "chunk", "text": "".join(parts)}
+
+
+async def coalesce(
+    events: AsyncIterator[Dict[str, Any]],
+    window_ms: Optional[float] = None,
+    max_bytes: Optional[int] = None,
+    until: Optional[asyncio.Future] = None,
+) -> AsyncIterator[Dict[str, Any]]:
+    window = (settings.STREAM_COALESCE_MS if window_ms is None else window_ms) / 1000.0
+    limit = settings.STREAM_COALESCE_BYTES if max_bytes is None else max_bytes
+    if window <= 0:
+        limit = 0  # Coalescing aus → jeder Chunk sofort
+
+    loop = asyncio.get_running_loop()
+    it = events.__aiter__()
+    parts: List[str] = []
+    size = 0
+    deadline = 0.0
+    first_sent = False
+    pending: Optional[asyncio.Future] = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(it.__anext__())
+            waiting = (pending,) if until is None else (pending, until)
+            timeout = max(0.0, deadline - loop.time()) if parts else None
+            await asyncio.wait(waiting, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if until is not None and until.done():
+                return  # Client weg → finally bricht die Quelle ab
+            if not pending.done():  # Fenster abgelaufen → flushen, nächstes Event läuft weiter
+                yield _chunk(parts)
+                parts, size = [], 0
+                continue
+            fut, pending = pending, None
+            try:
+                ev = fut.result()
+            except StopAsyncIteration:
+                break
+
+            if ev.get("status") == "chunk":
+                if not first_sent:
+                    first_sent = True
+                    yield ev
+                    continue
+                text = ev.get("text") or ""
+                if not parts:
+                    deadline = loop.time() + window
+                parts.append(text)
+                size += len(text.encode("utf-8"))
+                if size >= limit:
+                    yield _chunk(parts)
+                    parts, size = [], 0
+                continue
+
+            if parts:
+                yield _chunk(parts)
+                parts, size = [], 0
+            yield ev
+
+        if parts:
+            yield _chunk(parts)
+    finally:
+        # Client weg / Abbruch: laufendes __anext__ beenden, dann die Quelle schließen
+        if pending is not None and not pending.done():
+            pending.cancel()
+            try:
+                await pending
+            except BaseException:
+                pass
+        aclose = getattr(it, "aclose", None)
+        if aclose is not None:
+            await aclose()
@@ -8,18 +8,86 @@ class Settings(BaseModel):
     SUPABASE_URL: str | None = os.getenv("SUPABASE_URL")
     SUPABASE_SERVICE_ROLE: str | None = os.getenv("SUPABASE_SERVICE_ROLE")
 
+    # Supabase HTTP-Pool (app-weit, Keep-Alive + HTTP/2)
+    SUPABASE_HTTP2: str = os.getenv("SUPABASE_HTTP2", "on")  # "on"|"off"
+    SUPABASE_POOL_MAX: int = int(os.getenv("SUPABASE_POOL_MAX", "20"))
+    SUPABASE_POOL_KEEPALIVE: int = int(os.getenv("SUPABASE_POOL_KEEPALIVE", "10"))
+    SUPABASE_POOL_KEEPALIVE_EXPIRY: float = float(os.getenv("SUPABASE_POOL_KEEPALIVE_EXPIRY", "30"))
+
+    # In-Process LRU vor prompt_cache
+    PROMPT_CACHE_LRU_ITEMS: int = int(os.getenv("PROMPT_CACHE_LRU_ITEMS", "5000"))
+    PROMPT_CACHE_LRU_MB: int = int(os.getenv("PROMPT_CACHE_LRU_MB", "32"))
+    PROMPT_CACHE_LRU_TTL: float = float(os.getenv("PROMPT_CACHE_LRU_TTL", "3600"))
+
+    # Auth: JWT lokal prüfen (HS256-Secret oder JWKS), Remote-Call nur als Fallback
+    SUPABASE_JWT_SECRET: str | None = os.getenv("SUPABASE_JWT_SECRET")
+    SUPABASE_JWT_AUD: str = os.getenv("SUPABASE_JWT_AUD", "authenticated")
+    AUTH_JWKS: str = os.getenv("AUTH_JWKS", "on")                        # "on"|"off"
+    AUTH_REMOTE_FALLBACK: str = os.getenv("AUTH_REMOTE_FALLBACK", "on")  # "on"|"off"
+    AUTH_CACHE_SIZE: int = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+    AUTH_REJECT_TTL: float = float(os.getenv("AUTH_REJECT_TTL", "30"))   # abgelehnte Tokens so lange merken (Sekunden)
+
+    # Write-Behind-Queue für prompt_cache/usage_log (Batch-Inserts im Hintergrund)
+    WRITE_QUEUE_MAX: int = int(os.getenv("WRITE_QUEUE_MAX", "10000"))
+    WRITE_BATCH_MAX: int = int(os.getenv("WRITE_BATCH_MAX", "200"))
+    WRITE_FLUSH_MS: int = int(os.getenv("WRITE_FLUSH_MS", "250"))
+    WRITE_DRAIN_TIMEOUT: float = float(os.getenv("WRITE_DRAIN_TIMEOUT", "10"))
+    # Credit-Reservierungen ohne usage_log-Eintrag/Release verfallen danach (Sekunden)
+    CREDIT_RESERVE_TTL: int = int(os.getenv("CREDIT_RESERVE_TTL", "300"))
+
     MAILGUN_API_KEY: str | None = os.getenv("MAILGUN_API_KEY")
     MAILGUN_DOMAIN: str | None = os.getenv("MAILGUN_DOMAIN")
 
     # OpenRouter / LLM
     OPENROUTER_API_KEY: str | None = os.getenv("OPENROUTER_API_KEY")
     OPENROUTER_MODEL: str = os.getenv("OPENROUTER_MODEL", "x-ai/grok-4-fast:free")
+    OPENROUTER_MODELS: str | None = os.getenv("OPENROUTER_MODELS")  # CSV, geordnet; sonst nur OPENROUTER_MODEL
     OPENROUTER_SITE_URL: str | None = os.getenv("OPENROUTER_SITE_URL")
     OPENROUTER_APP_TITLE: str = os.getenv("OPENROUTER_APP_TITLE", "Creator AI")
     LLM_REASONING: str = os.getenv("LLM_REASONING", "off")   # "on"|"off"
     LLM_JSON_MODE: str = os.getenv("LLM_JSON_MODE", "on")    # "on"|"off"
+    OPENROUTER_HTTP2: str = os.getenv("OPENROUTER_HTTP2", "on")  # "on"|"off"
+    LLM_POOL_MAX: int = int(os.getenv("LLM_POOL_MAX", "50"))
+    LLM_TIMEOUT: float = float(os.getenv("LLM_TIMEOUT", "25"))                  # Sekunden pro Versuch
+    LLM_RETRIES: int = int(os.getenv("LLM_RETRIES", "3"))
+    LLM_BACKOFF: float = float(os.getenv("LLM_BACKOFF", "0.5"))                 # Basis für Full Jitter
+    LLM_RETRY_AFTER_MAX: float = float(os.getenv("LLM_RETRY_AFTER_MAX", "8"))   # länger → lokal fallbacken
+    LLM_ROUTER_ALPHA: float = float(os.getenv("LLM_ROUTER_ALPHA", "0.2"))       # EWMA-Gewicht neuer Messungen
+    LLM_MODEL_COOLDOWN: float = float(os.getenv("LLM_MODEL_COOLDOWN", "30"))    # Sekunden
+    LLM_ROUTER_EXPLORE: float = float(os.getenv("LLM_ROUTER_EXPLORE", "0.05"))
+    LLM_MAX_CONCURRENCY: int = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))    # gleichzeitige Upstream-Calls/Worker
+    LLM_QUEUE_TIMEOUT: float = float(os.getenv("LLM_QUEUE_TIMEOUT", "15"))     # Sekunden (interaktiv; 0 = ohne)
+
+    # Streams: Tokens zu Frames bündeln (SSE + WS); 0 ms = aus
+    STREAM_COALESCE_MS: float = float(os.getenv("STREAM_COALESCE_MS", "30"))
+    STREAM_COALESCE_BYTES: int = int(os.getenv("STREAM_COALESCE_BYTES", "1024"))
+    STREAM_DISCONNECT_POLL: float = float(os.getenv("STREAM_DISCONNECT_POLL", "0.5"))  # Sekunden (SSE)
+    STREAM_CACHE_PARTIAL: str = os.getenv("STREAM_CACHE_PARTIAL", "off")  # "on" → abgebrochene Streams cachen
+
+    # Geteilter State für mehrere Worker (Rate-Limits, Cache-Stufe, Single-Flight-Locks)
+    STATE_BACKEND: str = os.getenv("STATE_BACKEND", "memory")     # "memory"|"mmap"|"redis"
+    STATE_PREFIX: str = os.getenv("STATE_PREFIX", "cai:")
+    STATE_MMAP_DIR: str = os.getenv("STATE_MMAP_DIR", "/dev/shm")
+    STATE_MMAP_SLOTS: int = int(os.getenv("STATE_MMAP_SLOTS", "65536"))            # Counter/Locks
+    STATE_MMAP_CACHE_SLOTS: int = int(os.getenv("STATE_MMAP_CACHE_SLOTS", "8192"))  # Cache-Einträge
+    STATE_MMAP_CACHE_VALUE_MAX: int = int(os.getenv("STATE_MMAP_CACHE_VALUE_MAX", "4096"))  # Bytes/Eintrag
+    REDIS_URL: str = os.getenv("REDIS_URL", "redis://127.0.0.1:6379/0")
+    REDIS_POOL_MAX: int = int(os.getenv("REDIS_POOL_MAX", "8"))
+    REDIS_TIMEOUT: float = float(os.getenv("REDIS_TIMEOUT", "0.5"))            # Sekunden pro Befehl
+    SF_LOCK_TTL: float = float(os.getenv("SF_LOCK_TTL", "60"))                 # Worker-übergreifender Single-Flight-Lock
+    SF_REMOTE_WAIT: float = float(os.getenv("SF_REMOTE_WAIT", "30"))           # so lange auf fremden Worker warten
 
     CRON_SECRET: str | None = os.getenv("CRON_SECRET")       # schützt /planner/remind
+
+    # daily3 refresh_all (Cron): Keyset-Seiten, parallele LLM-Calls, Zeitbudget pro Aufruf
+    DAILY3_REFRESH_PAGE: int = int(os.getenv("DAILY3_REFRESH_PAGE", "100"))                # User pro Seite
+    DAILY3_REFRESH_CONCURRENCY: int = int(os.getenv("DAILY3_REFRESH_CONCURRENCY", "8"))
+    DAILY3_REFRESH_BUDGET_S: float = float(os.getenv("DAILY3_REFRESH_BUDGET_S", "240"))    # danach Checkpoint + Antwort
+    DAILY3_REFRESH_LEASE_S: float = float(os.getenv("DAILY3_REFRESH_LEASE_S", "600"))      # Lock gegen parallele Läufe
+    DAILY3_POOL_SIZE: int = int(os.getenv("DAILY3_POOL_SIZE", "9"))                        # Packs pro Kohorte und Tag
+    DAILY3_CACHE_TTL: float = float(os.getenv("DAILY3_CACHE_TTL", "30"))                   # Sekunden, Cache vor GET /daily3
+    DAILY3_CACHE_MAX: int = int(os.getenv("DAILY3_CACHE_MAX", "10000"))                    # User-Einträge pro Worker
+
     MAIL_FROM: str = os.getenv("DAILY_EMAIL_FROM", "noreply@example.com")
     MAILGUN_REGION: str = os.getenv("MAILGUN_REGION", "eu")  # "us" | "eu"
 
@@ -28,6 +96,10 @@ class Settings(BaseModel):
     CORS_EXTRA_ORIGINS: str | None = os.getenv("CORS_EXTRA_ORIGINS")  # CSV
     DEV_ORIGINS: str = os.getenv("DEV_ORIGINS", "http://localhost:5173,http://127.0.0.1:5173")
 
+    def openrouter_models(self) -> list[str]:
+        models = [m.strip() for m in (self.OPENROUTER_MODELS or "").split(",") if m.strip()]
+        return list(dict.fromkeys(models)) or [self.OPENROUTER_MODEL]
+
     def cors_allowed_origins(self) -> list[str]:  # NEU
         origins: list[str] = []
         if self.VERCEL_ORIGIN:
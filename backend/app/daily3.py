@@ -1,39 +1,44 @@
 # backend/app/daily3.py
-from fastapi import APIRouter, Header, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
+from collections import OrderedDict
 from datetime import datetime, timezone, timedelta
-from typing import Any, Dict, List
-import os, json, requests
-from .supa import _get_sync, _post_sync, get_user_from_token
+from typing import Any, Dict, List, Optional, Tuple
+import asyncio, hashlib, json, logging, random, time
+from . import supa
+from .auth import current_uid
 from .config import settings
+from .llm_openrouter import chat_routed
+from .llm_gate import LANE_BATCH, LANE_FREE, lane_for
+from .singleflight import flights
 
 router = APIRouter(prefix="/api/v1", tags=["daily3"])
-
-def _require_user(authorization: str | None):
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(401, "auth")
-    token = authorization.split(" ", 1)[1]
-    user = get_user_from_token(token)
-    if not user or not user.get("id"):
-        raise HTTPException(401, "auth")
-    return user
+logger = logging.getLogger("uvicorn.error")
 
 def _today_utc():
     now = datetime.now(timezone.utc)
     return datetime(now.year, now.month, now.day, tzinfo=timezone.utc)
 
-def _gen_with_llm(niche: str, target: str, tone: str) -> List[Dict[str,Any]]:
+def _fallback_packs(niche: str, target: str) -> List[Dict[str,Any]]:
+    return [
+        {"hook": f"3 Fehler in {niche}", "script": "Kurzes Skript …", "caption": "Heute lernst du …", "hashtags": ["#"+niche.replace(" ",""), "#tipps", "#creator"]},
+        {"hook": f"Schneller {niche}-Hack", "script": "Kurzes Skript …", "caption": "So machst du es …", "hashtags": ["#"+niche.replace(" ",""), "#howto"]},
+        {"hook": f"Niemand sagt dir das über {niche}", "script": "Kurzes Skript …", "caption": "Wichtig für "+target, "hashtags": ["#"+niche.replace(" ",""), "#shorts"]},
+    ]
+
+async def _gen_with_llm(niche: str, target: str, tone: str, lane: int = LANE_FREE, n: int = 3) -> List[Dict[str,Any]]:
+    packs = await _llm_packs(niche, target, tone, lane, n)
+    return packs or _fallback_packs(niche, target)
+
+async def _llm_packs(niche: str, target: str, tone: str, lane: int = LANE_FREE, n: int = 3) -> Optional[List[Dict[str,Any]]]:
+    """n Packs vom LLM, None wenn kein Key/Fehler (Aufrufer entscheidet über den Fallback)."""
     # HINWEIS: nutze settings.*, nicht mehr Modul-Konstanten
-    if not settings.OPENROUTER_API_KEY or not settings.OPENROUTER_MODEL:
-        return [
-            {"hook": f"3 Fehler in {niche}", "script": "Kurzes Skript …", "caption": "Heute lernst du …", "hashtags": ["#"+niche.replace(" ",""), "#tipps", "#creator"]},
-            {"hook": f"Schneller {niche}-Hack", "script": "Kurzes Skript …", "caption": "So machst du es …", "hashtags": ["#"+niche.replace(" ",""), "#howto"]},
-            {"hook": f"Niemand sagt dir das über {niche}", "script": "Kurzes Skript …", "caption": "Wichtig für "+target, "hashtags": ["#"+niche.replace(" ",""), "#shorts"]},
-        ]
+    if not settings.OPENROUTER_API_KEY:
+        return None
 
     prompt = f"""
 Du bist ein Shortform-Creator-Assistent.
 Zielgruppe: {target or 'Allgemein'}; Nische: {niche or 'Creator'}; Ton: {tone or 'locker'}.
-Erzeuge GENAU 3 Sets im JSON-Array. Jedes Set hat:
+Erzeuge GENAU {n} Sets im JSON-Array. Jedes Set hat:
 - "hook" (<= 9 Wörter),
 - "script" (~100 Wörter, Struktur: Hook → 3 Value-Punkte → CTA),
 - "caption" (1 Satz),
@@ -41,23 +46,22 @@ Erzeuge GENAU 3 Sets im JSON-Array. Jedes Set hat:
 Gib NUR JSON aus.
 """.strip()
 
-    headers = {
-        "Authorization": f"Bearer {settings.OPENROUTER_API_KEY}",
-        "Content-Type": "application/json",
-    }
     body = {
-        "model": settings.OPENROUTER_MODEL,
         "messages": [
             {"role":"system","content":"Antworte knapp und NUR im JSON-Format."},
             {"role":"user","content": prompt}
         ],
     }
-    if (os.getenv("LLM_JSON_MODE","off").lower()=="on") or (settings.LLM_JSON_MODE or "").lower()=="on":
+    if (settings.LLM_JSON_MODE or "").lower()=="on":
         body["response_format"] = {"type":"json_object"}
 
-    r = requests.post("https://openrouter.ai/api/v1/chat/completions", headers=headers, json=body, timeout=60)
-    r.raise_for_status()
-    txt = r.json()["choices"][0]["message"]["content"]
+    # geroutet über OPENROUTER_MODELS (Latenz/Fehlerrate/Cooldown, siehe llm_router)
+    try:
+        data, _model = await chat_routed(body, lane=lane)
+        txt = data["choices"][0]["message"]["content"]
+    except Exception as e:
+        logger.warning("[daily3] LLM failed, using fallback: %s", e)
+        return None
     try:
         data = json.loads(txt)
         arr = data if isinstance(data, list) else (list(data.values())[0] if isinstance(data, dict) else [])
@@ -69,14 +73,86 @@ Gib NUR JSON aus.
                 "caption": str(it.get("caption","")).strip(),
                 "hashtags": it.get("hashtags",[]),
             })
-        return out[:3]
+        return out[:n] or None
     except Exception:
         # Fallback auf einfache Vorschläge
-        return _gen_with_llm(niche, target, tone=None)
+        return None
+
+# ---------------------------------------------------------------------------
+# Kohorten: User mit gleicher (Nische, Zielgruppe, Ton) teilen sich pro Tag einen
+# Pool an Packs (1 LLM-Call pro Kohorte statt pro User, daily3_cohort_packs).
+# Jeder User bekommt daraus eine deterministisch gemischte Auswahl → unterschiedliche
+# Ideen je User, stabil über Reloads und Worker hinweg.
+# ---------------------------------------------------------------------------
+COHORTS = "/rest/v1/daily3_cohort_packs"
+_pools: Dict[Tuple[str, str], List[Dict[str,Any]]] = {}   # (cohort_key, Tag) → Pool (nur heute)
+
+def _norm(s: Any) -> str:
+    return " ".join(str(s or "").lower().split())
+
+def _cohort_of(prof: Dict[str,Any]) -> Tuple[str, str, str, str]:
+    """→ (cohort_key, niche, target, tone) mit den Defaults des Endpoints."""
+    niche = str(prof.get("niche") or "").strip() or "Creator"
+    target = str(prof.get("target") or "").strip() or "Anfänger"
+    tone = str((prof.get("brand_voice") or {}).get("tone") or "").strip() or "locker"
+    key = hashlib.sha1("|".join(_norm(x) for x in (niche, target, tone)).encode("utf-8")).hexdigest()[:16]
+    return key, niche, target, tone
+
+def _assign(pool: List[Dict[str,Any]], uid: str, day: str, k: int = 3) -> List[Dict[str,Any]]:
+    # str-Seed → sha512-basiert, in jedem Prozess gleich
+    rnd = random.Random(f"{uid}|{day}")
+    return [pool[i] for i in rnd.sample(range(len(pool)), min(k, len(pool)))]
+
+async def _cohort_pool(key: str, niche: str, target: str, tone: str, lane: int) -> Optional[List[Dict[str,Any]]]:
+    """Pool der Kohorte für heute: Prozess-Cache → DB → 1 LLM-Call (Single-Flight). None bei LLM-Fehler."""
+    day = _today_utc().date().isoformat()
+    pool = _pools.get((key, day))
+    if pool:
+        return pool
+
+    async def _load() -> Optional[List[Dict[str,Any]]]:
+        q = {"select": "packs", "cohort_key": f"eq.{key}", "day": f"eq.{day}", "limit": 1}
+        rows = await supa._get(COHORTS, q)
+        if rows and rows[0].get("packs"):
+            return rows[0]["packs"]
+        packs = await _llm_packs(niche, target, tone, lane, max(3, settings.DAILY3_POOL_SIZE))
+        if not packs:
+            return None  # Fallback nicht speichern → nächster Aufruf versucht es erneut
+        row = {"cohort_key": key, "day": day, "niche": niche, "target": target, "tone": tone, "packs": packs}
+        ins = await supa._post(COHORTS, row, params={"on_conflict": "cohort_key,day"},
+                               extra_headers={"Prefer": "resolution=ignore-duplicates,return=representation"})
+        if not ins:
+            # anderer Worker war schneller → dessen Pool gilt für alle
+            rows = await supa._get(COHORTS, q)
+            if rows and rows[0].get("packs"):
+                return rows[0]["packs"]
+        return packs
+
+    pool, _ = await flights.do(f"daily3:{key}:{day}", _load)
+    if pool:
+        for k in [k for k in _pools if k[1] != day]:
+            del _pools[k]
+        _pools[(key, day)] = pool
+    return pool
 
-def _ensure_today(uid: str) -> List[Dict[str,Any]]:
+async def _packs_for(uid: str, prof: Dict[str,Any], lane: int, exclude: Optional[set] = None) -> List[Dict[str,Any]]:
+    """
+    3 Packs für den User aus dem Kohorten-Pool. Kein Pool (LLM-Fehler/kein Key) → Fallback
+    der Kohorte, kein Call pro User; nur wenn exclude den Pool aufbraucht → eigener Call.
+    """
+    key, niche, target, tone = _cohort_of(prof)
+    pool = await _cohort_pool(key, niche, target, tone, lane)
+    if not pool:
+        return _fallback_packs(niche, target)
+    if exclude:
+        pool = [p for p in pool if p.get("hook") not in exclude]
+    if len(pool) >= 3:
+        return _assign(pool, uid, _today_utc().date().isoformat())
+    return await _gen_with_llm(niche, target, tone, lane)
+
+async def _ensure_today(uid: str) -> List[Dict[str,Any]]:
     start = _today_utc().isoformat()
-    rows, _ = _get_sync("/rest/v1/daily_ideas", {
+    rows = await supa._get("/rest/v1/daily_ideas", {
         "select":"id,idea,meta,created_at",
         "user_id": f"eq.{uid}",
         "created_at": f"gte.{start}",
@@ -84,74 +160,239 @@ def _ensure_today(uid: str) -> List[Dict[str,Any]]:
     })
     return rows or []
 
-def _profile(uid: str):
-    rows, _ = _get_sync("/rest/v1/users_public", {
-        "select":"user_id,niche,target,brand_voice",
+async def _profile(uid: str):
+    rows = await supa._get("/rest/v1/users_public", {
+        "select":"user_id,niche,target,brand_voice,plan",
         "user_id": f"eq.{uid}",
     })
     return rows[0] if rows else {}
 
+async def _clear_today(uid: str) -> None:
+    _today_cache.pop(uid, None)
+    await supa._delete("/rest/v1/daily_ideas", {"user_id": f"eq.{uid}", "created_at": f"gte.{_today_utc().isoformat()}"})
+
+async def _insert_packs(uid: str, packs: List[Dict[str,Any]]) -> None:
+    # ein Multi-Row-Insert statt einem POST pro Idee
+    rows = [{"user_id": uid, "idea": p["hook"], "meta": p} for p in packs]
+    _today_cache.pop(uid, None)
+    if rows:
+        await supa._post("/rest/v1/daily_ideas", rows)
+
+# ---------------------------------------------------------------------------
+# GET /daily3: stale-while-revalidate. Im Request nie ein LLM-Call: fehlen die
+# Ideen von heute, gibt es die letzten älteren (oder den lokalen Fallback) sofort,
+# heute wird im Hintergrund erzeugt (Single-Flight pro User und Tag).
+# Header X-Daily3-Freshness: fresh | stale | fallback.
+# Vor _ensure_today liegt ein kurzer Cache pro User (wird bei Inserts verworfen).
+# ---------------------------------------------------------------------------
+_today_cache: "OrderedDict[str, Tuple[float, str, List[Dict[str,Any]]]]" = OrderedDict()  # uid → (expires, Tag, rows)
+_filling: Dict[str, asyncio.Task] = {}
+
+async def _today_cached(uid: str) -> List[Dict[str,Any]]:
+    day = _today_utc().date().isoformat()
+    now = time.monotonic()
+    item = _today_cache.get(uid)
+    if item and item[0] > now and item[1] == day:
+        _today_cache.move_to_end(uid)
+        return item[2]
+    rows = await _ensure_today(uid)
+    _today_cache[uid] = (now + settings.DAILY3_CACHE_TTL, day, rows)
+    _today_cache.move_to_end(uid)
+    while len(_today_cache) > settings.DAILY3_CACHE_MAX:
+        _today_cache.popitem(last=False)
+    return rows
+
+async def _latest_before_today(uid: str) -> List[Dict[str,Any]]:
+    rows = await supa._get("/rest/v1/daily_ideas", {
+        "select":"id,idea,meta,created_at",
+        "user_id": f"eq.{uid}",
+        "created_at": f"lt.{_today_utc().isoformat()}",
+        "order":"created_at.desc",
+        "limit": 3,
+    })
+    return list(reversed(rows or []))
+
+async def _fill_today(uid: str) -> None:
+    day = _today_utc().date().isoformat()
+
+    async def _run() -> bool:
+        today = await _ensure_today(uid)  # ungecacht: evtl. schon von einem anderen Worker erledigt
+        if len(today) < 3:
+            prof = await _profile(uid)
+            packs = await _packs_for(uid, prof, lane_for(prof.get("plan")))
+            await _insert_packs(uid, packs[len(today):3])
+        return True
+
+    try:
+        await flights.do(f"daily3:user:{uid}:{day}", _run)
+    except Exception as e:
+        logger.warning("[daily3] background fill for %s failed: %s", uid, e)
+    finally:
+        _today_cache.pop(uid, None)
+        _filling.pop(uid, None)
+
+def _schedule_fill(uid: str) -> None:
+    if uid not in _filling:
+        _filling[uid] = asyncio.get_running_loop().create_task(_fill_today(uid))
+
 @router.get("/daily3")
-def get_daily3(authorization: str | None = Header(None)):
-    user = _require_user(authorization)
-    uid = user["id"]
+async def get_daily3(response: Response, uid: str = Depends(current_uid)):
 
-    today = _ensure_today(uid)
+    today = await _today_cached(uid)
     if len(today) >= 3:
+        response.headers["X-Daily3-Freshness"] = "fresh"
         return today
 
-    prof = _profile(uid)
-    tone = (prof.get("brand_voice") or {}).get("tone","locker")
-    niche = prof.get("niche") or "Creator"
-    target = prof.get("target") or "Anfänger"
-
-    packs = _gen_with_llm(niche, target, tone)
-    for i in range(len(today), min(3, len(packs))):
-        p = packs[i]
-        _post_sync("/rest/v1/daily_ideas", {
-            "user_id": uid,
-            "idea": p["hook"],
-            "meta": p
-        })
-    return _ensure_today(uid)
+    _schedule_fill(uid)
+    freshness = "stale"
+    older = await _latest_before_today(uid)
+    if len(today) + len(older) < 3:
+        freshness = "fallback"
+        prof = await _profile(uid)
+        _, niche, target, _ = _cohort_of(prof)
+        now = datetime.now(timezone.utc).isoformat()
+        older += [{"id": None, "idea": p["hook"], "meta": p, "created_at": now} for p in _fallback_packs(niche, target)]
+    response.headers["X-Daily3-Freshness"] = freshness
+    return (today + older)[:3]
 
 @router.post("/daily3/refresh")
-def refresh_my_daily3(authorization: str | None = Header(None)):
-    user = _require_user(authorization)
-    uid = user["id"]
-    start = _today_utc().isoformat()
-    requests.delete(
-        f"{settings.SUPABASE_URL}/rest/v1/daily_ideas",
-        headers={"apikey": settings.SUPABASE_SERVICE_ROLE, "Authorization": f"Bearer {settings.SUPABASE_SERVICE_ROLE}"},
-        params={"user_id": f"eq.{uid}", "created_at": f"gte.{start}"}
-    )
-    return get_daily3(authorization)
+async def refresh_my_daily3(uid: str = Depends(current_uid)):
+    # neue Auswahl: die bisherigen Ideen von heute aus dem Pool ausschließen
+    seen = {r.get("idea") for r in await _ensure_today(uid)}
+    prof = await _profile(uid)
+    packs = await _packs_for(uid, prof, lane_for(prof.get("plan")), exclude=seen)
+    await _clear_today(uid)
+    await _insert_packs(uid, packs[:3])
+    return await _ensure_today(uid)
+
+# ---------------------------------------------------------------------------
+# refresh_all (Cron): alle User per Keyset-Paging (user_id), 1 LLM-Call pro
+# Kohorte (begrenzt parallel), pro Seite 1 DELETE + 1 Multi-Row-INSERT. Fortschritt
+# steht in daily3_refresh_runs (1 Zeile pro Tag): Läuft ein Aufruf ins Zeitbudget
+# oder bricht ab, setzt der nächste am Cursor fort statt von vorn zu beginnen.
+# ---------------------------------------------------------------------------
+RUNS = "/rest/v1/daily3_refresh_runs"
+
+async def _claim_run(day: str, restart: bool) -> Optional[Dict[str, Any]]:
+    """Checkpoint-Zeile anlegen und Lease nehmen → Zeile, oder None wenn ein anderer Lauf sie hält."""
+    await supa._post(RUNS, {"run_date": day}, params={"on_conflict": "run_date"},
+                     extra_headers={"Prefer": "resolution=ignore-duplicates,return=minimal"})
+    now = datetime.now(timezone.utc)
+    patch: Dict[str, Any] = {
+        "lease_until": (now + timedelta(seconds=settings.DAILY3_REFRESH_LEASE_S)).isoformat(),
+        "updated_at": now.isoformat(),
+    }
+    if restart:
+        patch.update({"cursor": None, "processed": 0, "failed": 0, "done": False})
+    # bedingtes PATCH = atomarer Compare-and-Set auf die Lease
+    rows = await supa._patch(RUNS, {
+        "run_date": f"eq.{day}",
+        "or": f"(lease_until.is.null,lease_until.lt.{now.isoformat()})",
+    }, patch)
+    return rows[0] if rows else None
+
+async def _save_run(day: str, **fields: Any) -> None:
+    fields["updated_at"] = datetime.now(timezone.utc).isoformat()
+    await supa._patch(RUNS, {"run_date": f"eq.{day}"}, fields)
+
+async def _refresh_page(users: List[Dict[str, Any]], sem: asyncio.Semaphore) -> Tuple[int, int]:
+    """
+    Eine Seite: Pools pro Kohorte parallel holen, dann alte Ideen löschen + neue gebündelt einfügen.
+    Kohorten ohne Pool (LLM-Fehler/kein Key) bekommen _fallback_packs – nur User, die heute noch
+    nichts haben (vorhandene Ideen bleiben). → (verarbeitet, davon nur mit Fallback).
+    """
+    day = _today_utc().date().isoformat()
+    cohorts = {u["user_id"]: _cohort_of(u) for u in users}
+
+    async def pool(c: Tuple[str, str, str, str]) -> Optional[List[Dict[str, Any]]]:
+        async with sem:
+            return await _cohort_pool(*c, LANE_BATCH)
+
+    unique = list({c[0]: c for c in cohorts.values()}.values())
+    results = await asyncio.gather(*(pool(c) for c in unique), return_exceptions=True)
+    pools = {c[0]: p for c, p in zip(unique, results) if p and not isinstance(p, BaseException)}
+
+    fallback = [u["user_id"] for u in users if cohorts[u["user_id"]][0] not in pools]
+    has_today: set = set()
+    if fallback:
+        existing = await supa._get("/rest/v1/daily_ideas", {
+            "select": "user_id",
+            "user_id": f"in.({','.join(fallback)})",
+            "created_at": f"gte.{_today_utc().isoformat()}",
+        })
+        has_today = {r["user_id"] for r in existing or []}
+
+    rows: List[Dict[str, Any]] = []
+    for u in users:
+        uid = u["user_id"]
+        key, niche, target, _ = cohorts[uid]
+        if key in pools:
+            packs = _assign(pools[key], uid, day)
+        elif uid in has_today:
+            continue
+        else:
+            packs = _fallback_packs(niche, target)
+        rows.extend({"user_id": uid, "idea": x["hook"], "meta": x} for x in packs)
+
+    uids = sorted({r["user_id"] for r in rows})
+    for uid in uids:
+        _today_cache.pop(uid, None)
+    if uids:
+        # erst einfügen, dann die älteren Ideen von heute löschen: scheitert der Insert,
+        # behalten die User ihre bisherigen Ideen (kein leerer Tag bis zum nächsten Lauf)
+        stamp = datetime.now(timezone.utc).isoformat()
+        for r in rows:
+            r["created_at"] = stamp
+        await supa._post("/rest/v1/daily_ideas", rows, extra_headers={"Prefer": "return=minimal"})
+        await supa._delete("/rest/v1/daily_ideas", {
+            "user_id": f"in.({','.join(uids)})",
+            "and": f"(created_at.gte.{_today_utc().isoformat()},created_at.lt.{stamp})",
+        })
+    if fallback:
+        logger.warning("[daily3] %s users without cohort pool, fallback packs used", len(fallback))
+    return len(users), len(fallback)
 
 @router.post("/daily3/refresh_all")
-def refresh_all(x_cron_secret: str | None = Header(None)):
+async def refresh_all(
+    x_cron_secret: str | None = Header(None),
+    restart: bool = Query(False, description="Heutigen Lauf von vorn beginnen"),
+):
     if not settings.CRON_SECRET or x_cron_secret != settings.CRON_SECRET:
         raise HTTPException(403, "forbidden")
 
-    users, _ = _get_sync("/rest/v1/users_public", {
-        "select":"user_id,niche,target,brand_voice",
-        "order": "created_at.desc",
-        "limit": 200
-    })
-    for u in users or []:
-        uid = u["user_id"]
-        start = _today_utc().isoformat()
-        requests.delete(
-            f"{settings.SUPABASE_URL}/rest/v1/daily_ideas",
-            headers={"apikey": settings.SUPABASE_SERVICE_ROLE, "Authorization": f"Bearer {settings.SUPABASE_SERVICE_ROLE}"},
-            params={"user_id": f"eq.{uid}", "created_at": f"gte.{start}"}
-        )
-        bv = u.get("brand_voice") or {}
-        packs = _gen_with_llm(u.get("niche") or "Creator", u.get("target") or "Anfänger", bv.get("tone","locker"))
-        for i in range(min(3, len(packs))):
-            p = packs[i]
-            _post_sync("/rest/v1/daily_ideas", {
-                "user_id": uid,
-                "idea": p["hook"],
-                "meta": p
-            })
-    return {"ok": True}
+    day = _today_utc().date().isoformat()
+    run = await _claim_run(day, restart)
+    if run is None:
+        return {"ok": True, "running": True}
+    cursor: Optional[str] = run.get("cursor")
+    processed, failed = int(run.get("processed") or 0), int(run.get("failed") or 0)
+    done = bool(run.get("done"))
+
+    page = max(1, settings.DAILY3_REFRESH_PAGE)
+    sem = asyncio.Semaphore(max(1, settings.DAILY3_REFRESH_CONCURRENCY))
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + settings.DAILY3_REFRESH_BUDGET_S
+    try:
+        while not done and loop.time() < deadline:
+            params: Dict[str, Any] = {"select": "user_id,niche,target,brand_voice", "order": "user_id.asc", "limit": page}
+            if cursor:
+                params["user_id"] = f"gt.{cursor}"
+            users = await supa._get("/rest/v1/users_public", params) or []
+            if users:
+                # failed = User ohne LLM-Pool (haben Fallback-Packs bekommen)
+                ok, bad = await _refresh_page(users, sem)
+                cursor = users[-1]["user_id"]
+                processed += ok
+                failed += bad
+            done = len(users) < page
+            lease = datetime.now(timezone.utc) + timedelta(seconds=settings.DAILY3_REFRESH_LEASE_S)
+            await _save_run(day, cursor=cursor, processed=processed, failed=failed, done=done,
+                            lease_until=lease.isoformat())
+    finally:
+        try:
+            await _save_run(day, lease_until=None)  # Lease freigeben, nächster Aufruf darf weiter
+        except Exception as e:
+            logger.warning("[daily3] releasing refresh lease failed: %s", e)
+
+    logger.info("[daily3] refresh_all %s: processed=%s failed=%s done=%s", day, processed, failed, done)
+    return {"ok": True, "done": done, "processed": processed, "failed": failed, "cursor": cursor}
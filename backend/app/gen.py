@@ -1,5 +1,7 @@
 from datetime import datetime
+from functools import lru_cache
 from random import choice, sample
+from typing import Any, Iterable
 import re
 
 def _norm_voice(voice: dict | None) -> dict:
@@ -12,26 +14,123 @@ def _norm_voice(voice: dict | None) -> dict:
         "hashtags_base": [h.strip() for h in v.get("hashtags_base", []) if isinstance(h, str) and h.strip()],
     }
 
+# ---------------------------------------------------------------------------
+# Brand-Voice-Filter: Tabuwörter maskieren + Emojis entfernen in EINEM re.sub.
+# Pro Voice-Fingerprint (Tabuwörter, Emojis ja/nein, Hook-Modus) wird genau eine
+# Alternation kompiliert und per LRU gecacht.
+# ---------------------------------------------------------------------------
+MASK = "▮▮"
+EMOJI_CLASS = r"[^\w\s\-.,!?:;#€/€%]"     # Skripte/Captions (lokale Templates)
+EMOJI_CLASS_HOOK = r"[^\w\s\-.,?€%]"      # Hooks: strenger (kein !:;#/)
+# LLM-Freitext: nur echte Emojis/Piktogramme (+ Variation Selector, ZWJ, Keycap),
+# Satzzeichen wie ' " ( ) – bleiben stehen
+EMOJI_CLASS_LLM = r"[\U0001F000-\U0001FAFF\u2600-\u27BF\u2B00-\u2BFF\u231A\u231B\u23E9-\u23FA\uFE0F\u200D\u20E3]"
+
+class VoiceFilter:
+    """Kompilierter Filter; apply() für fertige Texte, stream() für Token-Streams."""
+    __slots__ = ("pattern", "mask", "max_len")
+
+    def __init__(self, forbidden: tuple[str, ...], drop_emojis: bool, hook: bool, llm: bool = False):
+        parts = []
+        if forbidden:
+            # längste zuerst, damit Phrasen vor ihren Teilwörtern greifen
+            words = sorted(forbidden, key=len, reverse=True)
+            parts.append(r"(?P<w>\b(?:" + "|".join(re.escape(w) for w in words) + r")\b)")
+        if drop_emojis:
+            parts.append(EMOJI_CLASS_LLM if llm else (EMOJI_CLASS_HOOK if hook else EMOJI_CLASS))
+        self.pattern = re.compile("|".join(parts), re.IGNORECASE) if parts else None
+        # wie bisher: ohne Emojis fällt auch die Maske (kein \w) weg
+        self.mask = "" if drop_emojis else MASK
+        self.max_len = max((len(w) for w in forbidden), default=0)
+
+    def _sub(self, m: re.Match) -> str:
+        return self.mask if m.lastgroup == "w" else ""
+
+    def apply(self, txt: str) -> str:
+        if self.pattern is None or not txt:
+            return txt
+        return self.pattern.sub(self._sub, txt)
+
+    def stream(self) -> "StreamFilter":
+        return StreamFilter(self)
+
+
+class StreamFilter:
+    """
+    Filter als Stream-Stufe: feed(token) gibt den bereits sicheren Text zurück.
+    Zurückgehalten wird nur das Ende, in dem ein Tabuwort noch über die Token-Grenze
+    laufen könnte (max. Wortlänge, an Whitespace geschnitten); close() gibt den Rest.
+    """
+    __slots__ = ("f", "buf")
+
+    def __init__(self, f: VoiceFilter):
+        self.f = f
+        self.buf = ""
+
+    def feed(self, token: str) -> str:
+        if self.f.pattern is None:
+            return token
+        if not self.f.max_len:
+            return self.f.apply(token)  # nur Emojis: zeichenweise, kein Kontext nötig
+        self.buf += token
+        cut = self._safe_cut(_last_space(self.buf, len(self.buf) - self.f.max_len + 1))
+        if cut <= 0:
+            return ""
+        out, self.buf = self.buf[:cut], self.buf[cut:]
+        return self.f.apply(out)
+
+    def _safe_cut(self, cut: int) -> int:
+        # nicht mitten in einem Treffer (mehrwortige Tabu-Phrasen) schneiden
+        while cut > 0:
+            for m in self.f.pattern.finditer(self.buf, 0, len(self.buf)):
+                if m.start() < cut < m.end():
+                    cut = _last_space(self.buf, m.start())
+                    break
+            else:
+                return cut
+        return cut
+
+    def close(self) -> str:
+        out, self.buf = self.buf, ""
+        return self.f.apply(out)
+
+
+def _last_space(s: str, end: int) -> int:
+    # letzte Leerzeichen-/Zeilenumbruch-Position vor end (-1: keine)
+    return max(s.rfind(" ", 0, max(0, end)), s.rfind("\n", 0, max(0, end)))
+
+
+@lru_cache(maxsize=256)
+def _compiled(forbidden: tuple[str, ...], drop_emojis: bool, hook: bool, llm: bool = False) -> VoiceFilter:
+    return VoiceFilter(forbidden, drop_emojis, hook, llm)
+
+def voice_filter(voice: dict | None, hook: bool = False, llm: bool = False) -> VoiceFilter:
+    """llm=True: für LLM-Output, entfernt nur Emojis statt allem außerhalb der Template-Zeichen."""
+    v = _norm_voice(voice)
+    forbidden = tuple(sorted({w for w in v["forbidden"] if w}))
+    return _compiled(forbidden, not v["emojis"], hook, llm)
+
 def _strip_forbidden(txt: str, forbidden: list[str]) -> str:
     if not forbidden: return txt
-    out = txt
-    for w in forbidden:
-        out = re.sub(rf"\b{re.escape(w)}\b", "▮▮", out, flags=re.IGNORECASE)
-    return out
+    return _compiled(tuple(sorted({w for w in forbidden if w})), False, False).apply(txt)
 
 def _maybe_drop_emojis(txts: list[str], allow: bool) -> list[str]:
     if allow: return txts
-    return [re.sub(r"[^\w\s\-.,!?:;#€/€%]", "", t) for t in txts]
+    f = _compiled((), True, False)
+    return [f.apply(t) for t in txts]
 
 def _append_cta(txt: str, ctas: list[str]) -> str:
     cta = choice(ctas) if ctas else ""
     if not cta: return txt
     return f"{txt}\nCTA: {cta}"
 
+_TRAIL = re.compile(r"[.!?️]+$")
+_SPACES = re.compile(r"\s+")
+
 def _words(text: str) -> list[str]:
     # trennt auf Leerzeichen, entfernt doppelte, säubert Satzzeichen am Ende
-    t = re.sub(r"[.!?️]+$", "", text.strip())
-    return [w for w in re.split(r"\s+", t) if w]
+    t = _TRAIL.sub("", text.strip())
+    return [w for w in _SPACES.split(t) if w]
 
 def _tighten_to_range(s: str, lo=7, hi=9) -> str:
     ws = _words(s)
@@ -41,41 +140,59 @@ def _tighten_to_range(s: str, lo=7, hi=9) -> str:
         ws = ws[:hi]
     return " ".join(ws)
 
-def gen_hooks(topic: str, niche: str, tone: str, voice: dict | None) -> list[str]:
-    v = _norm_voice(voice)
-    patterns = [
-        "Der größte Fehler bei {topic}",
-        "3 schnelle Schritte für {topic}",
-        "{topic} in {niche}: so klappt’s",
-        "Warum {topic} heute Pflicht ist",
-        "Niemand sagt dir das über {topic}",
-        "{topic} ohne teure Tools",
-        "{topic}: die 80/20-Abkürzung",
-        "So startest du {topic} richtig",
-        "Stop wasting Zeit: {topic}",
-        "Bevor du {topic} beginnst, lies das"
-    ]
-    base = [p.format(topic=topic, niche=niche) for p in patterns]
-    if "locker" in (v["tone"] or tone).lower():
-        base = [b.replace("Niemand sagt dir das über", "Das sagt dir keiner über") for b in base]
+HOOK_PATTERNS = (
+    "Der größte Fehler bei {topic}",
+    "3 schnelle Schritte für {topic}",
+    "{topic} in {niche}: so klappt’s",
+    "Warum {topic} heute Pflicht ist",
+    "Niemand sagt dir das über {topic}",
+    "{topic} ohne teure Tools",
+    "{topic}: die 80/20-Abkürzung",
+    "So startest du {topic} richtig",
+    "Stop wasting Zeit: {topic}",
+    "Bevor du {topic} beginnst, lies das"
+)
+# Ton-Variante einmal beim Import statt pro Aufruf
+HOOK_PATTERNS_LOCKER = tuple(p.replace("Niemand sagt dir das über", "Das sagt dir keiner über") for p in HOOK_PATTERNS)
+
+HASHTAGS_BROAD = (
+    "#learn", "#growth", "#creator", "#tips", "#howto", "#shorts", "#tiktok", "#reels",
+    "#content", "#viral", "#strategy", "#daily", "#consistency"
+)
+
 
-    # 7–9 Wörter, Emojis ggf. entfernen, verbotene Wörter maskieren
+class _Voice:
+    """Pro Voice einmal: normalisierte Werte + kompilierte Filter (Hook/Text)."""
+    __slots__ = ("v", "hook_filter", "text_filter")
+
+    def __init__(self, voice: dict | None):
+        self.v = _norm_voice(voice)
+        self.hook_filter = voice_filter(self.v, hook=True)
+        self.text_filter = voice_filter(self.v)
+
+
+def _hooks(topic: str, niche: str, tone: str, vc: _Voice) -> list[str]:
+    locker = "locker" in (vc.v["tone"] or tone).lower()
+    patterns = HOOK_PATTERNS_LOCKER if locker else HOOK_PATTERNS
+
+    # 7–9 Wörter, Emojis ggf. entfernen, verbotene Wörter maskieren (ein Durchlauf)
     outs = []
     seen = set()
-    for b in base:
-        h = _tighten_to_range(b, 7, 9)
-        h = _strip_forbidden(h, v["forbidden"])
-        if not v["emojis"]:
-            h = re.sub(r"[^\w\s\-.,?€%]", "", h)
+    for p in patterns:
+        h = vc.hook_filter.apply(_tighten_to_range(p.format(topic=topic, niche=niche), 7, 9))
         if h.lower() not in seen:
             seen.add(h.lower())
             outs.append(h)
     return outs[:10]
 
+def gen_hooks(topic: str, niche: str, tone: str, voice: dict | None) -> list[str]:
+    return _hooks(topic, niche, tone, _Voice(voice))
 
-def gen_script(topic: str, niche: str, tone: str, voice: dict | None, seconds: int = 35) -> list[str]:
-    v = _norm_voice(voice)
-    hook = choice(gen_hooks(topic, niche, tone, voice))
+
+def _script(topic: str, niche: str, tone: str, vc: _Voice, seconds: int = 35, hooks: list[str] | None = None) -> list[str]:
+    v = vc.v
+    hooks = hooks or _hooks(topic, niche, tone, vc)  # Hooks einmal bauen, zweimal ziehen
+    hook = choice(hooks)
     values = sample([
         f"Schneller Einstieg: fokussiere 1 Ziel rund um {topic}",
         f"Vermeide Streuverlust: 1 Format, 1 Kernbotschaft",
@@ -90,49 +207,81 @@ VALUE 1: {values[0]}
 VALUE 2: {values[1]}
 VALUE 3: {values[2]}
 CTA: {cta_block}"""
-    alt = f"""HOOK: {choice(gen_hooks(topic, niche, tone, voice))}
+    alt = f"""HOOK: {choice(hooks)}
 SCHRITT 1: Problem in {niche} kurz zeigen
 SCHRITT 2: Lösung mit {topic} in 2 Punkten
 SCHRITT 3: Ergebnis/Proof andeuten
 CTA: {cta_block}"""
-    outs = [base, alt]
-    outs = [_strip_forbidden(o, v["forbidden"]) for o in outs]
-    outs = _maybe_drop_emojis(outs, v["emojis"])
-    return outs
+    f = vc.text_filter
+    return [f.apply(o) for o in (base, alt)]
 
-def gen_caption(topic: str, niche: str, tone: str, voice: dict | None) -> list[str]:
-    v = _norm_voice(voice)
+def gen_script(topic: str, niche: str, tone: str, voice: dict | None, seconds: int = 35) -> list[str]:
+    return _script(topic, niche, tone, _Voice(voice), seconds)
+
+def _caption(topic: str, niche: str, vc: _Voice) -> list[str]:
+    v = vc.v
     short = f"{topic} in {niche}: 3 Dinge, die sofort wirken. 🚀 #{niche}"
     mid = f"{topic} schnell erklärt: Fokus, Konsistenz, Messbarkeit. Wenn du das beherrschst, wächst du — ohne Ausreden."
     long = (f"Heute geht’s um {topic} für {niche}. "
             "Starte klein, bleib konsistent, verbessere jede Woche eine Sache. "
             "Frag in den Kommentaren nach einer passenden Vorlage.")
-    outs = [short, mid, _append_cta(long, v["cta"])]
-    outs = [_strip_forbidden(o, v["forbidden"]) for o in outs]
-    outs = _maybe_drop_emojis(outs, v["emojis"])
-    return outs
+    f = vc.text_filter
+    return [f.apply(o) for o in (short, mid, _append_cta(long, v["cta"]))]
 
-def gen_hashtags(topic: str, niche: str, voice: dict | None) -> list[str]:
-    v = _norm_voice(voice)
+def gen_caption(topic: str, niche: str, tone: str, voice: dict | None) -> list[str]:
+    return _caption(topic, niche, _Voice(voice))
+
+def _hashtags(topic: str, niche: str, vc: _Voice) -> list[str]:
     base = list(dict.fromkeys(  # dedupe, preserve order
-        v["hashtags_base"] + [
-            f"#{niche}", f"#{topic.replace(' ', '')}", "#learn", "#growth",
-            "#creator", "#tips", "#howto", "#shorts", "#tiktok", "#reels",
-            "#content", "#viral", "#strategy", "#daily", "#consistency"
-        ]
+        vc.v["hashtags_base"] + [f"#{niche}", f"#{topic.replace(' ', '')}", *HASHTAGS_BROAD]
     ))
     return base[:14]
 
+def gen_hashtags(topic: str, niche: str, voice: dict | None) -> list[str]:
+    return _hashtags(topic, niche, _Voice(voice))
+
+KINDS = ("hook", "script", "caption", "hashtags")
+
+def _generate(kind: str, topic: str, niche: str, tone: str, vc: _Voice, hooks_memo: dict | None = None) -> list[str]:
+    if kind == "hook" or kind == "script":
+        key = (topic, niche, tone)
+        hooks = hooks_memo.get(key) if hooks_memo is not None else None
+        if hooks is None:
+            hooks = _hooks(topic, niche, tone, vc)
+            if hooks_memo is not None:
+                hooks_memo[key] = hooks
+        return list(hooks) if kind == "hook" else _script(topic, niche, tone, vc, hooks=hooks)
+    if kind == "caption":
+        return _caption(topic, niche, vc)
+    if kind == "hashtags":
+        return _hashtags(topic, niche, vc)
+    raise ValueError("Unsupported type")
+
 def generate(kind: str, topic: str, niche: str, tone: str, voice: dict | None = None):
     now = datetime.utcnow().isoformat()
-    if kind == "hook":
-        data = gen_hooks(topic, niche, tone, voice)
-    elif kind == "script":
-        data = gen_script(topic, niche, tone, voice)
-    elif kind == "caption":
-        data = gen_caption(topic, niche, tone, voice)
-    elif kind == "hashtags":
-        data = gen_hashtags(topic, niche, voice)
-    else:
-        raise ValueError("Unsupported type")
+    data = _generate(kind, topic, niche, tone, _Voice(voice))
     return {"generated_at": now, "type": kind, "variants": data}
+
+def generate_many(items: Iterable[dict[str, Any]], voice: dict | None = None) -> list[dict]:
+    """
+    Batch-Variante von generate() für Bulk-Jobs (Daily-Ideen, Kalender-Füllung).
+    items: [{"type", "topic", "niche", "tone"}, ...] – alle mit derselben Voice.
+    Voice wird einmal normalisiert/kompiliert, Hook-Listen pro (topic, niche, tone)
+    einmal gebaut (auch für Skripte). Ergebnis in Eingabe-Reihenfolge, Format wie generate().
+    Unbekannter Typ → ValueError (vor der ersten Generierung).
+    """
+    items = list(items)
+    for it in items:
+        if it.get("type") not in KINDS:
+            raise ValueError("Unsupported type")
+    vc = _Voice(voice)
+    now = datetime.utcnow().isoformat()
+    memo: dict = {}
+    return [
+        {
+            "generated_at": now,
+            "type": it["type"],
+            "variants": _generate(it["type"], it.get("topic") or "", it.get("niche") or "", it.get("tone") or "", vc, memo),
+        }
+        for it in items
+    ]
@@ -0,0 +1,175 @@
+# app/gen_context.py
+# Zweck: Request-Kontext für /generate, /generate_stream und /ws/generate.
+# Profil (inkl. Brand-Voice + Limit), Monatszähler bzw. Credit-Reservierung und
+# Cache-Probe laufen parallel, das Profil wird nur einmal geladen.
+
+from __future__ import annotations
+import asyncio
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Dict, Optional, Set
+
+from . import supa
+from .cache import make_cache_key
+from .ratelimit import remember_plan
+
+DEFAULT_LIMIT = 50
+
+
+@dataclass
+class GenContext:
+    user_id: Optional[str]
+    typ: str
+    payload: Dict[str, Any]             # Request-Payload, tone ggf. aus Brand-Voice
+    cache_key: str
+    force_bypass: bool = False
+    profile: Dict[str, Any] = field(default_factory=dict)
+    voice: Optional[Dict[str, Any]] = None
+    limit: int = DEFAULT_LIMIT
+    used: int = 0
+    hit: Optional[Dict[str, Any]] = None
+    reservation: Optional[str] = None   # ID der offenen Credit-Reservierung (RPC reserve_credit)
+    denied: bool = False                # Monatslimit erreicht, nichts reserviert
+    charged: bool = False               # used enthält diesen Request schon
+    rate_key: Optional[str] = None      # Budget-Key (User-ID/IP) für nachträgliche Token-Kosten
+    rate_plan: Optional[str] = None     # Budget (Plan), gegen das rate_key vorab gebucht wurde
+
+    @property
+    def tone(self) -> str:
+        return (self.payload.get("tone") or "").strip()
+
+    @property
+    def plan(self) -> str:
+        return (self.profile.get("plan") or "free").lower()
+
+    @property
+    def remaining(self) -> int:
+        return max(0, self.limit - self.used)
+
+
+async def _safe(aw: Awaitable[Any], default: Any = None) -> Any:
+    # Kontext-Lookups sind „best effort“ – wie bisher im Endpoint
+    try:
+        return await aw
+    except Exception:
+        return default
+
+async def _none() -> None:
+    return None
+
+def _limit_from(profile: Dict[str, Any]) -> int:
+    try:
+        limit = int(profile.get("monthly_credit_limit") or DEFAULT_LIMIT)
+    except Exception:
+        limit = DEFAULT_LIMIT
+    return limit if limit > 0 else DEFAULT_LIMIT
+
+
+async def load_context(
+    user_id: Optional[str],
+    typ: str,
+    payload: Dict[str, Any],
+    *,
+    force_bypass: bool = False,
+    with_usage: bool = True,
+    reserve: bool = False,
+) -> GenContext:
+    """
+    Lädt alles, was vor dem LLM-Call gebraucht wird, in ~1 RTT:
+    get_profile ‖ count_generates_this_month (reserve=True: reserve_credit) ‖ cache_get_by_key.
+
+    Die Reservierung läuft spekulativ mit, auch wenn die Probe danach einen Cache-Hit
+    findet; der Endpoint löst sie dann über settle()/release() wieder auf.
+
+    Der Cache-Key hängt vom Ton ab, den die Brand-Voice überschreiben kann. Die Probe
+    läuft deshalb spekulativ mit dem Request-Ton; nur wenn die Voice einen anderen
+    Ton setzt, wird mit dem finalen Key ein zweites Mal nachgeschaut.
+    """
+    payload = dict(payload)
+    if not user_id:
+        return GenContext(
+            user_id=None, typ=typ, payload=payload, force_bypass=force_bypass,
+            cache_key=make_cache_key("anon", typ, payload),
+        )
+
+    probe = not force_bypass
+    spec_key = make_cache_key(user_id, typ, payload)
+    if reserve:
+        usage_call = _safe(supa.reserve_credit(user_id), None)
+    elif with_usage:
+        usage_call = _safe(supa.count_generates_this_month(user_id), 0)
+    else:
+        usage_call = _none()
+    profile, usage, hit = await asyncio.gather(
+        _safe(supa.get_profile(user_id), None),
+        usage_call,
+        _safe(supa.cache_get_by_key(spec_key, user_id), None) if probe else _none(),
+    )
+    profile = profile or {}
+    remember_plan(user_id, profile.get("plan"))  # Budget der Rate-Limit-Middleware
+
+    voice = profile.get("brand_voice") or {}
+    if isinstance(voice, dict) and voice.get("tone"):
+        payload["tone"] = (voice.get("tone") or payload.get("tone") or "").strip()
+
+    cache_key = make_cache_key(user_id, typ, payload)
+    if probe and cache_key != spec_key:
+        hit = await _safe(supa.cache_get_by_key(cache_key, user_id), None)
+
+    limit, used = _limit_from(profile), usage
+    credit: Dict[str, Any] = {}
+    if reserve:
+        if isinstance(usage, dict) and "ok" in usage:
+            credit = usage
+            limit, used = int(usage.get("limit") or limit), int(usage.get("used") or 0)
+        else:
+            # RPC nicht erreichbar → nicht blockieren, nur zählen (dieser Request zählt mit)
+            used = await _safe(supa.count_generates_this_month(user_id), 0) + 1
+
+    return GenContext(
+        user_id=user_id,
+        typ=typ,
+        payload=payload,
+        cache_key=cache_key,
+        force_bypass=force_bypass,
+        profile=profile,
+        voice=voice,
+        limit=limit,
+        used=int(used or 0),
+        hit=hit,
+        reservation=(credit.get("reservation") or None) if credit.get("ok") else None,
+        denied=bool(credit) and not credit.get("ok"),
+        charged=reserve and (not credit or bool(credit.get("ok"))),
+    )
+
+
+# ---------------------------------------------------------------------------
+# Credit-Reservierung auflösen
+# ---------------------------------------------------------------------------
+_release_tasks: Set[asyncio.Task] = set()
+
+def settle(ctx: GenContext, counted: bool = True) -> Dict[str, Any]:
+    """
+    Reservierung über den usage_log-Eintrag des Requests auflösen (kein eigener RTT):
+    → Meta-Zusatz {"reservation_id": ...}, den der usage_log-Trigger löscht.
+    counted=False (Cache-Hit/Join): der Request zählt nicht gegen die Credits.
+    Geht der Eintrag verloren (Write-Behind), verfällt die Reservierung nach CREDIT_RESERVE_TTL.
+    """
+    if ctx.charged and not counted:
+        ctx.used = max(0, ctx.used - 1)
+    ctx.charged = False
+    if not ctx.reservation:
+        return {}
+    reservation, ctx.reservation = ctx.reservation, None
+    return {"reservation_id": reservation}
+
+def release(ctx: GenContext) -> None:
+    """Fehler-/Abbruchpfad: Reservierung im Hintergrund zurückgeben (RPC release_credit)."""
+    if ctx.charged:
+        ctx.used = max(0, ctx.used - 1)
+        ctx.charged = False
+    if not ctx.reservation:
+        return
+    reservation, ctx.reservation = ctx.reservation, None
+    task = asyncio.get_running_loop().create_task(_safe(supa.release_credit(reservation)))
+    _release_tasks.add(task)
+    task.add_done_callback(_release_tasks.discard)
@@ -1,20 +1,11 @@
 # app/ical.py
 from datetime import datetime, timezone, timedelta
-from fastapi import APIRouter, HTTPException, Request, Query, Response
+from fastapi import APIRouter, Request, Query, Response
 from . import supa
+from .auth import current_uid
 
 router = APIRouter()
 
-async def _uid_from_request(request: Request) -> str:
-    auth = request.headers.get("authorization") or request.headers.get("Authorization") or ""
-    token = auth.replace("Bearer", "").strip()
-    if not token:
-        raise HTTPException(401, "missing bearer token")
-    user = await supa.get_user_from_token(token)
-    uid = (user.get("user") or {}).get("id") or user.get("id")
-    if not uid:
-        raise HTTPException(401, "invalid token")
-    return uid
 
 def _ics_escape(s: str) -> str:
     if not s:
@@ -36,7 +27,7 @@ async def planner_ical(
     days: int = Query(30, ge=1, le=180),
     filename: str = Query("creatorai_planner.ics")
 ):
-    uid = await _uid_from_request(request)
+    uid = await current_uid(request)
 
     now = datetime.now(timezone.utc)
     until = now + timedelta(days=days)
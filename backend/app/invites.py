@@ -1,10 +1,11 @@
 # app/invites.py — Beta-Invites + Referral (fixed)
-from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi import APIRouter, Depends, HTTPException
 from typing import Optional
 from datetime import datetime, timezone
 import secrets
 from . import supa
 from .config import INVITE_REQUIRED
+from .auth import optional_user
 
 router = APIRouter(prefix="/api/v1/beta", tags=["beta"])
 
@@ -26,17 +27,12 @@ def _update_sync(path: str, json: dict, *, eq: Optional[dict] = None):
         params = {k: f"eq.{v}" for k, v in eq.items()}
     return supa._patch_sync(path, params=params, json=json)
 
-def get_profile_sync(request: Request) -> dict | None:
-    # Read Authorization header -> token -> user -> users_public row
-    auth = request.headers.get("authorization") or request.headers.get("Authorization") or ""
-    token = auth.replace("Bearer", "").strip()
-    if not token:
-        return None
-    user = supa.get_user_from_token(token)
-    uid = user.get("id") or user.get("user", {}).get("id")
-    email = user.get("email") or user.get("user", {}).get("email")
-    if not uid:
+def get_profile_sync(user: dict | None = Depends(optional_user)) -> dict | None:
+    # verifizierter User (auth.optional_user) -> users_public row
+    if not user or not user.get("id"):
         return None
+    uid = user["id"]
+    email = user.get("email")
     rows, _resp = supa._get_sync("/rest/v1/users_public", params={"user_id": f"eq.{uid}", "select": "*"})
     prof = (rows or [{}])[0]
     prof["user_id"] = uid
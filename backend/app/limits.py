@@ -1,55 +1,30 @@
 # backend/app/limits.py
-from fastapi import APIRouter, Header, HTTPException
+import asyncio
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
 from datetime import datetime, timezone
-from calendar import monthrange
-from typing import Optional
-from .supa import _get_sync, get_user_from_token
+from .supa import _get, rebuild_usage_counters, usage_this_month
+from .auth import current_uid
+from .config import settings
 
 router = APIRouter(prefix="/api/v1", tags=["limits"])
 
-def _require_user(authorization: Optional[str]):
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(401, "auth")
-    token = authorization.split(" ", 1)[1]
-    user = get_user_from_token(token)
-    if not user or not user.get("id"):
-        raise HTTPException(401, "auth")
-    return user
-
 @router.get("/me/limits")
-def me_limits(authorization: Optional[str] = Header(None)):
-    user = _require_user(authorization)
-    uid = user["id"]
+async def me_limits(uid: str = Depends(current_uid)):
 
     now = datetime.now(timezone.utc)
     start_month = datetime(now.year, now.month, 1, tzinfo=timezone.utc)
-    end_month = datetime(now.year, now.month, monthrange(now.year, now.month)[1], 23, 59, 59, tzinfo=timezone.utc)
 
-    # profile
-    prof_rows, _ = _get_sync("/rest/v1/users_public", {"select": "monthly_credit_limit,plan", "user_id": f"eq.{uid}"})
+    # profile ‖ usage (used/referrals this month: 1 Lookup in usage_counters, Trigger-gepflegt)
+    prof_rows, usage = await asyncio.gather(
+        _get("/rest/v1/users_public", {"select": "monthly_credit_limit,plan", "user_id": f"eq.{uid}"}),
+        usage_this_month(uid),
+    )
     prof = prof_rows[0] if prof_rows else {}
     base_limit = int(prof.get("monthly_credit_limit") or 50)
     plan = (prof.get("plan") or "free").lower()
 
-    # used = generations this month
-    gens, _ = _get_sync("/rest/v1/generations", {
-        "select": "id",
-        "user_id": f"eq.{uid}",
-        "created_at": f"gte.{start_month.isoformat()}",
-        "order":"created_at.desc",
-        "limit":10000
-    })
-    used = len(gens or [])
-
-    # referrals this month
-    refs, _ = _get_sync("/rest/v1/referrals", {
-        "select": "id",
-        "referrer_user_id": f"eq.{uid}",
-        "created_at": f"gte.{start_month.isoformat()}",
-        "order":"created_at.desc",
-        "limit": 10000
-    })
-    ref_cnt = len(refs or [])
+    used = usage["generations"]
+    ref_cnt = usage["referrals"]
     referral_bonus = 20 * (ref_cnt // 3)
 
     effective_limit = base_limit + referral_bonus
@@ -69,3 +44,15 @@ def me_limits(authorization: Optional[str] = Header(None)):
         "used_this_month": used,
         "remaining": remaining
     }
+
+
+# Backfill/Reparatur der Monatszähler aus usage_log + referrals (per CRON)
+@router.post("/usage/rebuild")
+async def usage_rebuild(
+    x_cron_secret: str | None = Header(None),
+    month: str | None = Query(None, pattern=r"^\d{4}-\d{2}$", description="YYYY-MM, leer = alle Monate"),
+):
+    if not settings.CRON_SECRET or x_cron_secret != settings.CRON_SECRET:
+        raise HTTPException(403, "forbidden")
+    rows = await rebuild_usage_counters(f"{month}-01" if month else None)
+    return {"ok": True, "month": month, "rows": rows}
@@ -0,0 +1,127 @@
+# app/llm_gate.py
+# Zweck: Begrenzt gleichzeitige OpenRouter-Calls pro Worker (LLM_MAX_CONCURRENCY).
+# Wer keinen Slot bekommt, wartet in einer Lane: pro/team (interaktiv) vor free vor
+# Batch (Cron). Freie Slots gehen immer an die höchste wartende Lane, FIFO innerhalb.
+
+from __future__ import annotations
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional
+
+from .config import settings
+
+LANE_PAID = 0
+LANE_FREE = 1
+LANE_BATCH = 2
+LANE_NAMES = ("paid", "free", "batch")
+
+PAID_PLANS = ("pro", "team")
+
+
+class GateTimeout(Exception):
+    """Kein Slot innerhalb von LLM_QUEUE_TIMEOUT → Caller fällt lokal zurück."""
+
+
+def lane_for(plan: Optional[str], batch: bool = False) -> int:
+    if batch:
+        return LANE_BATCH
+    return LANE_PAID if (plan or "").lower() in PAID_PLANS else LANE_FREE
+
+
+class _LaneStats:
+    __slots__ = ("admitted", "queued", "timeouts", "wait_total", "wait_max", "wait_ewma")
+
+    def __init__(self):
+        self.admitted = 0
+        self.queued = 0        # mussten warten
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.wait_ewma = 0.0
+
+    def record(self, waited: float) -> None:
+        self.admitted += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        self.wait_ewma = 0.8 * self.wait_ewma + 0.2 * waited
+
+
+class PriorityGate:
+    def __init__(self, limit: int):
+        self.limit = max(1, limit)
+        self.active = 0
+        self._waiters: List[Deque[asyncio.Future]] = [deque() for _ in LANE_NAMES]
+        self._stats = [_LaneStats() for _ in LANE_NAMES]
+
+    def _queued(self) -> int:
+        return sum(len(q) for q in self._waiters)
+
+    @asynccontextmanager
+    async def slot(self, lane: int, timeout: Optional[float] = None) -> AsyncIterator[None]:
+        await self._acquire(lane, timeout)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, lane: int, timeout: Optional[float]) -> None:
+        st = self._stats[lane]
+        if self.active < self.limit and not self._queued():
+            self.active += 1
+            st.record(0.0)
+            return
+
+        st.queued += 1
+        t0 = time.monotonic()
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters[lane].append(fut)
+        try:
+            await asyncio.wait_for(fut, timeout) if timeout else await fut
+        except BaseException as e:
+            if fut.done() and not fut.cancelled():
+                self._release()  # Slot wurde schon übergeben → weiterreichen
+            else:
+                fut.cancel()
+                try:
+                    self._waiters[lane].remove(fut)
+                except ValueError:
+                    pass
+            if isinstance(e, asyncio.TimeoutError):
+                st.timeouts += 1
+                raise GateTimeout(f"LLM queue timeout ({LANE_NAMES[lane]})") from None
+            raise
+        st.record(time.monotonic() - t0)
+
+    def _release(self) -> None:
+        # Slot direkt an den nächsten Wartenden übergeben (active bleibt gleich)
+        for q in self._waiters:
+            while q:
+                fut = q.popleft()
+                if not fut.done():
+                    fut.set_result(None)
+                    return
+        self.active -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        lanes = {}
+        for name, q, st in zip(LANE_NAMES, self._waiters, self._stats):
+            lanes[name] = {
+                "waiting": len(q),
+                "admitted": st.admitted,
+                "queued": st.queued,
+                "timeouts": st.timeouts,
+                "wait_ms_avg": round(st.wait_total / st.admitted * 1000, 1) if st.admitted else 0.0,
+                "wait_ms_ewma": round(st.wait_ewma * 1000, 1),
+                "wait_ms_max": round(st.wait_max * 1000, 1),
+            }
+        return {"limit": self.limit, "active": self.active, "lanes": lanes}
+
+
+def queue_timeout(lane: int) -> Optional[float]:
+    # Batch darf warten; interaktive Requests fallen nach LLM_QUEUE_TIMEOUT lokal zurück
+    return None if lane == LANE_BATCH else (settings.LLM_QUEUE_TIMEOUT or None)
+
+
+gate = PriorityGate(settings.LLM_MAX_CONCURRENCY)
@@ -1,9 +1,14 @@
-import json, re
+import json, re, random, asyncio, time
 import httpx
-from typing import Any, Dict, List
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from .config import settings
+from .llm_router import router
+from .llm_gate import LANE_FREE, gate, queue_timeout
 
 OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+RETRY_STATUS = (429, 500, 502, 503, 504)
 
 def _headers() -> Dict[str, str]:
     h = {
@@ -17,6 +22,60 @@ def _headers() -> Dict[str, str]:
         h["X-Title"] = settings.OPENROUTER_APP_TITLE
     return h
 
+
+# ---------------------------------------------------------------------------
+# Gepoolter Async-Client (HTTP/2, Keep-Alive) – auch für llm_stream_openrouter.
+# Lifespan öffnet/schließt ihn; in Skripten wird er lazy angelegt.
+# ---------------------------------------------------------------------------
+_async_client: Optional[httpx.AsyncClient] = None
+
+def _client() -> httpx.AsyncClient:
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        _async_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(settings.LLM_TIMEOUT, connect=10.0),
+            limits=httpx.Limits(max_connections=settings.LLM_POOL_MAX, max_keepalive_connections=settings.LLM_POOL_MAX),
+            http2=settings.OPENROUTER_HTTP2.lower() == "on",
+        )
+    return _async_client
+
+def open_client() -> None:
+    _client()
+
+async def close_client() -> None:
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+
+class OpenRouterError(RuntimeError):
+    """HTTP-Fehler von OpenRouter; retry_after in Sekunden (falls vom Server gesetzt)."""
+
+    def __init__(self, status: int, message: str, retry_after: Optional[float] = None):
+        super().__init__(f"OpenRouter {status}: {message}")
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        return self.status in RETRY_STATUS
+
+
+def _retry_after(value: Optional[str]) -> Optional[float]:
+    # Retry-After: Sekunden oder HTTP-Datum
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        dt = parsedate_to_datetime(value)
+        return max(0.0, (dt - datetime.now(timezone.utc)).total_seconds())
+    except Exception:
+        return None
+
 def _as_schema():
     # Striktes JSON-Objekt mit "variants": string[]
     return {
@@ -122,17 +181,135 @@ def _parse_variants(content: str) -> List[str]:
     lines = [l.strip(" -•\t") for l in content.splitlines() if l.strip()]
     return lines[:10] if lines else []
 
-def call_openrouter(kind: str, topic: str, niche: str, tone: str, voice: dict | None) -> List[str]:
-    if not settings.OPENROUTER_API_KEY:
-        raise RuntimeError("OPENROUTER_API_KEY not set")
 
+_NUMBERED = re.compile(r"^\s*(\d{1,2})[.)]\s+")
+_SEPARATOR = re.compile(r"^\s*-{3,}\s*$")
+
+class VariantParser:
+    """
+    Inkrementelles Gegenstück zu _parse_variants für Streams: feed(token) liefert jede
+    Variante, sobald sie abgeschlossen ist – ein String-Element im JSON-Array
+    ({"variants": [...]} oder [...]), eine nummerierte Zeile/Absatz oder ein ---Block.
+    close() liefert den Rest (letzte Variante, ggf. Zeilen-Fallback wie _parse_variants).
+    clean (optional) wird auf jede fertige Variante angewendet, z. B. der Brand-Voice-Filter.
+    """
+
+    def __init__(self, clean: Optional[Callable[[str], str]] = None):
+        self.clean = clean
+        self.mode: Optional[str] = None   # "json" | "text"
+        self.variants: List[str] = []
+        # JSON-Zustand
+        self._depth = 0
+        self._array_depth: Optional[int] = None
+        self._in_str = False
+        self._esc = False
+        self._str: List[str] = []
+        # Text-Zustand
+        self._line = ""
+        self._block: List[str] = []
+        self._structured = False
+
+    def feed(self, text: str) -> List[str]:
+        if not text:
+            return []
+        if self.mode is None:
+            head = text.lstrip()
+            if not head:
+                return []
+            self.mode = "json" if head[0] in "{[" else "text"
+        out = self._feed_json(text) if self.mode == "json" else self._feed_text(text)
+        return self._add(out)
+
+    def close(self) -> List[str]:
+        out: List[str] = []
+        if self.mode == "text":
+            if self._line:
+                out += self._text_line(self._line)
+                self._line = ""
+            block = self._flush_block()
+            if block:
+                if self._structured or self.variants:
+                    out.append(block)
+                else:
+                    # weder Nummern noch Trenner → wie _parse_variants: Zeilen
+                    out += [l.strip(" -•\t") for l in block.splitlines() if l.strip()][:10]
+        return self._add(out)
+
+    def _add(self, out: List[str]) -> List[str]:
+        if self.clean is not None:
+            out = [self.clean(v) for v in out]
+        self.variants += out
+        return out
+
+    # ---- JSON: String-Elemente des (ersten) Arrays -----------------------------
+    def _feed_json(self, text: str) -> List[str]:
+        out: List[str] = []
+        for ch in text:
+            if self._in_str:
+                self._str.append(ch)
+                if self._esc:
+                    self._esc = False
+                elif ch == "\\":
+                    self._esc = True
+                elif ch == '"':
+                    self._in_str = False
+                    if self._array_depth is not None and self._depth == self._array_depth:
+                        try:
+                            v = json.loads('"' + "".join(self._str))
+                        except ValueError:
+                            v = None
+                        if isinstance(v, str) and v.strip():
+                            out.append(v.strip())
+                    self._str = []
+                continue
+            if ch == '"':
+                self._in_str = True
+            elif ch in "{[":
+                self._depth += 1
+                if ch == "[" and self._array_depth is None:
+                    self._array_depth = self._depth
+            elif ch in "}]":
+                if ch == "]" and self._depth == self._array_depth:
+                    self._array_depth = -1  # Array zu, weitere Strings ignorieren
+                self._depth -= 1
+        return out
+
+    # ---- Text: nummerierte Einträge / ---Blöcke --------------------------------
+    def _feed_text(self, text: str) -> List[str]:
+        out: List[str] = []
+        self._line += text
+        while "\n" in self._line:
+            line, self._line = self._line.split("\n", 1)
+            out += self._text_line(line)
+        return out
+
+    def _text_line(self, line: str) -> List[str]:
+        if _SEPARATOR.match(line):
+            self._structured = True
+            block = self._flush_block()
+            return [block] if block else []
+        m = _NUMBERED.match(line)
+        if m:
+            self._structured = True
+            block = self._flush_block()
+            self._block = [line[m.end():]]
+            return [block] if block else []
+        if self._block or line.strip():
+            self._block.append(line)
+        return []
+
+    def _flush_block(self) -> str:
+        block = "\n".join(self._block).strip()
+        self._block = []
+        return block
+
+def _payload(kind: str, topic: str, niche: str, tone: str, voice: dict | None) -> Dict[str, Any]:
     messages = [
         {"role": "system", "content": _system_json_prompt()},
         {"role": "user", "content": _user_prompt(kind, topic, niche, tone, voice)},
     ]
 
     payload: Dict[str, Any] = {
-        "model": settings.OPENROUTER_MODEL,
         "messages": messages,
         "temperature": 0.7 if kind in ("hook","caption") else 0.4,
         "max_tokens": 1200,
@@ -151,35 +328,82 @@ def call_openrouter(kind: str, topic: str, niche: str, tone: str, voice: dict |
             "effort": "medium",
             "exclude": True  # reasoning nicht im finalen Text anzeigen
         }
+    return payload
 
-    with httpx.Client(timeout=60.0) as c:
-        r = c.post(OPENROUTER_URL, headers=_headers(), json=payload)
-        # 429/403 → Caller soll fallbacken
-        if r.status_code in (429, 403, 402):
-            raise RuntimeError(f"OpenRouter limit/forbidden: {r.status_code} {r.text[:200]}")
-        r.raise_for_status()
-        data = r.json()
+async def _post_chat(payload: Dict[str, Any], timeout: Optional[float] = None) -> Dict[str, Any]:
+    """Ein Versuch gegen das Modell in payload["model"]; timeout begrenzt den ganzen Versuch."""
+    r = await asyncio.wait_for(
+        _client().post(OPENROUTER_URL, headers=_headers(), json=payload),
+        timeout or settings.LLM_TIMEOUT,
+    )
+    # 429/403/402 → anderes Modell bzw. (zuletzt) lokaler Fallback
+    if r.status_code >= 400:
+        raise OpenRouterError(r.status_code, r.text[:200], _retry_after(r.headers.get("retry-after")))
+    return r.json()
 
-    content = data["choices"][0]["message"]["content"]
-    usage = _extract_usage(data)
-    return _parse_variants(content), usage
+async def chat_routed(payload: Dict[str, Any], attempts: Optional[int] = None,
+                      backoff: Optional[float] = None, lane: int = LANE_FREE) -> Tuple[Dict[str, Any], str]:
+    """
+    Chat-Completion über die Modell-Kette (llm_router) → (response, model).
+    Jeder Versuch nimmt das aktuell beste Modell; Fehler fließen in die Stats, sodass
+    das nächste Modell übernimmt. Gewartet wird nur, wenn kein anderes Modell bereitsteht:
+    Retry-After (bis LLM_RETRY_AFTER_MAX, sonst aufgeben) bzw. Backoff mit Full Jitter.
+    Jeder Versuch braucht einen Slot im llm_gate (lane = Priorität); GateTimeout geht an den Caller.
+    """
+    if not settings.OPENROUTER_API_KEY:
+        raise RuntimeError("OPENROUTER_API_KEY not set")
+    attempts = attempts or settings.LLM_RETRIES
+    backoff = settings.LLM_BACKOFF if backoff is None else backoff
+    for i in range(attempts):
+        async with gate.slot(lane, queue_timeout(lane)):
+            model = router.pick() or settings.OPENROUTER_MODEL
+            t0 = time.monotonic()
+            try:
+                data = await _post_chat({**payload, "model": model})
+                router.success(model, time.monotonic() - t0)
+                return data, model
+            except OpenRouterError as e:
+                router.failure(model, e.status, e.retry_after)
+                if i + 1 >= attempts or not (e.retryable or e.status in (402, 403)):
+                    raise
+                retry_after, err = e.retry_after, e
+            except (asyncio.TimeoutError, httpx.TimeoutException, httpx.TransportError) as e:
+                router.failure(model)
+                if i + 1 >= attempts:
+                    raise
+                retry_after, err = None, e
 
-import time
+        if router.pick() != model:
+            continue  # anderes Modell bereit → sofort weiter
+        if isinstance(err, OpenRouterError) and not err.retryable:
+            raise err  # 402/403 ohne Ausweichmodell
+        if retry_after is not None:
+            if retry_after > settings.LLM_RETRY_AFTER_MAX:
+                raise err
+            await asyncio.sleep(retry_after)
+        else:
+            await asyncio.sleep(random.uniform(0, backoff * (2 ** i)))
+    raise RuntimeError("no attempts")
 
-def call_openrouter_retry(kind: str, topic: str, niche: str, tone: str, voice: dict | None, attempts: int = 2, backoff: float = 0.8):
-    last_err = None
-    for i in range(attempts):
-        try:
-            return call_openrouter(kind, topic, niche, tone, voice)
-        except RuntimeError as e:
-            last_err = e
-            msg = str(e)
-            if "429" in msg and i + 1 < attempts:
-                time.sleep(backoff * (i + 1))
-                continue
-            raise
-    if last_err:
-        raise last_err
+async def call_openrouter(kind: str, topic: str, niche: str, tone: str, voice: dict | None,
+                          model: Optional[str] = None, timeout: Optional[float] = None,
+                          lane: int = LANE_FREE) -> Tuple[List[str], dict]:
+    """Ein Versuch gegen ein festes Modell → (variants, usage)."""
+    if not settings.OPENROUTER_API_KEY:
+        raise RuntimeError("OPENROUTER_API_KEY not set")
+    payload = {**_payload(kind, topic, niche, tone, voice), "model": model or settings.OPENROUTER_MODEL}
+    async with gate.slot(lane, queue_timeout(lane)):
+        data = await _post_chat(payload, timeout)
+    content = data["choices"][0]["message"]["content"]
+    return _parse_variants(content), {**_extract_usage(data), "model": payload["model"]}
+
+async def call_openrouter_retry(kind: str, topic: str, niche: str, tone: str, voice: dict | None,
+                                attempts: Optional[int] = None, backoff: Optional[float] = None,
+                                lane: int = LANE_FREE) -> Tuple[List[str], dict]:
+    """Geroutet über OPENROUTER_MODELS mit Retry → (variants, usage inkl. "model")."""
+    data, model = await chat_routed(_payload(kind, topic, niche, tone, voice), attempts, backoff, lane)
+    content = data["choices"][0]["message"]["content"]
+    return _parse_variants(content), {**_extract_usage(data), "model": model}
 
 def _extract_usage(data: dict) -> dict:
     # robust gegen unterschiedliche Felder
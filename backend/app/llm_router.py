@@ -0,0 +1,132 @@
+# app/llm_router.py
+# Zweck: Routing über mehrere OpenRouter-Modelle (OPENROUTER_MODELS, CSV, geordnet).
+# Pro Modell laufen EWMA von Latenz, Time-to-first-Token und Fehlerrate mit; Modelle,
+# die 429/402/403 liefern oder wiederholt scheitern, gehen in einen Cooldown.
+
+from __future__ import annotations
+import random
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+from .config import settings
+
+COOLDOWN_MAX = 300.0      # Sekunden
+FAIL_STREAK = 3           # so viele Fehler in Folge → Cooldown
+ERR_WEIGHT = 4.0          # Fehlerrate 25% ≈ doppelte Latenz
+
+
+class ModelStats:
+    __slots__ = ("model", "latency", "ttft", "err", "calls", "failures", "streak", "cooldown_until")
+
+    def __init__(self, model: str):
+        self.model = model
+        self.latency: Optional[float] = None   # EWMA Gesamtdauer (s)
+        self.ttft: Optional[float] = None      # EWMA Time-to-first-Token (s), nur Streams
+        self.err = 0.0                         # EWMA Fehlerrate 0..1
+        self.calls = 0
+        self.failures = 0
+        self.streak = 0
+        self.cooldown_until = 0.0
+
+    def cooling(self, now: float) -> bool:
+        return self.cooldown_until > now
+
+    def score(self, stream: bool) -> float:
+        base = (self.ttft if stream else None) or self.latency
+        if base is None:
+            return 0.0  # noch keine Messung → zuerst probieren
+        return base * (1.0 + ERR_WEIGHT * self.err)
+
+
+def _ewma(old: Optional[float], new: float, alpha: float) -> float:
+    return new if old is None else (1 - alpha) * old + alpha * new
+
+
+class ModelRouter:
+    def __init__(self, models: Iterable[str], alpha: float, cooldown: float, explore: float):
+        self.alpha = alpha
+        self.cooldown = cooldown
+        self.explore = explore
+        self._stats: Dict[str, ModelStats] = {m: ModelStats(m) for m in models}
+
+    @property
+    def models(self) -> List[str]:
+        return list(self._stats)
+
+    def order(self, stream: bool = False) -> List[str]:
+        """
+        Modelle nach Score (beste zuerst), Modelle im Cooldown nicht dabei.
+        Sind alle im Cooldown, kommt das mit dem frühesten Ende – lieber versuchen als gar nicht.
+        Die Config-Reihenfolge entscheidet bei Gleichstand.
+        """
+        now = time.monotonic()
+        ready = [s for s in self._stats.values() if not s.cooling(now)]
+        if not ready:
+            return [min(self._stats.values(), key=lambda s: s.cooldown_until).model]
+        pos = {m: i for i, m in enumerate(self._stats)}
+        ready.sort(key=lambda s: (s.score(stream), pos[s.model]))
+        out = [s.model for s in ready]
+        # etwas Exploration, damit Stats von Ausweichmodellen nicht veralten
+        if len(out) > 1 and random.random() < self.explore:
+            out.insert(0, out.pop(random.randrange(1, len(out))))
+        return out
+
+    def pick(self, stream: bool = False, exclude: Iterable[str] = ()) -> Optional[str]:
+        skip = set(exclude)
+        for m in self.order(stream):
+            if m not in skip:
+                return m
+        return None
+
+    def _get(self, model: str) -> ModelStats:
+        s = self._stats.get(model)
+        if s is None:
+            s = self._stats[model] = ModelStats(model)
+        return s
+
+    def success(self, model: str, latency: float, ttft: Optional[float] = None) -> None:
+        s = self._get(model)
+        s.calls += 1
+        s.streak = 0
+        s.latency = _ewma(s.latency, latency, self.alpha)
+        if ttft is not None:
+            s.ttft = _ewma(s.ttft, ttft, self.alpha)
+        s.err = (1 - self.alpha) * s.err
+
+    def failure(self, model: str, status: Optional[int] = None, retry_after: Optional[float] = None) -> None:
+        s = self._get(model)
+        s.calls += 1
+        s.failures += 1
+        s.streak += 1
+        s.err = (1 - self.alpha) * s.err + self.alpha
+        now = time.monotonic()
+        if status in (402, 403, 429):
+            # Limit/Quota: Modell sofort parken (Retry-After, falls gesetzt)
+            pause = retry_after if retry_after is not None else self.cooldown
+        elif s.streak >= FAIL_STREAK:
+            pause = self.cooldown * (2 ** (s.streak - FAIL_STREAK))
+        else:
+            return
+        s.cooldown_until = max(s.cooldown_until, now + min(COOLDOWN_MAX, pause))
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            s.model: {
+                "latency_ms": round(s.latency * 1000) if s.latency is not None else None,
+                "ttft_ms": round(s.ttft * 1000) if s.ttft is not None else None,
+                "error_rate": round(s.err, 3),
+                "calls": s.calls,
+                "failures": s.failures,
+                "cooldown_s": round(max(0.0, s.cooldown_until - now), 1),
+            }
+            for s in self._stats.values()
+        }
+
+
+router = ModelRouter(
+    settings.openrouter_models(),
+    alpha=settings.LLM_ROUTER_ALPHA,
+    cooldown=settings.LLM_MODEL_COOLDOWN,
+    explore=settings.LLM_ROUTER_EXPLORE,
+)
@@ -1,11 +1,13 @@
 # app/llm_stream_openrouter.py
 from __future__ import annotations
 import json
-import asyncio
-import httpx
+import time
 from typing import AsyncGenerator, Dict, Optional
 
 from .config import settings
+from .llm_openrouter import OPENROUTER_URL, _client, _retry_after
+from .llm_router import router
+from .llm_gate import LANE_FREE, gate, queue_timeout
 
 # --- Minimaler Prompt-Builder (kompatibel zu deinem Setup) -------------------
 def _build_messages(
@@ -27,11 +29,12 @@ def _build_messages(
         if voice.get("cta"):
             bv_lines.append(f"CTA-Beispiele: {', '.join(voice.get('cta') or [])}")
     bv = ("\n".join(bv_lines)).strip()
+    bv_block = ("Brand-Voice:\n" + bv) if bv else ""
 
     sys = (
         "Du bist eine KI für Shortform-Content (TikTok/IG/YT Shorts).\n"
         f"Zielnische: {niche}\n"
-        f"{('Brand-Voice:\n' + bv) if bv else ''}\n"
+        f"{bv_block}\n"
         "Antwort immer kurz, präzise und in natürlichem Deutsch."
     ).strip()
 
@@ -71,10 +74,15 @@ async def stream_openrouter(
     voice: Optional[dict] = None,
     temperature: float = 0.7,
     max_tokens: int = 700,
+    meta: Optional[dict] = None,
+    lane: int = LANE_FREE,
 ) -> AsyncGenerator[str, None]:
     """
     Liefert inkrementell Tokens/Textstücke (bereits zusammengesetzt aus deltas).
     Nutzt OpenRouter (OpenAI-kompatibles Chat Completions-API) mit stream=true.
+    meta["model"] bekommt das Modell, das den Stream tatsächlich liefert, meta["usage"]
+    die Token-Zahlen aus dem letzten Chunk (falls geliefert).
+    Der Stream hält für seine Dauer einen Slot im llm_gate (lane = Priorität).
     """
     if not settings.OPENROUTER_API_KEY:
         raise RuntimeError("OPENROUTER_API_KEY not configured")
@@ -88,34 +96,72 @@ async def stream_openrouter(
         headers["X-Title"] = settings.OPENROUTER_APP_TITLE or "Creator AI"
 
     body: Dict = {
-        "model": settings.OPENROUTER_MODEL or "x-ai/grok-4-fast:free",
         "stream": True,
         "temperature": temperature,
         "max_tokens": max_tokens,
         "messages": _build_messages(typ, topic, niche, tone, voice),
+        "usage": {"include": True},  # Token-Zahlen im letzten Chunk (Rate-Limit nach Tokens)
     }
 
-    url = "https://openrouter.ai/api/v1/chat/completions"
+    # Modell-Kette (llm_router): gewechselt wird nur, solange noch kein Token raus ist
+    last_err: Optional[BaseException] = None
+    tried: list[str] = []
+    for _ in range(max(1, settings.LLM_RETRIES)):
+        model = router.pick(stream=True, exclude=tried)
+        if model is None:
+            break
+        tried.append(model)
+        ttft: Optional[float] = None
+        async with gate.slot(lane, queue_timeout(lane)):
+            t0 = time.monotonic()
+            try:
+                async for token in _stream_model(headers, {**body, "model": model}, meta):
+                    if ttft is None:
+                        ttft = time.monotonic() - t0
+                        if meta is not None:
+                            meta["model"] = model
+                    yield token
+            except Exception as e:
+                resp = getattr(e, "response", None)
+                router.failure(
+                    model,
+                    getattr(resp, "status_code", None),
+                    _retry_after(resp.headers.get("retry-after")) if resp is not None else None,
+                )
+                if ttft is not None:
+                    raise
+                last_err = e
+                continue
+        if ttft is None:
+            router.failure(model)
+            last_err = RuntimeError(f"empty stream from {model}")
+            continue
+        router.success(model, time.monotonic() - t0, ttft)
+        return
+    raise last_err or RuntimeError("no LLM model available")
 
-    async with httpx.AsyncClient(timeout=None) as client:
-        async with client.stream("POST", url, headers=headers, json=body) as resp:
-            resp.raise_for_status()
-            async for raw_line in resp.aiter_lines():
-                if not raw_line:
+
+async def _stream_model(headers: Dict[str, str], body: Dict, meta: Optional[dict] = None) -> AsyncGenerator[str, None]:
+    # gepoolter Client (HTTP/2, Keep-Alive); read-Timeout gilt pro Chunk, nicht gesamt
+    async with _client().stream("POST", OPENROUTER_URL, headers=headers, json=body) as resp:
+        resp.raise_for_status()
+        async for raw_line in resp.aiter_lines():
+            if not raw_line:
+                continue
+            # SSE-Format: "data: {...}"
+            if raw_line.startswith("data:"):
+                data = raw_line[5:].strip()
+                if data == "[DONE]":
+                    break
+                try:
+                    obj = json.loads(data)
+                    if obj.get("usage") and meta is not None:
+                        meta["usage"] = obj["usage"]  # letzter Chunk (usage.include)
+                    choice = (obj.get("choices") or [{}])[0]
+                    delta = (choice.get("delta") or {})
+                    token = delta.get("content")
+                    if token:
+                        yield token
+                except Exception:
+                    # ignore malformed lines silently
                     continue
-                # SSE-Format: "data: {...}"
-                if raw_line.startswith("data:"):
-                    data = raw_line[5:].strip()
-                    if data == "[DONE]":
-                        break
-                    try:
-                        obj = json.loads(data)
-                        choice = (obj.get("choices") or [{}])[0]
-                        delta = (choice.get("delta") or {})
-                        token = delta.get("content")
-                        if token:
-                            yield token
-                    except Exception:
-                        # ignore malformed lines silently
-                        continue
-                await asyncio.sleep(0)
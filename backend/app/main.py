@@ -1,9 +1,9 @@
 # app/main.py
 from datetime import datetime, timezone, timedelta
 from typing import Literal, Optional
-import os
 import logging
 import asyncio, json
+from contextlib import aclosing, asynccontextmanager
 from fastapi import WebSocket, WebSocketDisconnect
 from fastapi.responses import StreamingResponse
 from .llm_stream_openrouter import stream_openrouter  # NEU
@@ -18,9 +18,8 @@ from .invites import router as invites_router
 from .billing import router as billing_router
 from .planner_api import router as planner_api_router  # optional
 
-from fastapi import FastAPI, HTTPException, Header, Response, Query, Request, Path, APIRouter
+from fastapi import FastAPI, Depends, HTTPException, Header, Response, Query, Request, Path, APIRouter
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
 from pydantic import BaseModel, field_validator
 
 
@@ -33,25 +32,52 @@ from .reminder import router as reminder_router
 from .analytics import router as analytics_router  # NEU
 from .mailer import send_mail
 from .config import settings
-from .supa import get_upcoming_slots, mark_reminded
-from .llm_openrouter import call_openrouter_retry
-from .gen import generate as generate_local
+from .supa import get_upcoming_slots_sync, mark_reminded_sync
+from . import llm_openrouter
+from . import state
+from .llm_openrouter import VariantParser, call_openrouter_retry
+from .llm_router import router as llm_router
+from .llm_gate import gate as llm_gate, lane_for
+from .gen import generate as generate_local, voice_filter
 
-# Sync helpers (bestehend)
+from .auth import auth_stats, current_uid, optional_user, user_from_token
+
+# Async helpers (blockieren den Event-Loop nicht)
 from .supa import (
-    get_user_from_token,
     get_profile,
-    get_profile_full,        # Brand-Voice
     count_generates_this_month,
+    credit_status,
     month_start_utc,
 )
+from .gen_context import GenContext, load_context, release, settle
+from .singleflight import StreamFlight, flights
+from .writebehind import write_behind
+from .coalesce import coalesce
 
 # NEU/GEÄNDERT: Cache & async-Logging via supa + Cache-Key-Helper
-from .cache import make_cache_key, normalize_payload
-from .ratelimit import check_allow  # Rate limit helper
+from .cache import normalize_payload, prompt_lru
+from .ratelimit import charge, charge_tokens, plan_hint, route_cost, stats as ratelimit_stats  # Rate limit helper
+
+
+# ------------- Lifespan: app-weite Ressourcen (HTTP-Pools) -------------
+logger = logging.getLogger("uvicorn.error")
+
+@asynccontextmanager
+async def _lifespan(_app: FastAPI):
+    _startup_env_report()
+    supa.open_clients()
+    llm_openrouter.open_client()
+    write_behind.start()
+    try:
+        yield
+    finally:
+        await write_behind.stop(settings.WRITE_DRAIN_TIMEOUT)
+        await llm_openrouter.close_client()
+        await supa.close_clients()
+        await state.close()
 
 
-app = FastAPI(title="Creator AI Backend", version="0.4.0")
+app = FastAPI(title="Creator AI Backend", version="0.4.0", lifespan=_lifespan)
 
 # Router aus Modulen einhängen
 app.include_router(analytics_router)              # NEU
@@ -74,10 +100,7 @@ app.add_middleware(
     max_age=600,
 )
 
-# ------------- Startup-Report (nur Logs) -------------
-logger = logging.getLogger("uvicorn.error")
-
-@app.on_event("startup")
+# ------------- Startup-Report (nur Logs, via Lifespan) -------------
 def _startup_env_report():
     feats = {
         "llm": bool(settings.OPENROUTER_API_KEY),
@@ -128,22 +151,27 @@ def health():
     return {"ok": True, "version": "0.4.0"}
 
 
-# ---- kleiner Helper für Rate-Limit ----
-def _rate_limit_or_429(request: Request, user_id: Optional[str]):
-    key = user_id or (request.client.host if request.client else "anon")
-    ok, _lim, _used = check_allow(key)
-    if not ok:
-        raise HTTPException(status_code=429, detail="Zu viele Anfragen. Warte kurz.")
+# ---- Interne Metriken (Pool-Auslastung etc.; per CRON_SECRET geschützt) ----
+@app.get("/api/v1/metrics")
+def metrics(x_cron_secret: str | None = Header(default=None)):
+    if not settings.CRON_SECRET or x_cron_secret != settings.CRON_SECRET:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    return {
+        "supabase_pool": supa.pool_stats(),
+        "auth": auth_stats(),
+        "prompt_cache_lru": prompt_lru.stats(),
+        "singleflight": flights.stats(),
+        "write_behind": write_behind.stats(),
+        "llm_models": llm_router.stats(),
+        "llm_gate": llm_gate.stats(),
+        "ratelimit": ratelimit_stats(),
+        "state": state.stats(),
+    }
 
 
 # ---- Credits (mit Fallback 50) ----
 @app.get("/api/v1/credits")
-async def get_credits(authorization: str | None = Header(default=None)):
-    token = None
-    if authorization and authorization.lower().startswith("bearer "):
-        token = authorization.split(" ", 1)[1].strip()
-
-    user = get_user_from_token(token) if token else None
+async def get_credits(user: dict | None = Depends(optional_user)):
     if not user:
         return {
             "limit": 0, "used": 0, "remaining": 0,
@@ -152,20 +180,30 @@ async def get_credits(authorization: str | None = Header(default=None)):
         }
 
     user_id = user.get("id")
-    prof = get_profile(user_id) or {}
-
+    # dieselbe Sicht wie die Reservierung in /generate (Referral-Bonus, Plan, offene Reservierungen)
     try:
-        limit_raw = prof.get("monthly_credit_limit", 50)
-        limit = int(limit_raw or 50)
+        credit = await credit_status(user_id)
     except Exception:
-        limit = 50
-    if limit <= 0:
-        limit = 50
+        credit = {}
+    if "limit" in credit:
+        limit, used = int(credit.get("limit") or 0), int(credit.get("used") or 0)
+    else:
+        # RPC nicht erreichbar → wie bisher: Basislimit und geloggte Generierungen
+        prof, used = await asyncio.gather(
+            get_profile(user_id),
+            count_generates_this_month(user_id),
+            return_exceptions=True,
+        )
+        prof = prof if isinstance(prof, dict) else {}
+        used = used if isinstance(used, int) else 0
 
-    try:
-        used = count_generates_this_month(user_id)
-    except Exception:
-        used = 0
+        try:
+            limit_raw = prof.get("monthly_credit_limit", 50)
+            limit = int(limit_raw or 50)
+        except Exception:
+            limit = 50
+        if limit <= 0:
+            limit = 50
 
     remaining = max(0, limit - used)
     return {
@@ -178,6 +216,20 @@ async def get_credits(authorization: str | None = Header(default=None)):
     }
 
 
+def _local_output(typ: str, topic: str, niche: str, tone: str, voice=None) -> tuple[str, list[str]]:
+    """
+    Lokaler Fallback (gen.generate) → (Text, Varianten). ValueError bei unbekanntem Typ.
+    """
+    local = generate_local(typ, topic.strip(), niche.strip(), tone.strip(), voice)
+    # local kann {output} oder {variants} liefern
+    if isinstance(local, dict) and "output" in local:
+        text = str(local["output"]).strip()
+        return text, [text]
+    raw = local.get("variants") if isinstance(local, dict) else local
+    variants = [str(v).strip() for v in raw if str(v).strip()] if isinstance(raw, list) else []
+    return _choose_output_from_variants(raw), variants
+
+
 def _choose_output_from_variants(variants) -> str:
     """
     Nimmt die beste Variante (erste nicht-leere). Fallback: join mit newline.
@@ -198,157 +250,142 @@ async def api_generate(
     payload: GenerateIn,
     response: Response,
     request: Request,
-    authorization: str | None = Header(default=None),
     force: str | None = Query(default=None, description="Cache ignorieren (1/true/yes)"),
 ):
-    # Rate-limit (vor Auth)
-    _rate_limit_or_429(request, None)
-    response.headers["X-RateLimit-Limit"] = str(int(os.getenv("RATE_LIMIT_PER_MIN", "60")))
-
-    # --- Auth + Credits defensiv ---
-    user_id: Optional[str] = None
-    user = None
-    if authorization and authorization.lower().startswith("bearer "):
-        token = authorization.split(" ", 1)[1].strip()
-        try:
-            user = get_user_from_token(token) or {}
-            user_id = user.get("id")
-        except Exception:
-            user_id = None
-
-    # Optional: nach Bestimmung des Users strenger limitieren
-    if user_id:
-        _rate_limit_or_429(request, user_id)
-
-    # --- Credits vorberechnen (nur für Header/UX)
-    limit = 50
-    used = 0
-    if user_id:
-        try:
-            prof = get_profile(user_id) or {}
-            limit = int(prof.get("monthly_credit_limit") or 50)
-            if limit <= 0:
-                limit = 50
-            used = count_generates_this_month(user_id)
-        except Exception:
-            pass
-
-    # --- Brand-Voice defensiv ---
-    voice = None
-    if user_id:
-        try:
-            full = get_profile_full(user_id) or {}
-            voice = full.get("brand_voice") or {}
-            if isinstance(voice, dict) and voice.get("tone"):
-                payload.tone = (voice.get("tone") or payload.tone or "").strip()
-        except Exception:
-            voice = None
+    # --- Auth (lokal verifiziert, gecacht; meist schon von der Middleware aufgelöst) ---
+    user = await optional_user(request)
+    user_id: Optional[str] = (user or {}).get("id")
 
-    # --- Cache prüfen ---
+    # --- Kontext: Profil/Brand-Voice ‖ Credit-Reservierung ‖ Cache-Probe (parallel) ---
     force_bypass = str(force or "").lower() in ("1", "true", "yes")
-    cache_key = make_cache_key(user_id or "anon", payload.type, payload.model_dump())
-    if user_id and not force_bypass:
-        hit = await supa.cache_get_by_key(cache_key, user_id)
-        if hit:
-            # Cache-Hit zählt NICHT gegen Credits
-            await supa.log_usage(user_id, "generate_cache_hit", {"type": payload.type, "cache_key": cache_key})
-            response.headers["X-Cache"] = "HIT"
-            response.headers["X-Engine"] = hit.get("model") or "cache"
-            # Remaining bleibt unverändert
-            response.headers["X-RateLimit-Remaining"] = str(max(0, limit - used))
-            return JSONResponse(
-                {
-                    "generated_at": datetime.now(timezone.utc).isoformat(),
-                    "type": payload.type,
-                    "output": hit["output"],
-                    "engine": "cache",
-                    "cached": True,
-                }
-            )
+    ctx = await load_context(user_id, payload.type, payload.model_dump(), force_bypass=force_bypass, reserve=bool(user_id))
+    payload.tone = ctx.tone or payload.tone
+    voice = ctx.voice
+    cache_key = ctx.cache_key
+
+    # --- Cache-Hit ---
+    if ctx.hit:
+        hit = ctx.hit
+        # Cache-Hit zählt NICHT gegen Credits (Reservierung löst der usage_log-Eintrag auf)
+        if user_id:
+            write_behind.log_usage(user_id, "generate_cache_hit", {"type": payload.type, "cache_key": cache_key, **settle(ctx, counted=False)})
+        response.headers["X-Cache"] = "HIT"
+        response.headers["X-Engine"] = hit.get("model") or "cache"
+        # Remaining bleibt unverändert
+        response.headers["X-RateLimit-Remaining"] = str(ctx.remaining)
+        return {
+            "generated_at": datetime.now(timezone.utc).isoformat(),
+            "type": payload.type,
+            "output": hit["output"],
+            "variants": hit.get("variants") or [],
+            "engine": "cache",
+            "cached": True,
+        }
 
-    # --- Engine-Switch bestimmen ---
-    mode = (payload.engine or "auto").lower()
-    use_llm = (mode == "llm") or (mode == "auto" and bool(settings.OPENROUTER_API_KEY))
-    output_text: Optional[str] = None
-    engine_used = "local"
-    model_name = None
-    tokens_in = None
-    tokens_out = None
+    # --- Monatslimit erreicht (atomar geprüft, nichts reserviert) ---
+    if ctx.denied:
+        raise HTTPException(status_code=429, detail="Monthly credit limit reached", headers={"X-RateLimit-Remaining": "0"})
 
-    # --- LLM zuerst (wenn konfiguriert / erlaubt) ---
-    if use_llm:
-        try:
-            variants = call_openrouter_retry(
-                payload.type,
-                payload.topic.strip(),
-                payload.niche.strip(),
-                payload.tone.strip(),
-                voice,
-            )
-            output_text = _choose_output_from_variants(variants)
-            engine_used = "llm"
-            model_name = getattr(settings, "OPENROUTER_MODEL", None) or "llm"
-        except Exception:
-            # Silent fallthrough → local
-            output_text = None
+    # --- Generieren: identische Requests (gleicher cache_key) teilen sich einen Call ---
+    async def _produce() -> dict:
+        # --- Engine-Switch bestimmen ---
+        mode = (payload.engine or "auto").lower()
+        use_llm = (mode == "llm") or (mode == "auto" and bool(settings.OPENROUTER_API_KEY))
+        output_text: Optional[str] = None
+        variants: list[str] = []
+        engine_used = "local"
+        model_name = None
+        tokens_in = None
+        tokens_out = None
 
-    # --- Lokaler Fallback (kostenlos) ---
-    if output_text is None:
-        try:
-            local = generate_local(
-                payload.type,
-                payload.topic.strip(),
-                payload.niche.strip(),
-                payload.tone.strip(),
-                voice,
-            )
-            # local kann {output} oder {variants} liefern
-            if isinstance(local, dict) and "output" in local:
-                output_text = str(local["output"]).strip()
-            elif isinstance(local, dict) and "variants" in local:
-                output_text = _choose_output_from_variants(local["variants"])
-            else:
-                output_text = _choose_output_from_variants(local)
-            engine_used = "local"
-        except ValueError as e:
-            raise HTTPException(status_code=400, detail=str(e))
+        # --- LLM zuerst (wenn konfiguriert / erlaubt) ---
+        if use_llm:
+            try:
+                variants, usage = await call_openrouter_retry(
+                    payload.type,
+                    payload.topic.strip(),
+                    payload.niche.strip(),
+                    payload.tone.strip(),
+                    voice,
+                    lane=lane_for(ctx.plan),
+                )
+                # Brand-Voice auch auf LLM-Output (Tabuwörter/Emojis wie lokal)
+                vf = voice_filter(voice, hook=(payload.type == "hook"), llm=True)
+                variants = [vf.apply(v).strip() if isinstance(v, str) else v for v in variants]
+                output_text = _choose_output_from_variants(variants)
+                engine_used = "llm"
+                model_name = usage.get("model") or getattr(settings, "OPENROUTER_MODEL", None) or "llm"
+                tokens_in = usage.get("prompt_tokens") or None
+                tokens_out = usage.get("completion_tokens") or None
+            except Exception:
+                # Silent fallthrough → local
+                output_text = None
 
-    if not output_text:
-        raise HTTPException(status_code=500, detail="Generation failed")
+        # --- Lokaler Fallback (kostenlos) ---
+        if output_text is None:
+            try:
+                output_text, variants = _local_output(payload.type, payload.topic, payload.niche, payload.tone, voice)
+                engine_used = "local"
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
 
-    # --- Cache speichern (nur wenn User bekannt) ---
-    if user_id:
-        try:
-            await supa.cache_insert({
+        if not output_text:
+            raise HTTPException(status_code=500, detail="Generation failed")
+
+        # --- Cache speichern + Credits-Log NUR bei MISS (write-behind, blockiert nicht) ---
+        if user_id:
+            write_behind.cache_insert({
                 "cache_key": cache_key,
                 "user_id": user_id,
                 "type": payload.type,
                 "payload": normalize_payload(payload.model_dump()),
                 "output": output_text,
+                "variants": variants or None,
                 "model": model_name or engine_used,
                 "tokens_in": tokens_in,
                 "tokens_out": tokens_out,
             })
-        except Exception:
-            pass
+            tokens = {k: v for k, v in (("tokens_in", tokens_in), ("tokens_out", tokens_out)) if v}
+            write_behind.log_usage(user_id, "generate", {"type": payload.type, "cache_key": cache_key, **tokens, **settle(ctx)})
 
-        # Credits-Log NUR bei MISS
-        try:
-            await supa.log_usage(user_id, "generate", {"type": payload.type, "cache_key": cache_key})
-        except Exception:
-            pass
+        return {"output": output_text, "engine": engine_used, "variants": variants}
+
+    try:
+        result, joined = await flights.do(cache_key, _produce, fresh=force_bypass)
+    except BaseException:
+        # fehlgeschlagen oder Client weg (CancelledError) → Credit zurück. Läuft der Flight
+        # weiter, zählt er trotzdem über seinen usage_log-Eintrag; die Reservierung ist dann schon weg.
+        release(ctx)
+        raise
+    output_text, engine_used = result["output"], result["engine"]
+
+    # Joiner: kein eigener Upstream-Call → zählt wie ein Cache-Hit nicht gegen Credits
+    if joined:
+        if user_id:
+            write_behind.log_usage(user_id, "generate_cache_hit", {"type": payload.type, "cache_key": cache_key, "joined": True, **settle(ctx, counted=False)})
+        response.headers["X-Cache"] = "JOINED"
+        response.headers["X-Engine"] = engine_used
+        response.headers["X-RateLimit-Remaining"] = str(ctx.remaining)
+        return {
+            "generated_at": datetime.now(timezone.utc).isoformat(),
+            "type": payload.type,
+            "output": output_text,
+            "variants": result.get("variants") or [],
+            "engine": engine_used,
+            "cached": False,
+        }
 
     # --- Response-Header setzen ---
     response.headers["X-Cache"] = "MISS" if user_id and not force_bypass else ("BYPASS" if force_bypass else "MISS")
     response.headers["X-Engine"] = engine_used
-    # Remaining: bei MISS (mit User) theoretisch -1; wir zeigen konservativ die aktuelle Schätzung
-    remaining = max(0, (limit - used) - (1 if (user_id and not force_bypass) else 0))
-    response.headers["X-RateLimit-Remaining"] = str(remaining)
+    # Remaining: die Reservierung dieses Requests ist schon abgezogen
+    response.headers["X-RateLimit-Remaining"] = str(ctx.remaining)
 
     return {
         "generated_at": datetime.now(timezone.utc).isoformat(),
         "type": payload.type,
         "output": output_text,
+        "variants": result.get("variants") or [],
         "engine": engine_used,
         "cached": False if not force_bypass else False,
     }
@@ -357,121 +394,229 @@ async def api_generate(
 def _sse_pack(d: dict) -> bytes:
     return f"data: {json.dumps(d, ensure_ascii=False)}\n\n".encode("utf-8")
 
-@app.post("/api/v1/generate_stream")
-async def api_generate_stream(
-    payload: GenerateIn,
-    request: Request,
-    authorization: str | None = Header(default=None),
-    force: str | None = Query(default=None),
-):
-    _rate_limit_or_429(request, None)
 
-    user_id: Optional[str] = None
-    user = None
-    if authorization and authorization.lower().startswith("bearer "):
-        token = authorization.split(" ", 1)[1].strip()
-        try:
-            user = get_user_from_token(token) or {}
-            user_id = user.get("id")
-        except Exception:
-            user_id = None
-    if user_id:
-        _rate_limit_or_429(request, user_id)
+async def _client_gone(request: Request) -> None:
+    # endet, sobald der SSE-Client die Verbindung geschlossen hat
+    while not await request.is_disconnected():
+        await asyncio.sleep(settings.STREAM_DISCONNECT_POLL)
 
-    # Brand-Voice
-    voice = None
-    if user_id:
-        try:
-            full = get_profile_full(user_id) or {}
-            voice = full.get("brand_voice") or {}
-            if isinstance(voice, dict) and voice.get("tone"):
-                payload.tone = (voice.get("tone") or payload.tone or "").strip()
-        except Exception:
-            voice = None
 
-    force_bypass = str(force or "").lower() in ("1","true","yes")
-    cache_key = make_cache_key(user_id or "anon", payload.type, payload.model_dump())
+async def _ws_gone(websocket: WebSocket, inbox: list) -> None:
+    # endet bei websocket.disconnect; andere Nachrichten während eines Streams landen in inbox
+    while True:
+        msg = await websocket.receive()
+        if msg["type"] == "websocket.disconnect":
+            return
+        inbox.append(msg)
 
-    async def _gen():
-        yield _sse_pack({"status":"start","type":payload.type})
 
-        # Cache-Hit?
-        if user_id and not force_bypass:
-            try:
-                hit = await supa.cache_get_by_key(cache_key, user_id)
-            except Exception:
-                hit = None
-            if hit and hit.get("output"):
-                yield _sse_pack({"status":"chunk","text": hit["output"]})
-                yield _sse_pack({"status":"end","engine":"cache","cached":True})
-                return
+def _commit_stream(ctx: GenContext, text: str, variants: list, model: str, usage_meta: dict) -> None:
+    # Cache + Usage (write-behind, LRU sofort)
+    write_behind.cache_insert({
+        "cache_key": ctx.cache_key,
+        "user_id": ctx.user_id,
+        "type": ctx.typ,
+        "payload": normalize_payload(ctx.payload),
+        "output": text,
+        "variants": variants or None,
+        "model": model,
+        "tokens_in": usage_meta.get("tokens_in"),
+        "tokens_out": usage_meta.get("tokens_out"),
+    })
+    write_behind.log_usage(ctx.user_id, "generate", {"type": ctx.typ, "cache_key": ctx.cache_key, **usage_meta})
 
-        mode = (payload.engine or "auto").lower()
-        use_llm = (mode == "llm") or (mode == "auto" and bool(settings.OPENROUTER_API_KEY))
-        engine_used = "local"
-        model_name = getattr(settings, "OPENROUTER_MODEL", None) or "llm"
-        full_text = []
 
-        if use_llm:
-            # ECHTER TOKEN-STREAM
-            try:
-                async for token in stream_openrouter(
-                    payload.type,
-                    payload.topic.strip(),
-                    payload.niche.strip(),
-                    payload.tone.strip(),
-                    voice,
-                ):
-                    full_text.append(token)
-                    yield _sse_pack({"status":"chunk","text": token})
-                engine_used = "llm"
-            except Exception as e:
-                yield _sse_pack({"status":"warn","message": f'LLM stream failed, fallback to local: {str(e)[:120]}...'})
+def _token_meta(llm_meta: dict) -> dict:
+    # Token-Zahlen aus OpenRouter usage → usage_log.meta (Trigger summiert sie in usage_counters)
+    usage = llm_meta.get("usage") or {}
+    out = {"tokens_in": usage.get("prompt_tokens"), "tokens_out": usage.get("completion_tokens")}
+    return {k: int(v) for k, v in out.items() if v}
 
-        if not full_text:
-            # Fallback: lokal (ein Block)
-            try:
-                local = generate_local(
-                    payload.type,
-                    payload.topic.strip(),
-                    payload.niche.strip(),
-                    payload.tone.strip(),
-                    voice,
-                )
-                txt = ""
-                if isinstance(local, dict) and "output" in local:
-                    txt = str(local["output"]).strip()
-                elif isinstance(local, dict) and "variants" in local:
-                    txt = _choose_output_from_variants(local["variants"])
+
+def _variant_events(parser: VariantParser, new: list) -> list[dict]:
+    start = len(parser.variants) - len(new)
+    return [{"status":"variant","index":start + i,"text":v} for i, v in enumerate(new)]
+
+
+async def _charge_stream_tokens(ctx: GenContext, llm_meta: dict, text: str) -> None:
+    # Streams zahlen ihre Completion-Tokens nachträglich ins Budget (ohne usage: ~4 Zeichen/Token)
+    if not ctx.rate_key:
+        return
+    tokens = (llm_meta.get("usage") or {}).get("completion_tokens") or len(text) // 4
+    try:
+        await charge_tokens(ctx.rate_key, ctx.rate_plan or ctx.plan, int(tokens))
+    except Exception as e:
+        logger.warning("[ratelimit] token charge failed: %s", e)
+
+
+async def _produce_stream(ctx: GenContext, engine: str, usage_meta: dict, flight):
+    """
+    Pump eines StreamFlights: LLM-Tokens | lokaler Fallback → Cache/Usage → end.
+    Läuft als eigener Task (singleflight), alle Subscriber lesen denselben Puffer.
+    Wird er abgebrochen (letzter Client weg), endet der Upstream-Stream sofort; bereits
+    bezahlte Tokens werden mit cancelled/partial_cached geloggt.
+    """
+    p = ctx.payload
+    typ, user_id, cache_key, voice = ctx.typ, ctx.user_id, ctx.cache_key, ctx.voice
+    topic, niche, tone = (p.get("topic") or "").strip(), (p.get("niche") or "").strip(), ctx.tone
+
+    mode = (engine or "auto").lower()
+    use_llm = (mode == "llm") or (mode == "auto" and bool(settings.OPENROUTER_API_KEY))
+    engine_used = "local"
+    llm_meta: dict = {}
+    llm_failed = False
+    full_text = []
+    # Brand-Voice als Stream-Stufe: Chunks gefiltert, Parser sieht den Rohtext (JSON bleibt parsebar)
+    vf = voice_filter(voice, hook=(typ == "hook"), llm=True)
+    sf = vf.stream()
+    parser = VariantParser(clean=lambda v: vf.apply(v).strip())  # Varianten schon während des Streams als "variant"-Events
+
+    if use_llm:
+        # ECHTER TOKEN-STREAM (Modell-Routing in stream_openrouter)
+        try:
+            async for token in stream_openrouter(typ, topic, niche, tone, voice, meta=llm_meta, lane=lane_for(ctx.plan)):
+                text = sf.feed(token)
+                if text:
+                    full_text.append(text)
+                    yield {"status":"chunk","text": text}
+                for ev in _variant_events(parser, parser.feed(token)):
+                    yield ev
+            tail = sf.close()
+            if tail:
+                full_text.append(tail)
+                yield {"status":"chunk","text": tail}
+            for ev in _variant_events(parser, parser.close()):
+                yield ev
+            engine_used = "llm"
+        except asyncio.CancelledError:
+            partial = ("".join(full_text) + sf.close()).strip()
+            if user_id and partial:
+                # Teilergebnis nur auf Wunsch cachen – sonst bekäme der nächste Request einen abgeschnittenen Text
+                cache_partial = settings.STREAM_CACHE_PARTIAL.lower() == "on"
+                meta = {**usage_meta, **_token_meta(llm_meta), "cancelled": True, "partial_cached": cache_partial}
+                if cache_partial:
+                    _commit_stream(ctx, partial, parser.variants, llm_meta.get("model") or settings.OPENROUTER_MODEL or "llm", meta)
                 else:
-                    txt = _choose_output_from_variants(local)
-                engine_used = "local"
-                full_text = [txt]
-                yield _sse_pack({"status":"chunk","text": txt})
-            except ValueError as e:
-                yield _sse_pack({"status":"error","message":str(e)})
-                return
+                    write_behind.log_usage(user_id, "generate", {"type": typ, "cache_key": cache_key, **meta})
+            await _charge_stream_tokens(ctx, llm_meta, partial)  # bezahlte Tokens zählen auch bei Abbruch
+            raise
+        except Exception as e:
+            # Abbruch mitten im Stream: bezahlte Tokens buchen, abgeschnittenen Text verwerfen
+            # (nie als "local" cachen) und vollständig lokal ausliefern; reset → Client verwirft Chunks
+            partial = ("".join(full_text) + sf.close()).strip()
+            await _charge_stream_tokens(ctx, llm_meta, partial)
+            yield {"status":"warn","message": f'LLM stream failed, fallback to local: {str(e)[:120]}...', "reset": bool(full_text)}
+            full_text = []
+            parser = VariantParser(clean=lambda v: vf.apply(v).strip())
+            llm_failed = True
+
+    if not full_text:
+        # Fallback: lokal (ein Block)
+        try:
+            txt, local_variants = _local_output(typ, topic, niche, tone, voice)
+            engine_used = "local"
+            full_text = [txt]
+            parser.variants = local_variants
+            yield {"status":"chunk","text": txt}
+            for i, v in enumerate(local_variants):
+                yield {"status":"variant","index":i,"text":v}
+        except ValueError as e:
+            yield {"status":"error","message":str(e)}
+            return
 
-        final_text = "".join(full_text).strip()
+    final_text = "".join(full_text).strip()
+    if engine_used == "llm":
+        await _charge_stream_tokens(ctx, llm_meta, final_text)
 
-        # Cache + Usage (nur wenn user_id)
-        if user_id and final_text:
-            try:
-                await supa.cache_insert({
-                    "cache_key": cache_key,
-                    "user_id": user_id,
-                    "type": payload.type,
-                    "payload": normalize_payload(payload.model_dump()),
-                    "output": final_text,
-                    "model": model_name if engine_used=="llm" else "local",
-                    "tokens_in": None,
-                    "tokens_out": None,
-                })
-                await supa.log_usage(user_id, "generate", {"type": payload.type, "cache_key": cache_key, "stream": True})
-            except Exception:
-                pass
+    # Cache + Usage (nur wenn user_id) – write-behind, LRU sofort. Der Puffer bleibt
+    # bis hierhin registriert, danach übernimmt der prompt_cache.
+    if user_id and final_text:
+        model = (llm_meta.get("model") or settings.OPENROUTER_MODEL or "llm") if engine_used=="llm" else "local"
+        meta = {**usage_meta, **_token_meta(llm_meta)}
+        if llm_failed:
+            meta["llm_failed"] = True
+        _commit_stream(ctx, final_text, parser.variants, model, meta)
 
-        yield _sse_pack({"status":"end","engine":engine_used,"cached":False})
+    flight.resolve({"output": final_text, "engine": engine_used, "variants": parser.variants})
+    yield {"status":"end","engine":engine_used,"cached":False}
+
+
+async def _stream_events(ctx: GenContext, engine: str, usage_meta: dict):
+    """
+    Gemeinsame Event-Pipeline für SSE (/generate_stream) und WebSocket (/ws/generate):
+    start → (Cache-Hit | Join | Live-Stream) → end.
+    Liefert Event-Dicts; der Transport packt sie nur noch ein.
+    """
+    typ, user_id, cache_key = ctx.typ, ctx.user_id, ctx.cache_key
+
+    yield {"status":"start","type":typ}
+
+    # Cache-Hit?
+    hit = ctx.hit
+    if hit and hit.get("output"):
+        yield {"status":"chunk","text": hit["output"]}
+        for i, v in enumerate(hit.get("variants") or []):
+            yield {"status":"variant","index":i,"text":v}
+        yield {"status":"end","engine":"cache","cached":True}
+        return
+
+    # Identische Nicht-Stream-Generierung läuft schon? → Ergebnis teilen
+    flight = flights.get(cache_key)
+    if flight is not None and not isinstance(flight, StreamFlight):
+        ok, result = await flights.join(flight)
+        if ok:
+            if user_id:
+                write_behind.log_usage(user_id, "generate_cache_hit", {"type": typ, "cache_key": cache_key, "joined": True, **usage_meta})
+            yield {"status":"chunk","text": result["output"]}
+            for i, v in enumerate(result.get("variants") or []):
+                yield {"status":"variant","index":i,"text":v}
+            yield {"status":"end","engine":result["engine"],"cached":False,"joined":True}
+            return
+
+    # Live-Stream: neu starten oder an laufenden anhängen (Replay + live)
+    flight, joined = flights.stream(cache_key, lambda f: _produce_stream(ctx, engine, usage_meta, f))
+    async for ev in flight.subscribe():
+        if ev.get("status") == "end":
+            if joined:
+                if user_id:
+                    write_behind.log_usage(user_id, "generate_cache_hit", {"type": typ, "cache_key": cache_key, "joined": True, **usage_meta})
+                ev = {**ev, "joined": True}
+            yield ev
+            return
+        yield ev
+        if ev.get("status") == "error":
+            return
+
+@app.post("/api/v1/generate_stream")
+async def api_generate_stream(
+    payload: GenerateIn,
+    request: Request,
+    force: str | None = Query(default=None),
+):
+    # Vorab-Kosten bucht die Middleware, die Completion-Tokens der Producer nach dem Stream
+    user = await optional_user(request)
+    user_id: Optional[str] = (user or {}).get("id")
+
+    # Kontext (Brand-Voice ‖ Cache-Probe)
+    force_bypass = str(force or "").lower() in ("1","true","yes")
+    ctx = await load_context(user_id, payload.type, payload.model_dump(), force_bypass=force_bypass, with_usage=False)
+    # Token-Kosten in den Bucket, den die Middleware vorab belastet hat (auch anon/IP)
+    rate = getattr(request.state, "rate", None)
+    if rate:
+        ctx.rate_key, ctx.rate_plan = rate
+    else:
+        ctx.rate_key = user_id or (request.client.host if request.client else "anon")
+        ctx.rate_plan = ctx.plan if user_id else "anon"
+
+    async def _gen():
+        # Disconnect-Watcher: Client weg → Subscriber abmelden → ggf. Upstream abbrechen
+        gone = asyncio.ensure_future(_client_gone(request))
+        try:
+            async with aclosing(coalesce(_stream_events(ctx, payload.engine, {"stream": True}), until=gone)) as events:
+                async for ev in events:
+                    yield _sse_pack(ev)
+        finally:
+            gone.cancel()
 
     return StreamingResponse(
         _gen(),
@@ -488,7 +633,7 @@ async def api_generate_stream(
 
 # ---- GET-Fallback (debug; KEINE Credits) + Rate-Limit ----
 @app.get("/api/v1/generate_simple")
-def api_generate_simple(
+async def api_generate_simple(
     type: str = Query(..., pattern="^(hook|script|caption|hashtags)$"),
     topic: str = Query(..., min_length=2),
     niche: str = Query("allgemein"),
@@ -497,9 +642,8 @@ def api_generate_simple(
     request: Request = None,     # wird von FastAPI injiziert
 ):
     # Hinweis: FastAPI injiziert Response/Request auch mit Default-Werten.
-    _rate_limit_or_429(request, None)
+    # Rate-Limit: Middleware (route_cost)
     if response is not None:
-        response.headers["X-RateLimit-Limit"] = str(int(os.getenv("RATE_LIMIT_PER_MIN", "60")))
         response.headers["X-Engine"] = "local"
         response.headers["X-Cache"] = "DISABLED"
     try:
@@ -525,12 +669,12 @@ def planner_remind(request: Request, x_cron_secret: str | None = Header(default=
 
     # NEU: wenn Mail nicht konfiguriert, freundlich abbrechen
     if not (settings.MAILGUN_API_KEY and settings.MAILGUN_DOMAIN):
-        slots = get_upcoming_slots(hours_ahead=26)
+        slots = get_upcoming_slots_sync(hours_ahead=26)
         # kein sent, aber ok
         return {"ok": True, "sent": 0, "checked": int(len(slots)), "mail": "disabled"}
 
     # Ladet Slots der nächsten ~24-26h
-    slots = get_upcoming_slots(hours_ahead=26)
+    slots = get_upcoming_slots_sync(hours_ahead=26)
     sent = 0
     for s in slots:
         email = (s.get("users_public") or {}).get("email")
@@ -548,7 +692,7 @@ def planner_remind(request: Request, x_cron_secret: str | None = Header(default=
         )
         try:
             send_mail(email, subject, text)
-            mark_reminded(int(s["id"]))
+            mark_reminded_sync(int(s["id"]))
             sent += 1
         except Exception:
             # weicher Fehler: skip
@@ -560,17 +704,6 @@ def planner_remind(request: Request, x_cron_secret: str | None = Header(default=
 # ---------------- Lokaler APIRouter (Templates + ICS) ----------------
 router = APIRouter()
 
-async def _uid_from_request(request: Request) -> str:
-    auth = request.headers.get("Authorization", "")
-    if not auth.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Unauthorized")
-    token = auth.split(" ", 1)[1]
-    user = await supa.get_user_from_token(token)
-    uid = user.get("id")
-    if not uid:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-    return uid
-
 
 @router.get("/api/v1/templates")
 async def list_templates(
@@ -579,14 +712,14 @@ async def list_templates(
     typ: Optional[str] = Query(None, regex="^(hook|script|caption)$"),
     limit: int = Query(100, ge=1, le=200),
 ):
-    uid = await _uid_from_request(request)
+    uid = await current_uid(request)
     items = await supa.templates_list(uid, search=search, typ=typ, limit=limit)
     return {"items": items}
 
 
 @router.post("/api/v1/templates")
 async def create_template(request: Request):
-    uid = await _uid_from_request(request)
+    uid = await current_uid(request)
     body = await request.json()
     name = (body.get("name") or "").strip()
     typ  = body.get("type")
@@ -604,7 +737,7 @@ async def create_template(request: Request):
 
 @router.patch("/api/v1/templates/{id}")
 async def update_template(id: int = Path(...), request: Request = None):
-    uid = await _uid_from_request(request)
+    uid = await current_uid(request)
     patch = await request.json()
     # nur erlaubte Felder
     patch = {k: v for k, v in patch.items() if k in ("name","type","prompt")}
@@ -619,7 +752,7 @@ async def update_template(id: int = Path(...), request: Request = None):
 
 @router.delete("/api/v1/templates/{id}")
 async def delete_template(id: int = Path(...), request: Request = None):
-    uid = await _uid_from_request(request)
+    uid = await current_uid(request)
     try:
         await supa.templates_delete(id, uid)
         return {"ok": True}
@@ -649,7 +782,7 @@ async def planner_ical(
     days: int = Query(30, ge=1, le=180),
     filename: str = Query("creatorai_planner.ics")
 ):
-    uid = await _uid_from_request(request)
+    uid = await current_uid(request)
     now = datetime.now(timezone.utc)
     until = now + timedelta(days=days)
 
@@ -716,21 +849,21 @@ app.include_router(router)
 async def ws_generate(websocket: WebSocket):
     # Token aus Query lesen
     token = websocket.query_params.get("token", "")
-    uid = None
-    if token:
-        try:
-            user = await supa.get_user_from_token(token)
-            uid = user.get("id")
-        except Exception:
-            uid = None
+    user = await user_from_token(token)
+    uid = (user or {}).get("id")
     if not uid:
         await websocket.close(code=4401)  # Unauthorized
         return
 
     await websocket.accept()
+    inbox: list = []  # während eines Streams empfangene Nachrichten (siehe _ws_gone)
     try:
         while True:
-            raw = await websocket.receive_text()
+            if inbox:
+                msg = inbox.pop(0)
+                raw = msg.get("text") or (msg.get("bytes") or b"").decode("utf-8", "ignore")
+            else:
+                raw = await websocket.receive_text()
             try:
                 data = json.loads(raw)
             except Exception:
@@ -751,89 +884,38 @@ async def ws_generate(websocket: WebSocket):
                 await websocket.send_text(json.dumps({"status":"error","message":"Bad params"}))
                 continue
 
-            # Rate limit (pro User)
+            # Rate limit (pro User, Budget des Plans; Completion-Tokens bucht der Producer nach)
+            rate_plan = plan_hint(uid)
             try:
-                ok, _, _ = check_allow(uid)
-                if not ok:
-                    await websocket.send_text(json.dumps({"status":"error","message":"Rate limit"}))
+                d = await charge(uid, rate_plan, route_cost("/ws/generate"))
+                if not d.allowed:
+                    await websocket.send_text(json.dumps({"status":"error","message":"Rate limit","retry_after":round(d.retry_after, 1)}))
                     continue
             except Exception:
                 pass
 
-            # Brand-Voice
-            voice = None
-            try:
-                full = get_profile_full(uid) or {}
-                voice = full.get("brand_voice") or {}
-            except Exception:
-                pass
-
-            await websocket.send_text(json.dumps({"status":"start","type":typ}))
-
-            force_bypass = False
-            cache_key = make_cache_key(uid, typ, {"type":typ,"topic":topic,"niche":niche,"tone":tone,"engine":engine})
-            try:
-                hit = await supa.cache_get_by_key(cache_key, uid)
-            except Exception:
-                hit = None
-            if hit and hit.get("output") and not force_bypass:
-                await websocket.send_text(json.dumps({"status":"chunk","text":hit["output"]}))
-                await websocket.send_text(json.dumps({"status":"end","engine":"cache","cached":True}))
-                continue
-
-            use_llm = (engine == "llm") or (engine == "auto" and bool(settings.OPENROUTER_API_KEY))
-            engine_used = "local"
-            model_name = getattr(settings, "OPENROUTER_MODEL", None) or "llm"
-            full_text_parts = []
-
-            if use_llm:
-                try:
-                    async for token in stream_openrouter(typ, topic, niche, tone, voice):
-                        full_text_parts.append(token)
-                        await websocket.send_text(json.dumps({"status":"chunk","text":token}))
-                    engine_used = "llm"
-                except Exception as e:
-                    await websocket.send_text(json.dumps({"status":"warn","message": f"LLM stream failed: {str(e)[:120]}..."}))
-
-            if not full_text_parts:
-                try:
-                    local = generate_local(typ, topic, niche, tone, voice)
-                    if isinstance(local, dict) and "output" in local:
-                        txt = str(local["output"]).strip()
-                    elif isinstance(local, dict) and "variants" in local:
-                        txt = _choose_output_from_variants(local["variants"])
-                    else:
-                        txt = _choose_output_from_variants(local)
-                    engine_used = "local"
-                    full_text_parts = [txt]
-                    await websocket.send_text(json.dumps({"status":"chunk","text":txt}))
-                except Exception as e:
-                    await websocket.send_text(json.dumps({"status":"error","message":str(e)}))
-                    continue
-
-            final_text = "".join(full_text_parts).strip()
+            # Kontext (Brand-Voice ‖ Cache-Probe)
+            ctx = await load_context(
+                uid, typ, {"type":typ,"topic":topic,"niche":niche,"tone":tone,"engine":engine},
+                with_usage=False,
+            )
+            ctx.rate_key, ctx.rate_plan = uid, rate_plan
+            gone = asyncio.ensure_future(_ws_gone(websocket, inbox))
             try:
-                await supa.cache_insert({
-                    "cache_key": cache_key,
-                    "user_id": uid,
-                    "type": typ,
-                    "payload": normalize_payload({"type":typ,"topic":topic,"niche":niche,"tone":tone,"engine":engine}),
-                    "output": final_text,
-                    "model": model_name if engine_used=="llm" else "local",
-                    "tokens_in": None,
-                    "tokens_out": None,
-                })
-                await supa.log_usage(uid, "generate", {"type": typ, "cache_key": cache_key, "ws": True})
-            except Exception:
-                pass
-
-            await websocket.send_text(json.dumps({"status":"end","engine":engine_used,"cached":False}))
+                async with aclosing(coalesce(_stream_events(ctx, engine, {"ws": True}), until=gone)) as events:
+                    async for ev in events:
+                        await websocket.send_text(json.dumps(ev))
+            finally:
+                if not gone.done():
+                    gone.cancel()
+            if gone.done() and not gone.cancelled():
+                break  # Socket zu → Stream wurde bereits abgebrochen
     except WebSocketDisconnect:
         # Client hat getrennt: einfach beenden
         pass
 
     # ÄNDERUNG: app erstellen -> Middleware hinzufügen
-app.add_middleware(RateLimitMiddleware, per_sec=2, per_min=60)
+app.add_middleware(RateLimitMiddleware, per_sec=5)
 
 # ÄNDERUNG: Router mounten
 app.include_router(captcha_router)
@@ -1,43 +1,83 @@
 # NEU: einfache globale Rate-Limit Middleware (pro User-ID/IP)
-from starlette.middleware.base import BaseHTTPMiddleware
+# GCRA-Limiter (ratelimit.GCRALimiter): O(1) Zustand pro Key, inaktive Keys werden verworfen.
+# Zwei Stufen: Burst-Schutz pro Sekunde (Requests) und das kosten-gewichtete Budget
+# pro Minute (ratelimit.ROUTE_COSTS / PLAN_BUDGETS, Key = User-ID, sonst IP).
+# Reihenfolge: erst der Burst-Schutz (Token-Suffix/IP, ohne Auth), dann der User –
+# nur lokal verifiziert (kein Remote-/JWKS-Call pro Request, abgelehnte Tokens sind
+# gecacht). Gültige User landen für optional_user() auf request.state.
+# Reine ASGI-Middleware: liest nur Header und lehnt früh ab. Der Response-Body (auch
+# StreamingResponse/SSE) läuft unverändert durch; nur an http.response.start werden
+# die X-RateLimit-Header angehängt. Kein Task/Memory-Stream wie bei BaseHTTPMiddleware.
+from typing import Optional
+
+from starlette.datastructures import MutableHeaders
 from starlette.responses import JSONResponse
-from time import monotonic
-from collections import defaultdict, deque
-from typing import Deque, Tuple
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .auth import bearer_token, user_from_token
+from .ratelimit import GCRALimiter, charge, plan_hint, route_cost
+
+EXEMPT_SUFFIXES = ("/health", "/webhooks/stripe")
 
-class RateLimitMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app, per_sec=2, per_min=60):
-        super().__init__(app)
+class RateLimitMiddleware:
+    def __init__(self, app: ASGIApp, per_sec=5):
+        self.app = app
         self.per_sec = per_sec
-        self.per_min = per_min
-        self.hits_sec: dict[str, Deque[float]] = defaultdict(deque)
-        self.hits_min: dict[str, Deque[float]] = defaultdict(deque)
-
-    async def dispatch(self, request, call_next):
-        path = request.url.path
-        # Health/Webhooks/Cron ggf. ausnehmen
-        if path.endswith("/health") or path.endswith("/webhooks/stripe"):
-            return await call_next(request)
-
-        ident = "anon"
-        # User-ID aus Bearer (wird in main ohnehin verifiziert – hier nur zur Key-Bildung)
-        auth = request.headers.get("authorization", "")
-        if auth.startswith("Bearer "):
-            ident = auth[-20:]  # anonymisiert
-        else:
-            # Fallback IP
-            ident = request.client.host if request.client else "anon"
-
-        now = monotonic()
-        dq1 = self.hits_sec[ident]
-        dq2 = self.hits_min[ident]
-
-        # cleanup
-        while dq1 and now - dq1[0] > 1.0: dq1.popleft()
-        while dq2 and now - dq2[0] > 60.0: dq2.popleft()
-
-        if len(dq1) >= self.per_sec or len(dq2) >= self.per_min:
-            return JSONResponse({"detail":"Rate limit exceeded"}, status_code=429)
-
-        dq1.append(now); dq2.append(now)
-        return await call_next(request)
+        self.sec = GCRALimiter(per_sec, 1.0, name="mw_per_sec")
+
+    @staticmethod
+    def _burst_ident(scope: Scope) -> tuple[str, Optional[str], str]:
+        """→ (Burst-Key, Token, IP) – nur aus Headern, noch ohne Verifikation."""
+        client = scope.get("client")
+        ip = client[0] if client else "anon"
+        token = None
+        for name, value in scope.get("headers") or ():
+            if name == b"authorization":
+                token = bearer_token(value.decode("latin-1"))
+                break
+        return (token[-20:] if token else ip), token, ip
+
+    @staticmethod
+    async def _budget_ident(scope: Scope, token: Optional[str], ip: str) -> tuple[str, str]:
+        """→ (Budget-Key, Plan)."""
+        if not token:
+            return ip, "anon"
+        # nur lokal (bzw. aus dem Cache); nicht lokal prüfbare Tokens löst der Endpoint auf
+        user = await user_from_token(token, remote=False)
+        if not user or not user.get("id"):
+            return ip, "anon"
+        scope.setdefault("state", {})["user"] = user
+        return user["id"], plan_hint(user["id"])
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        # Health/Webhooks/Cron ggf. ausnehmen; WebSockets limitiert main selbst
+        if scope["type"] != "http" or scope["path"].endswith(EXEMPT_SUFFIXES):
+            await self.app(scope, receive, send)
+            return
+
+        burst_key, token, ip = self._burst_ident(scope)
+        d_sec = await self.sec.hit(burst_key)
+        if not d_sec.allowed:
+            await JSONResponse({"detail":"Rate limit exceeded"}, status_code=429, headers=d_sec.headers())(scope, receive, send)
+            return
+        key, plan = await self._budget_ident(scope, token, ip)
+        # Endpoints buchen nachträgliche Kosten (Stream-Tokens) in denselben Bucket
+        scope.setdefault("state", {})["rate"] = (key, plan)
+        d_budget = await charge(key, plan, route_cost(scope["path"]))
+        if not d_budget.allowed:
+            await self.sec.refund(burst_key)  # abgelehnt → Sekunden-Budget nicht verbrauchen
+            await JSONResponse({"detail":"Rate limit exceeded"}, status_code=429, headers=d_budget.headers())(scope, receive, send)
+            return
+
+        extra = d_budget.headers()
+
+        async def send_with_headers(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                # Endpoints, die eigene Werte setzen (z. B. Credits bei /generate), behalten diese
+                headers = MutableHeaders(scope=message)
+                for k, v in extra.items():
+                    if k not in headers:
+                        headers.append(k, v)
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
@@ -1,8 +1,9 @@
 # backend/app/planner_api.py
-from fastapi import APIRouter, HTTPException, Header, Request, Path, Query
-from typing import Optional, Dict, Any
+from fastapi import APIRouter, Depends, HTTPException, Request, Path, Query
+from typing import Dict, Any
 import os, requests
-from .supa import get_user_from_token, _get_sync, _post_sync, _delete_sync
+from .supa import _get_sync, _post_sync, _delete_sync
+from .auth import current_uid
 
 router = APIRouter(prefix="/api/v1/planner", tags=["planner"])
 
@@ -37,26 +38,13 @@ def _patch_sync(table: str, patch: dict, where: Dict[str, Any]) -> None:
     if r.status_code >= 400:
         raise RuntimeError(f"supabase PATCH {table} failed: {r.status_code} {r.text}")
 
-# ----------------- Auth helper -----------------
-
-def _require_uid(authorization: Optional[str]) -> str:
-    if not authorization or not authorization.lower().startswith("bearer "):
-        raise HTTPException(401, "auth")
-    token = authorization.split(" ", 1)[1].strip()
-    user = get_user_from_token(token)
-    uid = user.get("id")
-    if not uid:
-        raise HTTPException(401, "auth")
-    return uid
-
 # ----------------- Endpoints -----------------
 
 @router.get("/slots")
 def list_slots(
-    authorization: Optional[str] = Header(None),
+    uid: str = Depends(current_uid),
     limit: int = Query(200, ge=1, le=500),
 ):
-    uid = _require_uid(authorization)
     rows, _ = _get_sync("/rest/v1/planner_slots", {
         "select": "id,platform,scheduled_at,generation_id,note,reminder_sent,created_at",
         "user_id": f"eq.{uid}",
@@ -66,11 +54,10 @@ def list_slots(
     return {"items": rows or []}
 
 @router.post("/slots")
-def create_slot(payload: dict, authorization: Optional[str] = Header(None)):
+def create_slot(payload: dict, uid: str = Depends(current_uid)):
     """
     Body: { platform, scheduled_at (ISO), note?, generation_id? }
     """
-    uid = _require_uid(authorization)
     platform = (payload.get("platform") or "").lower()
     scheduled_at = payload.get("scheduled_at")
     if platform not in ("tiktok", "instagram", "youtube", "shorts", "reels", "other"):
@@ -93,12 +80,11 @@ def create_slot(payload: dict, authorization: Optional[str] = Header(None)):
 def update_slot(
     slot_id: int = Path(..., ge=1),
     payload: dict = None,
-    authorization: Optional[str] = Header(None),
+    uid: str = Depends(current_uid),
 ):
     """
     Erlaubte Felder: platform, scheduled_at, note, generation_id, reminder_sent
     """
-    uid = _require_uid(authorization)
     if not isinstance(payload, dict):
         payload = {}
 
@@ -112,8 +98,7 @@ def update_slot(
     return {"ok": True}
 
 @router.delete("/slots/{slot_id}")
-def delete_slot(slot_id: int = Path(..., ge=1), authorization: Optional[str] = Header(None)):
-    uid = _require_uid(authorization)
+def delete_slot(slot_id: int = Path(..., ge=1), uid: str = Depends(current_uid)):
     # Sicherheit: filter auf user_id + id
     _, status = _delete_sync("/rest/v1/planner_slots", {
         "id": f"eq.{slot_id}",
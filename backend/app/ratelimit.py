@@ -1,18 +1,185 @@
-import os, time
-from collections import deque, defaultdict
-from typing import Tuple
+import logging, os
+from collections import OrderedDict
+from math import floor
+from typing import Any, Dict, NamedTuple, Optional
+
+from .state import MemoryBackend, StateBackend, key as state_key, shared_backend
+
+# GCRA (Generic Cell Rate Algorithm): pro Key nur ein Float (TAT = "theoretical
+# arrival time") statt einer Deque aller Zeitstempel → O(1) Speicher und Zeit.
+# Keys, deren TAT vorbei ist, sind wieder "frisch" und werden verworfen; dazu
+# ein LRU-Deckel (RATE_LIMIT_MAX_KEYS), damit viele IPs den Speicher nicht sprengen.
+# Gespeichert wird über app.state (pro Worker oder geteilt, siehe STATE_BACKEND).
+
+logger = logging.getLogger("uvicorn.error")
 
 WINDOW = 60  # Sekunden
-LIMIT = int(os.getenv("RATE_LIMIT_PER_MIN", "60"))  # z.B. 60/min
-_buckets = defaultdict(deque)
-
-def check_allow(key: str) -> Tuple[bool, int, int]:
-    now = time.time()
-    q = _buckets[key]
-    # alte Einträge entfernen
-    while q and q[0] <= now - WINDOW:
-        q.popleft()
-    if len(q) >= LIMIT:
-        return False, LIMIT, len(q)
-    q.append(now)
-    return True, LIMIT, len(q)
+MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+
+
+class RateDecision(NamedTuple):
+    allowed: bool
+    limit: int
+    remaining: int
+    retry_after: float  # Sekunden bis der Request erlaubt wäre (0 wenn allowed)
+    reset_after: float  # Sekunden bis das Kontingent wieder voll ist
+
+    def headers(self) -> Dict[str, str]:
+        h = {"X-RateLimit-Limit": str(self.limit), "X-RateLimit-Remaining": str(self.remaining)}
+        if not self.allowed:
+            h["Retry-After"] = str(max(1, int(self.retry_after + 0.999)))
+        return h
+
+
+class GCRALimiter:
+    """
+    `limit` Requests pro `period` Sekunden, davon bis zu `burst` am Stück
+    (Default: burst = limit, also wie ein gleitendes Fenster).
+    Zustand im geteilten State-Backend (STATE_BACKEND=mmap|redis, dann gilt das Limit
+    über alle Worker) oder lokal pro Worker.
+    """
+
+    def __init__(self, limit: int, period: float, burst: Optional[int] = None, max_keys: int = MAX_KEYS,
+                 name: str = "", store: Optional[StateBackend] = None):
+        self.limit = max(1, int(limit))
+        self.period = float(period)
+        self.burst = max(1, int(burst if burst is not None else self.limit))
+        self.interval = self.period / self.limit        # T: Abstand pro Request
+        self.capacity = self.interval * self.burst      # τ + T
+        self.name = name or f"gcra{id(self)}"
+        self._local = MemoryBackend(max_keys)
+        self._store = store
+        self.allowed = 0
+        self.denied = 0
+        self.backend_errors = 0
+        if name:
+            _registry[name] = self
+
+    def _backend(self) -> StateBackend:
+        if self._store is None:
+            self._store = shared_backend("state") or self._local
+        return self._store
+
+    def _key(self, backend: StateBackend, key: str) -> str:
+        return state_key("rl", self.name, key) if backend.shared else key
+
+    def _remaining(self, tat: float, now: float) -> int:
+        return max(0, min(self.burst, floor((self.capacity - (tat - now)) / self.interval + 1e-9)))
+
+    async def hit(self, key: str, cost: int = 1, force: bool = False) -> RateDecision:
+        """force=True verbucht auch über dem Budget (nachträgliche Kosten, z. B. Stream-Tokens)."""
+        backend = self._backend()
+        try:
+            ok, tat, now = await backend.gcra(self._key(backend, key), self.interval, self.capacity, cost, force)
+        except Exception as e:
+            # geteiltes Backend nicht erreichbar → lokal weiterzählen (pro Worker statt gar nicht)
+            self.backend_errors += 1
+            logger.warning("[ratelimit] %s backend error: %s", self.name, e)
+            ok, tat, now = self._local.gcra_sync(key, self.interval, self.capacity, cost, force)
+        if not ok:
+            self.denied += 1
+            allow_at = tat + self.interval * cost - self.capacity
+            return RateDecision(False, self.limit, self._remaining(tat, now), allow_at - now, tat - now)
+        self.allowed += 1
+        return RateDecision(True, self.limit, self._remaining(tat, now), 0.0, tat - now)
+
+    async def refund(self, key: str, cost: int = 1) -> None:
+        """Hit zurücknehmen (z. B. wenn ein zweites Limit danach ablehnt)."""
+        backend = self._backend()
+        try:
+            await backend.refund(self._key(backend, key), self.interval * cost)
+        except Exception:
+            self.backend_errors += 1
+
+    def stats(self) -> Dict[str, Any]:
+        backend = self._backend()
+        return {
+            "limit": self.limit,
+            "period_s": self.period,
+            "backend": backend.name,
+            "local": self._local.stats(),
+            "allowed": self.allowed,
+            "denied": self.denied,
+            "backend_errors": self.backend_errors,
+        }
+
+
+_registry: Dict[str, GCRALimiter] = {}
+
+
+# ---------------------------------------------------------------------------
+# Kosten-gewichtete Budgets: jede Route kostet Einheiten, jeder Plan hat ein Budget
+# pro Minute (Key = User-ID, sonst Token-Suffix/IP). Listen/Profile kosten 1,
+# Generierungen deutlich mehr; Streams zahlen einen Vorab-Anteil und danach ihre
+# Completion-Tokens (charge_tokens). Unbekannte Pfade kosten DEFAULT_COST.
+# ---------------------------------------------------------------------------
+ROUTE_COSTS: Dict[str, int] = {
+    "/api/v1/generate": 10,
+    "/api/v1/generate_stream": 4,   # + Completion-Tokens nach dem Stream
+    "/ws/generate": 4,              # pro Nachricht, + Completion-Tokens
+    "/api/v1/generate_simple": 2,
+    "/api/v1/daily3": 2,            # kann 1x/Tag einen LLM-Call auslösen
+    "/api/v1/daily3/refresh": 10,
+    "/api/v1/export": 5,
+}
+DEFAULT_COST = 1
+TOKENS_PER_UNIT = int(os.getenv("RATE_TOKENS_PER_UNIT", "100"))
+PLAN_HINTS_MAX = 100000
+
+
+def _parse_budgets(raw: str) -> Dict[str, int]:
+    out: Dict[str, int] = {}
+    for part in raw.split(","):
+        plan, _, units = part.partition(":")
+        if plan.strip() and units.strip().isdigit():
+            out[plan.strip().lower()] = int(units)
+    return out
+
+
+# Einheiten pro Minute; "anon" = ohne Login
+PLAN_BUDGETS = _parse_budgets(os.getenv("RATE_PLAN_BUDGETS", "anon:60,free:300,pro:1200,team:3000"))
+_budgets: Dict[str, GCRALimiter] = {}
+_plan_hints: "OrderedDict[str, str]" = OrderedDict()
+
+
+def route_cost(path: str) -> int:
+    return ROUTE_COSTS.get(path.rstrip("/") or "/", DEFAULT_COST)
+
+
+def remember_plan(user_id: Optional[str], plan: Optional[str]) -> None:
+    """Plan aus dem Profil merken, damit die Middleware das richtige Budget wählt."""
+    if not user_id:
+        return
+    _plan_hints[user_id] = (plan or "free").lower()
+    _plan_hints.move_to_end(user_id)
+    while len(_plan_hints) > PLAN_HINTS_MAX:
+        _plan_hints.popitem(last=False)
+
+
+def plan_hint(user_id: str) -> str:
+    return _plan_hints.get(user_id, "free")
+
+
+def budget(plan: Optional[str]) -> GCRALimiter:
+    plan = (plan or "free").lower()
+    if plan not in PLAN_BUDGETS:
+        plan = "free"
+    lim = _budgets.get(plan)
+    if lim is None:
+        lim = _budgets[plan] = GCRALimiter(PLAN_BUDGETS[plan], WINDOW, name=f"budget_{plan}")
+    return lim
+
+
+async def charge(key: str, plan: Optional[str], cost: int) -> RateDecision:
+    return await budget(plan).hit(key, cost)
+
+
+async def charge_tokens(key: str, plan: Optional[str], completion_tokens: int) -> None:
+    """Nachträglich (Stream fertig): immer verbuchen, folgende Requests warten ggf."""
+    units = -(-max(0, completion_tokens) // TOKENS_PER_UNIT)
+    if key and units:
+        await budget(plan).hit(key, units, force=True)
+
+
+def stats() -> Dict[str, Any]:
+    return {name: lim.stats() for name, lim in _registry.items()}
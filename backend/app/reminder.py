@@ -5,22 +5,15 @@ from typing import List, Dict, Any
 
 from fastapi import APIRouter, HTTPException, Request, Query
 from . import supa
+from .auth import current_user
 
 router = APIRouter()
 
 # --- Helpers ---------------------------------------------------------------
 
 async def _uid_and_email_from_request(request: Request) -> tuple[str, str]:
-    auth = request.headers.get("authorization") or request.headers.get("Authorization") or ""
-    token = auth.replace("Bearer", "").strip()
-    if not token:
-        raise HTTPException(401, "missing bearer token")
-    user_info = await supa.get_user_from_token(token)
-    uid = (user_info.get("user") or {}).get("id") or user_info.get("id")
-    email = (user_info.get("user") or {}).get("email") or user_info.get("email") or ""
-    if not uid:
-        raise HTTPException(401, "invalid token")
-    return uid, email
+    user_info = await current_user(request)
+    return user_info["id"], user_info.get("email") or ""
 
 def _fmt_local(dt: datetime) -> str:
     return dt.strftime("%Y-%m-%d %H:%M UTC")
@@ -128,7 +121,7 @@ from .config import settings
 async def planner_remind_all(x_cron_secret: str | None = Header(None), hours: int = Query(24, ge=1, le=168)):
     if not settings.CRON_SECRET or (x_cron_secret != settings.CRON_SECRET):
         raise HTTPException(403, "forbidden")
-    rows = supa.get_upcoming_slots(hours_ahead=hours) or []
+    rows = await supa.get_upcoming_slots(hours_ahead=hours) or []
     grouped = {}
     for r in rows:
         uid = r.get("user_id")
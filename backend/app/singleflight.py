@@ -0,0 +1,276 @@
+# app/singleflight.py
+# Zweck: Single-Flight pro Worker. Gleichzeitige, identische Generierungen
+# (gleicher make_cache_key) teilen sich einen Upstream-Call und dessen Ergebnis.
+# Streams (StreamFlight) puffern ihre Events: späte Subscriber bekommen erst den
+# bisherigen Stand als Replay und hängen sich dann an den Live-Stream. Geht der
+# letzte Subscriber, wird der Pump-Task (und damit der Upstream-Stream) abgebrochen.
+# Mit geteiltem State (STATE_BACKEND=mmap|redis) gilt do() auch über Worker hinweg:
+# ein Lock pro Key (State-Backend), die anderen Worker warten auf das Ergebnis
+# (JSON im Cache-Backend, da größer als ein State-Slot; TTL nur fürs Abholen).
+# Streams bleiben pro Worker.
+
+from __future__ import annotations
+import asyncio
+import json
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from .config import settings
+from .state import StateBackend, key as state_key, shared_backend
+
+logger = logging.getLogger("uvicorn.error")
+
+RESULT_TTL = 1.5   # Sekunden, die ein Ergebnis für wartende Worker abholbar bleibt (kein Cache!)
+POLL_MAX = 0.25    # längstes Poll-Intervall der Wartenden, < RESULT_TTL
+_MISS = object()
+
+
+class Flight:
+    """Ein laufender Call; Joiner warten auf `future` (shielded)."""
+    __slots__ = ("key", "future", "joined")
+
+    def __init__(self, key: str):
+        self.key = key
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.joined = 0
+
+    async def wait(self) -> Any:
+        self.joined += 1
+        return await asyncio.shield(self.future)
+
+    def resolve(self, result: Any) -> None:
+        if not self.future.done():
+            self.future.set_result(result)
+
+    def fail(self, exc: BaseException) -> None:
+        if not self.future.done():
+            self.future.set_exception(exc)
+            self.future.exception()  # als abgerufen markieren, auch ohne Joiner
+
+
+class StreamFlight(Flight):
+    """
+    Broadcast-Puffer eines laufenden Streams. Ein Pump-Task schreibt Events
+    (publish), beliebig viele Subscriber lesen ab Index 0 mit.
+    """
+    __slots__ = ("events", "closed", "cancelled", "task", "subscribers", "_changed")
+
+    def __init__(self, key: str):
+        super().__init__(key)
+        self.events: List[Dict[str, Any]] = []
+        self.closed = False
+        self.cancelled = False
+        self.task: Optional[asyncio.Task] = None
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+
+    def publish(self, ev: Dict[str, Any]) -> None:
+        self.events.append(ev)
+        self._wake()
+
+    def close(self) -> None:
+        self.closed = True
+        self._wake()
+
+    def _wake(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def cancel(self) -> None:
+        if self.task is not None and not self.task.done():
+            self.cancelled = True
+            self.task.cancel()
+
+    async def subscribe(self) -> AsyncIterator[Dict[str, Any]]:
+        self.subscribers += 1
+        try:
+            i = 0
+            while True:
+                changed = self._changed
+                while i < len(self.events):
+                    yield self.events[i]
+                    i += 1
+                if self.closed:
+                    return
+                await changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers <= 0 and not self.closed:
+                self.cancel()  # niemand hört mehr zu → Upstream nicht weiter bezahlen
+
+
+class SingleFlight:
+    def __init__(self):
+        self._flights: Dict[str, Flight] = {}
+        self.leaders = 0
+        self.joins = 0
+        self.failed_joins = 0
+        self.cancelled = 0
+        self.remote_joins = 0
+        self.remote_errors = 0
+
+    def get(self, key: str) -> Optional[Flight]:
+        return self._flights.get(key)
+
+    def lead(self, key: str) -> Optional[Flight]:
+        """Registriert einen neuen Flight; None, wenn für den Key schon einer läuft."""
+        if key in self._flights:
+            return None
+        flight = Flight(key)
+        self._flights[key] = flight
+        self.leaders += 1
+        return flight
+
+    def land(self, flight: Flight) -> None:
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+        if not flight.future.done():
+            flight.fail(RuntimeError("flight aborted"))
+
+    async def join(self, flight: Flight) -> Tuple[bool, Any]:
+        """(ok, result) – ok=False, wenn der Leader scheiterte (Caller macht es dann selbst)."""
+        self.joins += 1
+        try:
+            return True, await flight.wait()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.failed_joins += 1
+            return False, None
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]], fresh: bool = False) -> Tuple[Any, bool]:
+        """
+        Führt fn() genau einmal pro Key gleichzeitig aus → (result, joined).
+        fn läuft als eigener Task: bricht der Leader-Request ab, bekommen die
+        Joiner trotzdem das Ergebnis. fresh=True (z. B. force=1): kein Ergebnis
+        eines anderen Workers übernehmen, nur laufende Calls im eigenen Worker teilen.
+        """
+        flight = self._flights.get(key)
+        if flight is not None:
+            ok, result = await self.join(flight)
+            if ok:
+                return result, True
+
+        backend = None if fresh else shared_backend("state")
+        owner = False
+        if backend is not None:
+            owner, result = await self._remote(backend, key)
+            if result is not _MISS:
+                self.remote_joins += 1
+                return result, True
+
+        flight = self.lead(key)
+        if flight is None:  # Race: inzwischen neuer Leader → direkt selbst ausführen
+            return await fn(), False
+        task = asyncio.ensure_future(self._run_owned(backend, key, fn) if owner else fn())
+
+        def _done(t: asyncio.Task) -> None:
+            if t.cancelled():
+                flight.fail(RuntimeError("flight cancelled"))
+            elif t.exception() is not None:
+                flight.fail(t.exception())
+            else:
+                flight.resolve(t.result())
+            self.land(flight)
+
+        task.add_done_callback(_done)
+        return await asyncio.shield(task), False
+
+    async def _remote(self, backend: StateBackend, key: str) -> Tuple[bool, Any]:
+        """
+        → (owner, result). owner=True: dieser Worker hält den Lock und rechnet.
+        Sonst wird gepollt, bis das Ergebnis da ist (result) oder der Lock weg ist /
+        SF_REMOTE_WAIT abläuft (→ _MISS, Caller rechnet selbst ohne Lock).
+        Ist der Lock weg, aber kein Ergebnis da (zu groß/nicht JSON-fähig/Fehler), rechnen
+        die Wartenden parallel statt nacheinander den Lock zu nehmen.
+        """
+        lock, res = state_key("sf", key), state_key("sfr", key)
+        results = shared_backend("cache") or backend
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + settings.SF_REMOTE_WAIT
+        delay = 0.05
+        try:
+            if await backend.add(lock, b"1", settings.SF_LOCK_TTL):
+                return True, _MISS
+            while True:
+                await asyncio.sleep(delay)
+                delay = min(POLL_MAX, delay * 1.5)
+                raw = await results.get(res)
+                if raw is not None:
+                    return False, json.loads(raw)
+                if await backend.get(lock) is None or loop.time() >= deadline:
+                    return False, _MISS
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.remote_errors += 1
+            logger.warning("[singleflight] shared state error: %s", e)
+            return False, _MISS
+
+    async def _run_owned(self, backend: StateBackend, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """fn() unter dem Worker-Lock; Ergebnis für wartende Worker ablegen, Lock freigeben."""
+        try:
+            result = await fn()
+            try:
+                raw = json.dumps(result, ensure_ascii=False).encode("utf-8")
+                await (shared_backend("cache") or backend).set(state_key("sfr", key), raw, RESULT_TTL)
+            except (TypeError, ValueError):
+                pass  # nicht JSON-fähig → Wartende rechnen nach Lock-Freigabe selbst
+            except Exception:
+                self.remote_errors += 1
+            return result
+        finally:
+            try:
+                await backend.delete(state_key("sf", key))
+            except Exception:
+                self.remote_errors += 1
+
+    def stream(
+        self,
+        key: str,
+        producer: Callable[[StreamFlight], AsyncIterator[Dict[str, Any]]],
+    ) -> Tuple[StreamFlight, bool]:
+        """
+        Liefert (flight, joined). Läuft für den Key schon ein Stream, wird er geteilt;
+        sonst startet ein Pump-Task, der producer(flight) in den Puffer schreibt.
+        Der Puffer bleibt registriert, bis der Producer fertig ist (inkl. Cache-Commit).
+        """
+        flight = self._flights.get(key)
+        if isinstance(flight, StreamFlight) and not flight.cancelled:
+            self.joins += 1
+            return flight, True
+        flight = StreamFlight(key)
+        self._flights[key] = flight
+        self.leaders += 1
+        flight.task = asyncio.ensure_future(self._pump(flight, producer))
+        return flight, False
+
+    async def _pump(self, flight: StreamFlight, producer: Callable[[StreamFlight], AsyncIterator[Dict[str, Any]]]) -> None:
+        try:
+            async for ev in producer(flight):
+                flight.publish(ev)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            flight.publish({"status": "error", "message": "cancelled"})
+        except Exception as e:
+            logger.warning("[singleflight] stream producer failed: %s", e)
+            flight.publish({"status": "error", "message": str(e)[:200]})
+            flight.fail(e)
+        finally:
+            flight.close()
+            self.land(flight)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._flights),
+            "streams": sum(1 for f in self._flights.values() if isinstance(f, StreamFlight)),
+            "leaders": self.leaders,
+            "joins": self.joins,
+            "failed_joins": self.failed_joins,
+            "cancelled_streams": self.cancelled,
+            "remote_joins": self.remote_joins,
+            "remote_errors": self.remote_errors,
+        }
+
+
+flights = SingleFlight()
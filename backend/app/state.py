@@ -0,0 +1,508 @@
+# app/state.py
+# Zweck: Austauschbares State-Backend für Rate-Limits (GCRA), die geteilte Cache-Stufe
+# vor prompt_cache und Single-Flight-Locks. STATE_BACKEND:
+#   memory – pro Worker (Default, bisheriges Verhalten)
+#   mmap   – Hash-Tabelle in einer Datei unter STATE_MMAP_DIR (/dev/shm), geteilt von
+#            allen Workern eines Hosts; Zugriffe per flock serialisiert (Mikrosekunden)
+#   redis  – RESP über TCP (REDIS_URL), auch hostübergreifend; GCRA atomar per Lua
+# Alle Zeiten in Sekunden. memory nutzt monotonic, die geteilten Backends Wall-Clock.
+
+from __future__ import annotations
+import asyncio
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from .config import settings
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class StateBackend:
+    """Gemeinsame Schnittstelle. gcra() → (allowed, tat, now); tat ist nach Erfolg der neue Wert."""
+    name = "base"
+    shared = False
+
+    def now(self) -> float:
+        return time.time()
+
+    async def gcra(self, key: str, interval: float, capacity: float, cost: int = 1,
+                   force: bool = False) -> Tuple[bool, float, float]:
+        """force=True: immer verbuchen (nachträgliche Kosten), TAT darf über das Budget laufen."""
+        raise NotImplementedError
+
+    async def refund(self, key: str, amount: float) -> None:
+        raise NotImplementedError
+
+    async def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: bytes, ttl: float) -> bool:
+        raise NotImplementedError
+
+    async def add(self, key: str, value: bytes, ttl: float) -> bool:
+        """Nur setzen, wenn der Key fehlt/abgelaufen ist (Lock). True = gesetzt."""
+        raise NotImplementedError
+
+    async def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.name}
+
+
+def _gcra_step(tat: Optional[float], now: float, interval: float, capacity: float, cost: int,
+               force: bool = False) -> Tuple[bool, float]:
+    tat = max(tat if tat is not None else now, now)
+    new_tat = tat + interval * cost
+    if new_tat - capacity > now and not force:
+        return False, tat
+    return True, new_tat
+
+
+# ---------------------------------------------------------------------------
+# memory: OrderedDict key -> (expires, value); GCRA-Einträge: expires = TAT
+# ---------------------------------------------------------------------------
+EVICT_SCAN = 4  # pro Schreibzugriff so viele alte Keys prüfen (amortisiertes Aufräumen)
+
+
+class MemoryBackend(StateBackend):
+    name = "memory"
+
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max(1, max_keys)
+        self._data: "OrderedDict[str, Tuple[float, Optional[bytes]]]" = OrderedDict()
+        self.evicted = 0
+
+    def now(self) -> float:
+        return time.monotonic()
+
+    def _live(self, key: str, now: float) -> Optional[Tuple[float, Optional[bytes]]]:
+        item = self._data.get(key)
+        if item is not None and item[0] <= now:
+            del self._data[key]
+            return None
+        return item
+
+    def _put(self, key: str, expires: float, value: Optional[bytes], now: float) -> None:
+        od = self._data
+        od[key] = (expires, value)
+        od.move_to_end(key)
+        while len(od) > self.max_keys:
+            od.popitem(last=False)
+            self.evicted += 1
+        # älteste Keys: abgelaufen (bei GCRA: TAT vorbei = Zustand frisch) → weg
+        for _ in range(EVICT_SCAN):
+            if not od:
+                break
+            k, (exp, _v) = next(iter(od.items()))
+            if exp > now:
+                break
+            del od[k]
+            self.evicted += 1
+
+    def gcra_sync(self, key: str, interval: float, capacity: float, cost: int = 1,
+                  force: bool = False) -> Tuple[bool, float, float]:
+        now = time.monotonic()
+        item = self._data.get(key)
+        ok, tat = _gcra_step(item[0] if item else None, now, interval, capacity, cost, force)
+        if ok:
+            self._put(key, tat, None, now)
+        return ok, tat, now
+
+    async def gcra(self, key: str, interval: float, capacity: float, cost: int = 1,
+                   force: bool = False) -> Tuple[bool, float, float]:
+        return self.gcra_sync(key, interval, capacity, cost, force)
+
+    async def refund(self, key: str, amount: float) -> None:
+        item = self._data.get(key)
+        if item is not None:
+            self._data[key] = (item[0] - amount, item[1])
+
+    async def get(self, key: str) -> Optional[bytes]:
+        item = self._live(key, time.monotonic())
+        return item[1] if item else None
+
+    async def set(self, key: str, value: bytes, ttl: float) -> bool:
+        now = time.monotonic()
+        self._put(key, now + ttl, value, now)
+        return True
+
+    async def add(self, key: str, value: bytes, ttl: float) -> bool:
+        now = time.monotonic()
+        if self._live(key, now) is not None:
+            return False
+        self._put(key, now + ttl, value, now)
+        return True
+
+    async def delete(self, key: str) -> None:
+        self._data.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.name, "keys": len(self._data), "evicted": self.evicted}
+
+
+# ---------------------------------------------------------------------------
+# mmap: feste Slots (open addressing, PROBE Slots pro Key) in einer geteilten Datei.
+# Slot = hash u64 | expires f64 | num f64 | vlen u16 | value[value_max]
+# Voll → der Slot mit dem frühesten Ablauf im Probe-Fenster wird überschrieben.
+# ---------------------------------------------------------------------------
+_MAGIC = b"CAIST001"
+_HEAD = struct.Struct("<8sII")        # magic, slots, value_max
+_SLOT = struct.Struct("<QddH")
+PROBE = 8
+
+
+class MmapBackend(StateBackend):
+    name = "mmap"
+    shared = True
+
+    def __init__(self, path: str, slots: int, value_max: int):
+        self.path = path
+        self.slots = max(PROBE, slots)
+        self.value_max = max(0, value_max)
+        self.slot_size = _SLOT.size + self.value_max
+        size = _HEAD.size + self.slots * self.slot_size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        with self._locked():
+            head = os.pread(self._fd, _HEAD.size, 0)
+            ok = len(head) == _HEAD.size and _HEAD.unpack(head) == (_MAGIC, self.slots, self.value_max)
+            if not ok or os.fstat(self._fd).st_size != size:
+                # neu oder andere Geometrie → frisch anlegen (State ist flüchtig)
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, _HEAD.pack(_MAGIC, self.slots, self.value_max), 0)
+        self._mm = mmap.mmap(self._fd, size)
+        self.overwrites = 0
+        self.too_large = 0
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        # flock: serialisiert alle Prozesse, die dieselbe Datei nutzen
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little") | 1
+
+    def _off(self, i: int) -> int:
+        return _HEAD.size + i * self.slot_size
+
+    def _find(self, key: str, now: float) -> Tuple[int, Optional[int]]:
+        """→ (Slot-Offset zum Schreiben, Offset des lebenden Eintrags oder None)."""
+        h = self._hash(key)
+        start = h % self.slots
+        free: Optional[int] = None
+        oldest, oldest_exp = -1, float("inf")
+        for p in range(PROBE):
+            off = self._off((start + p) % self.slots)
+            sh, exp, _num, _vlen = _SLOT.unpack_from(self._mm, off)
+            if sh == h:
+                return off, (off if exp > now else None)
+            if sh == 0 or exp <= now:
+                if free is None:
+                    free = off  # leer oder abgelaufen
+            elif exp < oldest_exp:
+                oldest, oldest_exp = off, exp
+        if free is not None:
+            return free, None
+        self.overwrites += 1
+        return oldest, None
+
+    def _write(self, off: int, key: str, expires: float, num: float, value: bytes = b"") -> None:
+        _SLOT.pack_into(self._mm, off, self._hash(key), expires, num, len(value))
+        if value:
+            start = off + _SLOT.size
+            self._mm[start:start + len(value)] = value
+
+    def gcra_sync(self, key: str, interval: float, capacity: float, cost: int = 1,
+                  force: bool = False) -> Tuple[bool, float, float]:
+        with self._locked():
+            now = time.time()
+            off, live = self._find(key, now)
+            tat = _SLOT.unpack_from(self._mm, live)[2] if live is not None else None
+            ok, tat = _gcra_step(tat, now, interval, capacity, cost, force)
+            if ok:
+                self._write(off, key, tat, tat)
+        return ok, tat, now
+
+    async def gcra(self, key: str, interval: float, capacity: float, cost: int = 1,
+                   force: bool = False) -> Tuple[bool, float, float]:
+        return self.gcra_sync(key, interval, capacity, cost, force)
+
+    async def refund(self, key: str, amount: float) -> None:
+        with self._locked():
+            off, live = self._find(key, time.time())
+            if live is not None:
+                _h, exp, num, vlen = _SLOT.unpack_from(self._mm, live)
+                _SLOT.pack_into(self._mm, live, _h, exp - amount, num - amount, vlen)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        with self._locked():
+            _off, live = self._find(key, time.time())
+            if live is None:
+                return None
+            vlen = _SLOT.unpack_from(self._mm, live)[3]
+            start = live + _SLOT.size
+            return bytes(self._mm[start:start + vlen])
+
+    async def set(self, key: str, value: bytes, ttl: float) -> bool:
+        if len(value) > self.value_max:
+            self.too_large += 1
+            return False  # passt nicht in einen Slot → bleibt lokal
+        with self._locked():
+            now = time.time()
+            off, _live = self._find(key, now)
+            self._write(off, key, now + ttl, 0.0, value)
+        return True
+
+    async def add(self, key: str, value: bytes, ttl: float) -> bool:
+        if len(value) > self.value_max:
+            return False
+        with self._locked():
+            now = time.time()
+            off, live = self._find(key, now)
+            if live is not None:
+                return False
+            self._write(off, key, now + ttl, 0.0, value)
+        return True
+
+    async def delete(self, key: str) -> None:
+        with self._locked():
+            _off, live = self._find(key, time.time())
+            if live is not None:
+                _SLOT.pack_into(self._mm, live, self._hash(key), 0.0, 0.0, 0)
+
+    async def close(self) -> None:
+        try:
+            self._mm.close()
+            os.close(self._fd)
+        except (OSError, ValueError):
+            pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.name,
+            "path": self.path,
+            "slots": self.slots,
+            "value_max": self.value_max,
+            "overwrites": self.overwrites,
+            "too_large": self.too_large,
+        }
+
+
+# ---------------------------------------------------------------------------
+# redis: minimaler RESP2-Client (asyncio Streams) mit kleinem Verbindungs-Pool
+# ---------------------------------------------------------------------------
+class RedisError(Exception):
+    pass
+
+
+_GCRA_LUA = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local interval, capacity, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local tat = tonumber(redis.call('GET', KEYS[1]) or now)
+if tat < now then tat = now end
+local new_tat = tat + interval * cost
+if new_tat - capacity > now and ARGV[4] ~= '1' then
+  return {0, tostring(tat), tostring(now)}
+end
+redis.call('SET', KEYS[1], tostring(new_tat), 'PX', math.ceil((new_tat - now) * 1000))
+return {1, tostring(new_tat), tostring(now)}
+"""
+
+_REFUND_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+  redis.call('INCRBYFLOAT', KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+
+def _encode(*args: Any) -> bytes:
+    out = [b"*%d\r\n" % len(args)]
+    for a in args:
+        b = a if isinstance(a, bytes) else str(a).encode("utf-8")
+        out.append(b"$%d\r\n%s\r\n" % (len(b), b))
+    return b"".join(out)
+
+
+async def _read_reply(reader: asyncio.StreamReader) -> Any:
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("redis connection closed")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest.decode()
+    if kind == b"-":
+        raise RedisError(rest.decode())
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        n = int(rest)
+        if n < 0:
+            return None
+        data = await reader.readexactly(n + 2)
+        return data[:-2]
+    if kind == b"*":
+        n = int(rest)
+        if n < 0:
+            return None
+        return [await _read_reply(reader) for _ in range(n)]
+    raise RedisError(f"bad reply: {line[:40]!r}")
+
+
+class RedisBackend(StateBackend):
+    name = "redis"
+    shared = True
+
+    def __init__(self, url: str, pool_max: int = 8, timeout: float = 0.5):
+        u = urlparse(url)
+        self.host = u.hostname or "127.0.0.1"
+        self.port = u.port or 6379
+        self.password = u.password
+        self.db = int((u.path or "/0").lstrip("/") or 0)
+        self.timeout = timeout
+        self._pool: "asyncio.LifoQueue[Tuple[asyncio.StreamReader, asyncio.StreamWriter]]" = asyncio.LifoQueue()
+        self._sem = asyncio.Semaphore(max(1, pool_max))
+        self._sha: Dict[str, str] = {}
+        self.errors = 0
+
+    async def _connect(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            if self.password:
+                writer.write(_encode("AUTH", self.password))
+                await _read_reply(reader)
+            if self.db:
+                writer.write(_encode("SELECT", self.db))
+                await _read_reply(reader)
+        except BaseException:
+            writer.close()  # AUTH/SELECT fehlgeschlagen oder Timeout → halb offene Verbindung schließen
+            raise
+        return reader, writer
+
+    async def execute(self, *args: Any) -> Any:
+        async with self._sem:
+            conn = self._pool.get_nowait() if not self._pool.empty() else None
+            try:
+                if conn is None:
+                    conn = await asyncio.wait_for(self._connect(), self.timeout)
+                reader, writer = conn
+                writer.write(_encode(*args))
+                reply = await asyncio.wait_for(_read_reply(reader), self.timeout)
+            except RedisError:
+                if conn is not None:
+                    self._pool.put_nowait(conn)  # Protokoll ok, nur Fehlerantwort
+                else:
+                    self.errors += 1  # Fehler schon in _connect (AUTH/SELECT)
+                raise
+            except BaseException:
+                self.errors += 1
+                if conn is not None:
+                    conn[1].close()  # Zustand unklar → Verbindung verwerfen
+                raise
+            self._pool.put_nowait(conn)
+            return reply
+
+    async def _script(self, src: str, keys: List[str], args: List[Any]) -> Any:
+        sha = self._sha.get(src)
+        if sha is not None:
+            try:
+                return await self.execute("EVALSHA", sha, len(keys), *keys, *args)
+            except RedisError as e:
+                if not str(e).startswith("NOSCRIPT"):
+                    raise
+        self._sha[src] = await self.execute("SCRIPT", "LOAD", src)
+        return await self.execute("EVALSHA", self._sha[src], len(keys), *keys, *args)
+
+    async def gcra(self, key: str, interval: float, capacity: float, cost: int = 1,
+                   force: bool = False) -> Tuple[bool, float, float]:
+        ok, tat, now = await self._script(_GCRA_LUA, [key], [repr(interval), repr(capacity), cost, int(force)])
+        return bool(ok), float(tat), float(now)
+
+    async def refund(self, key: str, amount: float) -> None:
+        await self._script(_REFUND_LUA, [key], [repr(-amount)])
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self.execute("GET", key)
+
+    async def set(self, key: str, value: bytes, ttl: float) -> bool:
+        return await self.execute("SET", key, value, "PX", max(1, int(ttl * 1000))) == "OK"
+
+    async def add(self, key: str, value: bytes, ttl: float) -> bool:
+        return await self.execute("SET", key, value, "NX", "PX", max(1, int(ttl * 1000))) == "OK"
+
+    async def delete(self, key: str) -> None:
+        await self.execute("DEL", key)
+
+    async def close(self) -> None:
+        while not self._pool.empty():
+            _r, w = self._pool.get_nowait()
+            w.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.name, "host": f"{self.host}:{self.port}", "idle_conns": self._pool.qsize(), "errors": self.errors}
+
+
+# ---------------------------------------------------------------------------
+# Auswahl (lazy, pro Prozess): state = Counter/Locks, cache = große Werte
+# ---------------------------------------------------------------------------
+_backends: Dict[str, Optional[StateBackend]] = {}
+
+
+def shared_backend(kind: str = "state") -> Optional[StateBackend]:
+    """Geteiltes Backend oder None (STATE_BACKEND=memory → alles bleibt pro Worker)."""
+    if kind in _backends:
+        return _backends[kind]
+    mode = (settings.STATE_BACKEND or "memory").lower()
+    backend: Optional[StateBackend] = None
+    try:
+        if mode == "mmap":
+            if kind == "cache":
+                backend = MmapBackend(os.path.join(settings.STATE_MMAP_DIR, "creator-ai-cache.bin"),
+                                      settings.STATE_MMAP_CACHE_SLOTS, settings.STATE_MMAP_CACHE_VALUE_MAX)
+            else:
+                backend = MmapBackend(os.path.join(settings.STATE_MMAP_DIR, "creator-ai-state.bin"),
+                                      settings.STATE_MMAP_SLOTS, 64)
+        elif mode == "redis":
+            backend = _backends.get("state") if kind == "cache" else None
+            backend = backend or RedisBackend(settings.REDIS_URL, settings.REDIS_POOL_MAX, settings.REDIS_TIMEOUT)
+    except OSError as e:
+        logger.warning("[state] %s backend unavailable, falling back to memory: %s", mode, e)
+        backend = None
+    _backends[kind] = backend
+    return backend
+
+
+def key(*parts: str) -> str:
+    return settings.STATE_PREFIX + ":".join(parts)
+
+
+async def close() -> None:
+    seen = set()
+    for b in _backends.values():
+        if b is not None and id(b) not in seen:
+            seen.add(id(b))
+            await b.close()
+    _backends.clear()
+
+
+def stats() -> Dict[str, Any]:
+    return {kind: (b.stats() if b is not None else {"backend": "memory"}) for kind, b in _backends.items()}
@@ -1,12 +1,17 @@
 # app/supa.py
-# Zweck: Supabase REST Helpers (mix aus sync/async für Rückwärtskompatibilität mit main.py)
+# Zweck: Supabase REST Helpers. Async ist die Haupt-API (für async-Endpoints);
+# die *_sync-Varianten sind nur für def-Endpoints, die im Threadpool laufen.
 
 from __future__ import annotations
 import os
+import threading
 import httpx
 from typing import Any, Dict, Optional, List, Tuple
 from datetime import datetime, timezone, timedelta
 
+from .config import settings
+from .cache import prompt_lru, shared_get, shared_put
+
 SUPABASE_URL = os.environ["SUPABASE_URL"].rstrip("/")
 SERVICE_ROLE = os.environ["SUPABASE_SERVICE_ROLE"]
 
@@ -25,20 +30,118 @@ def _headers() -> Dict[str, str]:
     }
 
 
+# ---------------------------------------------------------------------------
+# Gepoolte HTTP-Clients (app-weit; Lifespan öffnet/schließt sie)
+# Ein Client pro Art: Keep-Alive + HTTP/2 spart den TCP/TLS-Handshake je Query.
+# ---------------------------------------------------------------------------
+_async_client: Optional[httpx.AsyncClient] = None
+_sync_client: Optional[httpx.Client] = None
+_sync_lock = threading.Lock()
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=settings.SUPABASE_POOL_MAX,
+        max_keepalive_connections=settings.SUPABASE_POOL_KEEPALIVE,
+        keepalive_expiry=settings.SUPABASE_POOL_KEEPALIVE_EXPIRY,
+    )
+
+def _client_kwargs() -> Dict[str, Any]:
+    return {
+        "base_url": SUPABASE_URL,
+        "timeout": DEFAULT_TIMEOUT,
+        "limits": _limits(),
+        "http2": settings.SUPABASE_HTTP2.lower() == "on",
+    }
+
+def _aclient() -> httpx.AsyncClient:
+    """Async-Pool; wird lazy angelegt, falls der Lifespan (z. B. in Skripten) nicht lief."""
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        _async_client = httpx.AsyncClient(**_client_kwargs())
+    return _async_client
+
+def _client() -> httpx.Client:
+    """Sync-Pool für Endpoints, die im Threadpool laufen (thread-safe)."""
+    global _sync_client
+    if _sync_client is None or _sync_client.is_closed:
+        with _sync_lock:
+            if _sync_client is None or _sync_client.is_closed:
+                _sync_client = httpx.Client(**_client_kwargs())
+    return _sync_client
+
+def open_clients() -> None:
+    _aclient()
+    _client()
+
+async def close_clients() -> None:
+    global _async_client, _sync_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+    if _sync_client is not None:
+        _sync_client.close()
+        _sync_client = None
+
+def _pool_info(client: Optional[httpx.Client | httpx.AsyncClient]) -> Dict[str, Any]:
+    # httpcore legt die Pool-Interna nicht offiziell offen → defensiv lesen
+    pool = getattr(getattr(client, "_transport", None), "_pool", None)
+    if client is None or pool is None:
+        return {"open": False, "in_use": 0, "idle": 0, "waiters": 0}
+    conns = list(getattr(pool, "_connections", []) or [])
+    reqs = list(getattr(pool, "_requests", []) or [])
+    idle = sum(1 for c in conns if c.is_idle())
+    return {
+        "open": not client.is_closed,
+        "connections": len(conns),
+        "in_use": len(conns) - idle,
+        "idle": idle,
+        "waiters": sum(1 for r in reqs if getattr(r, "connection", None) is None),
+        "max": settings.SUPABASE_POOL_MAX,
+    }
+
+def pool_stats() -> Dict[str, Any]:
+    """Pool-Auslastung (in use / idle / waiters) zum Dimensionieren unter Last."""
+    return {"async": _pool_info(_async_client), "sync": _pool_info(_sync_client)}
+
+
 # ---------------------------------------------------------------------------
 # Async HTTP helpers (für async-APIs)
 # ---------------------------------------------------------------------------
 async def _get(path: str, params: Optional[Dict[str, Any]] = None):
-    async with httpx.AsyncClient(timeout=DEFAULT_TIMEOUT) as client:
-        r = await client.get(f"{SUPABASE_URL}{path}", headers=_headers(), params=params)
-        r.raise_for_status()
-        return r.json()
+    r = await _aclient().get(path, headers=_headers(), params=params)
+    r.raise_for_status()
+    return r.json()
 
-async def _post(path: str, json: Dict[str, Any]):
-    async with httpx.AsyncClient(timeout=DEFAULT_TIMEOUT) as client:
-        r = await client.post(f"{SUPABASE_URL}{path}", headers=_headers(), json=json)
-        r.raise_for_status()
-        return r.json() if r.text else None
+async def _get_resp(path: str, params: Optional[Dict[str, Any]] = None, extra_headers: Optional[Dict[str, str]] = None) -> Tuple[Any, httpx.Response]:
+    """Wie _get_sync: (data, response), z. B. für Content-Range bei count=exact."""
+    hdrs = _headers()
+    if extra_headers:
+        hdrs.update(extra_headers)
+    r = await _aclient().get(path, headers=hdrs, params=params)
+    r.raise_for_status()
+    try:
+        data = r.json()
+    except Exception:
+        data = None
+    return data, r
+
+async def _post(path: str, json: Any, params: Optional[Dict[str, Any]] = None, extra_headers: Optional[Dict[str, str]] = None):
+    hdrs = _headers()
+    if extra_headers:
+        hdrs.update(extra_headers)
+    r = await _aclient().post(path, headers=hdrs, params=params, json=json)
+    r.raise_for_status()
+    return r.json() if r.text else None
+
+async def _patch(path: str, params: Dict[str, Any], json: Dict[str, Any]):
+    r = await _aclient().patch(path, headers=_headers(), params=params, json=json)
+    r.raise_for_status()
+    return r.json() if r.text else None
+
+async def _delete(path: str, params: Dict[str, Any]) -> bool:
+    r = await _aclient().delete(path, headers=_headers(), params=params)
+    r.raise_for_status()
+    return True
 
 
 # ---------------------------------------------------------------------------
@@ -48,62 +151,44 @@ def _get_sync(path: str, params: Optional[Dict[str, Any]] = None, extra_headers:
     hdrs = _headers()
     if extra_headers:
         hdrs.update(extra_headers)
-    with httpx.Client(timeout=DEFAULT_TIMEOUT) as client:
-        r = client.get(f"{SUPABASE_URL}{path}", headers=hdrs, params=params)
-        r.raise_for_status()
-        try:
-            data = r.json()
-        except Exception:
-            data = None
-        return data, r
-
-def _post_sync(path: str, json: Dict[str, Any], extra_headers: Optional[Dict[str, str]] = None) -> Any:
+    r = _client().get(path, headers=hdrs, params=params)
+    r.raise_for_status()
+    try:
+        data = r.json()
+    except Exception:
+        data = None
+    return data, r
+
+def _post_sync(path: str, json: Any, extra_headers: Optional[Dict[str, str]] = None) -> Any:
     hdrs = _headers()
     if extra_headers:
         hdrs.update(extra_headers)
-    with httpx.Client(timeout=DEFAULT_TIMEOUT) as client:
-        r = client.post(f"{SUPABASE_URL}{path}", headers=hdrs, json=json)
-        r.raise_for_status()
-        return r.json() if r.text else None
+    r = _client().post(path, headers=hdrs, json=json)
+    r.raise_for_status()
+    return r.json() if r.text else None
 
 def _patch_sync(path: str, params: Dict[str, Any], json: Dict[str, Any]) -> Any:
-    with httpx.Client(timeout=DEFAULT_TIMEOUT) as client:
-        r = client.patch(f"{SUPABASE_URL}{path}", headers=_headers(), params=params, json=json)
-        r.raise_for_status()
-        return r.json() if r.text else None
+    r = _client().patch(path, headers=_headers(), params=params, json=json)
+    r.raise_for_status()
+    return r.json() if r.text else None
 
 def _delete_sync(path: str, params: Dict[str, Any]) -> Any:
-    with httpx.Client(timeout=DEFAULT_TIMEOUT) as client:
-        r = client.delete(f"{SUPABASE_URL}{path}", headers=_headers(), params=params)
-        r.raise_for_status()
-        return True
+    r = _client().delete(path, headers=_headers(), params=params)
+    r.raise_for_status()
+    return True
 
 
 # ---------------------------------------------------------------------------
-# Auth / User
-# Hybrid-Ansatz: sofort nutzbar (sync) + await-bar (für async-Stellen)
+# Auth / User (nur noch Remote-Fallback für app/auth.py)
 # ---------------------------------------------------------------------------
-class _UserResult(dict):
-    """Dict, das auch await-bar ist (await gibt sich selbst zurück)."""
-    def __await__(self):
-        async def _coro():
-            return self
-        return _coro().__await__()
-
-def get_user_from_token(access_token: str) -> _UserResult:
-    """
-    Wird in main.py teils sync, teils mit await genutzt.
-    Hier: synchroner HTTP-Call; Rückgabe ist dict-ähnlich und await-bar.
-    """
+async def get_user_from_token(access_token: str) -> Dict[str, Any]:
     headers = {
         "apikey": SERVICE_ROLE,
         "Authorization": f"Bearer {access_token}",
     }
-    with httpx.Client(timeout=DEFAULT_TIMEOUT) as client:
-        r = client.get(f"{SUPABASE_URL}/auth/v1/user", headers=headers)
-        r.raise_for_status()
-        data = r.json()
-        return _UserResult(data)
+    r = await _aclient().get("/auth/v1/user", headers=headers)
+    r.raise_for_status()
+    return r.json()
 
 
 # ---------------------------------------------------------------------------
@@ -119,53 +204,65 @@ async def log_usage(user_id: str, event: str, meta: Optional[Dict[str, Any]] = N
 
 # ---------------------------------------------------------------------------
 # Prompt-Cache (async, wird im Generate-Endpoint awaited)
+# Stufen: In-Process LRU (cache.prompt_lru) → geteilter State (nur mmap/redis)
+# → Tabelle prompt_cache.
+# Der cache_key enthält bereits die user_id (make_cache_key).
 # ---------------------------------------------------------------------------
 async def cache_get_by_key(cache_key: str, user_id: str) -> Optional[Dict[str, Any]]:
+    hit = prompt_lru.get(cache_key)
+    if hit is not None:
+        return hit
+    hit = await shared_get(cache_key)
+    if hit is not None:
+        return hit
     items = await _get("/rest/v1/prompt_cache", {
+        "select": "cache_key,output,model,variants",
         "cache_key": f"eq.{cache_key}",
         "user_id": f"eq.{user_id}",
         "limit": 1,
     })
-    return items[0] if items else None
+    if not items:
+        return None
+    row = items[0]
+    prompt_lru.put(cache_key, row.get("output") or "", row.get("model"), row.get("variants"))
+    shared_put(cache_key, row.get("output") or "", row.get("model"), row.get("variants"))
+    return row
 
 async def cache_insert(entry: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    # write-through: LRU sofort, dann DB
+    prompt_lru.put(entry["cache_key"], entry.get("output") or "", entry.get("model"), entry.get("variants"))
+    shared_put(entry["cache_key"], entry.get("output") or "", entry.get("model"), entry.get("variants"))
     return await _post("/rest/v1/prompt_cache", entry)
 
 
 # ---------------------------------------------------------------------------
-# Users Public (sync read/update; async upsert optional)
+# Users Public (async)
 # ---------------------------------------------------------------------------
-def get_profile(user_id: str) -> Optional[Dict[str, Any]]:
-    items, _ = _get_sync(
+PROFILE_SELECT = "user_id,handle,niche,target,email,brand_voice,monthly_credit_limit,plan,onboarding_done,created_at"
+
+async def get_profile(user_id: str) -> Optional[Dict[str, Any]]:
+    items = await _get(
         "/rest/v1/users_public",
         {
             "user_id": f"eq.{user_id}",
             "limit": 1,
-            "select": "user_id,handle,niche,target,email,brand_voice,monthly_credit_limit,onboarding_done,created_at",
+            "select": PROFILE_SELECT,
         },
     )
     return items[0] if items else None
 
-def get_profile_full(user_id: str) -> Optional[Dict[str, Any]]:
+async def get_profile_full(user_id: str) -> Optional[Dict[str, Any]]:
     """
     Für Brand-Voice im Generate-Endpoint. Aktuell identisch zu get_profile,
     aber als eigener Helper, falls du später weitere Relationen mitselektierst.
     """
-    items, _ = _get_sync(
-        "/rest/v1/users_public",
-        {
-            "user_id": f"eq.{user_id}",
-            "limit": 1,
-            "select": "user_id,handle,niche,target,email,brand_voice,monthly_credit_limit,onboarding_done,created_at",
-        },
-    )
-    return items[0] if items else None
+    return await get_profile(user_id)
 
 async def upsert_users_public(row: Dict[str, Any]) -> Optional[Dict[str, Any]]:
     return await _post("/rest/v1/users_public", row)
 
-def update_profile(user_id: str, patch: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-    data = _patch_sync(
+async def update_profile(user_id: str, patch: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    data = await _patch(
         "/rest/v1/users_public",
         params={"user_id": f"eq.{user_id}", "limit": 1},
         json=patch,
@@ -176,41 +273,62 @@ def update_profile(user_id: str, patch: Dict[str, Any]) -> Optional[Dict[str, An
 
 
 # ---------------------------------------------------------------------------
-# Credits / Stats (sync, weil in main.py ohne await benutzt)
+# Credits / Stats (async)
 # ---------------------------------------------------------------------------
 def month_start_utc(dt: Optional[datetime] = None) -> str:
     dt = dt or datetime.now(timezone.utc)
     start = datetime(dt.year, dt.month, 1, 0, 0, 0, tzinfo=timezone.utc)
     return start.isoformat()
 
-def count_generates_this_month(user_id: str) -> int:
+USAGE_FIELDS = ("generations", "cache_hits", "referrals", "tokens_in", "tokens_out")
+
+async def usage_this_month(user_id: str) -> Dict[str, int]:
     """
-    Zählt rows in generations ab Monatsanfang (nutzt Content-Range via count=exact).
-    Holt nur Range 0-0, der Total-Wert steht im Header.
+    Monatszähler aus usage_counters (1 Lookup über den Primary Key user_id+month).
+    Die Zeile pflegen Trigger auf usage_log/referrals; fehlt sie, gab es noch keine Nutzung.
     """
-    start = month_start_utc()
-    params = {
-        "select": "id",
-        "user_id": f"eq.{user_id}",
-        "created_at": f"gte.{start}",
-    }
-    data, resp = _get_sync(
-        "/rest/v1/generations",
-        params=params,
-        extra_headers={"Prefer": "count=exact"},
+    rows = await _get(
+        "/rest/v1/usage_counters",
+        {
+            "select": ",".join(USAGE_FIELDS),
+            "user_id": f"eq.{user_id}",
+            "month": f"eq.{month_start_utc()[:10]}",
+            "limit": 1,
+        },
     )
-    # Content-Range: "0-0/123"
-    total = 0
-    cr = resp.headers.get("Content-Range") or resp.headers.get("content-range")
-    if cr and "/" in cr:
-        try:
-            total = int(cr.split("/")[-1])
-        except Exception:
-            total = 0
-    else:
-        # Fallback (nicht ideal, aber besser als 0)
-        total = len(data or [])
-    return total
+    row = rows[0] if rows else {}
+    return {k: int(row.get(k) or 0) for k in USAGE_FIELDS}
+
+async def count_generates_this_month(user_id: str) -> int:
+    """Generierungen ab Monatsanfang (zählen gegen die Credits)."""
+    return (await usage_this_month(user_id))["generations"]
+
+async def reserve_credit(user_id: str) -> Dict[str, Any]:
+    """
+    1 Credit atomar reservieren (RPC reserve_credit, Zeilensperre in usage_counters).
+    → {ok, reservation, limit, used, remaining, month}; used enthält die eigene Reservierung.
+    Aufgelöst wird sie über usage_log (meta.reservation_id) oder release_credit(),
+    sonst verfällt sie nach CREDIT_RESERVE_TTL Sekunden.
+    """
+    data = await _post("/rest/v1/rpc/reserve_credit", {"p_user": user_id, "p_ttl_s": settings.CREDIT_RESERVE_TTL})
+    if isinstance(data, list):
+        data = data[0] if data else {}
+    return data or {}
+
+async def release_credit(reservation_id: str) -> None:
+    await _post("/rest/v1/rpc/release_credit", {"p_reservation": reservation_id})
+
+async def credit_status(user_id: str) -> Dict[str, Any]:
+    """Dieselbe Sicht wie reserve_credit (limit, used inkl. offener Reservierungen), ohne zu reservieren."""
+    data = await _post("/rest/v1/rpc/credit_status", {"p_user": user_id, "p_ttl_s": settings.CREDIT_RESERVE_TTL})
+    if isinstance(data, list):
+        data = data[0] if data else {}
+    return data or {}
+
+async def rebuild_usage_counters(month: Optional[str] = None) -> int:
+    """Backfill: Zähler aus der Historie neu aufbauen (month 'YYYY-MM-01' oder None = alle)."""
+    n = await _post("/rest/v1/rpc/rebuild_usage_counters", {"p_month": month})
+    return int(n or 0)
 
 
 # ---------------------------------------------------------------------------
@@ -241,35 +359,23 @@ async def templates_create(user_id: str, name: str, typ: str, prompt: dict):
     return await _post("/rest/v1/templates", payload)
 
 async def templates_update(id_: int, user_id: str, patch: dict):
-    with httpx.AsyncClient(timeout=DEFAULT_TIMEOUT) as client:
-        r = await client.patch(
-            f"{SUPABASE_URL}/rest/v1/templates",
-            headers=_headers(),
-            params={"id": f"eq.{id_}", "user_id": f"eq.{user_id}"},
-            json=patch,
-        )
-        r.raise_for_status()
-        return r.json() if r.text else None
+    return await _patch(
+        "/rest/v1/templates",
+        params={"id": f"eq.{id_}", "user_id": f"eq.{user_id}"},
+        json=patch,
+    )
 
 async def templates_delete(id_: int, user_id: str):
-    with httpx.AsyncClient(timeout=DEFAULT_TIMEOUT) as client:
-        r = await client.delete(
-            f"{SUPABASE_URL}/rest/v1/templates",
-            headers=_headers(),
-            params={"id": f"eq.{id_}", "user_id": f"eq.{user_id}"},
-        )
-        r.raise_for_status()
-        return True
+    return await _delete(
+        "/rest/v1/templates",
+        params={"id": f"eq.{id_}", "user_id": f"eq.{user_id}"},
+    )
 
 
 # ---------------------------------------------------------------------------
-# Planner Helpers (sync) – für /api/v1/planner/remind in main.py
+# Planner Helpers – async für async-Handler, *_sync für /api/v1/planner/remind
 # ---------------------------------------------------------------------------
-def get_upcoming_slots(*, hours_ahead: Optional[int] = None, window_minutes: Optional[int] = None) -> List[Dict[str, Any]]:
-    """
-    Liefert Slots im kommenden Zeitfenster, die noch nicht erinnert wurden.
-    Main ruft mit hours_ahead=26 auf. Join auf users_public(email).
-    """
+def _upcoming_params(hours_ahead: Optional[int], window_minutes: Optional[int]) -> Dict[str, Any]:
     if hours_ahead is None and window_minutes is None:
         hours_ahead = 24
     if window_minutes is None:
@@ -279,29 +385,45 @@ def get_upcoming_slots(*, hours_ahead: Optional[int] = None, window_minutes: Opt
     since = now.isoformat()
     until = (now + timedelta(minutes=window_minutes)).isoformat()
 
-    params = {
+    return {
         "select": "id,user_id,platform,scheduled_at,note,reminder_sent,users_public(email)",
         "reminder_sent": "is.false",
         "and": f"(gte.scheduled_at.{since},lte.scheduled_at.{until})",
         "order": "scheduled_at.asc",
         "limit": 500,
     }
-    data, _ = _get_sync("/rest/v1/planner_slots", params=params)
+
+def _reminded_params(ids: int | List[int]) -> Optional[Dict[str, Any]]:
+    if isinstance(ids, int):
+        ids = [ids]
+    if not ids:
+        return None
+    return {"id": f"in.({','.join(str(i) for i in ids)})"}
+
+async def get_upcoming_slots(*, hours_ahead: Optional[int] = None, window_minutes: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Liefert Slots im kommenden Zeitfenster, die noch nicht erinnert wurden.
+    Join auf users_public(email).
+    """
+    data = await _get("/rest/v1/planner_slots", params=_upcoming_params(hours_ahead, window_minutes))
     return data or []
 
-def mark_reminded(ids: int | List[int]) -> bool:
+async def mark_reminded(ids: int | List[int]) -> bool:
     """
     Setzt reminder_sent=true.
     Akzeptiert einzelne ID oder Liste von IDs.
     """
-    if isinstance(ids, int):
-        ids = [ids]
-    if not ids:
-        return True
-    ids_str = ",".join(str(i) for i in ids)
-    _patch_sync(
-        "/rest/v1/planner_slots",
-        params={"id": f"in.({ids_str})"},
-        json={"reminder_sent": True},
-    )
+    params = _reminded_params(ids)
+    if params:
+        await _patch("/rest/v1/planner_slots", params=params, json={"reminder_sent": True})
+    return True
+
+def get_upcoming_slots_sync(*, hours_ahead: Optional[int] = None, window_minutes: Optional[int] = None) -> List[Dict[str, Any]]:
+    data, _ = _get_sync("/rest/v1/planner_slots", params=_upcoming_params(hours_ahead, window_minutes))
+    return data or []
+
+def mark_reminded_sync(ids: int | List[int]) -> bool:
+    params = _reminded_params(ids)
+    if params:
+        _patch_sync("/rest/v1/planner_slots", params=params, json={"reminder_sent": True})
     return True
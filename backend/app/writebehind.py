@@ -0,0 +1,158 @@
+# app/writebehind.py
+# Zweck: Write-Behind für prompt_cache + usage_log. Die Generate-Endpoints legen
+# Zeilen nur in eine begrenzte In-Process-Queue; ein Hintergrund-Task schreibt sie
+# gebündelt als Multi-Row-Insert (1 PostgREST-Request pro Tabelle und Batch).
+# Der Lifespan startet den Flusher und leert die Queue beim Shutdown.
+
+from __future__ import annotations
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from . import supa
+from .cache import prompt_lru, shared_put
+from .config import settings
+
+logger = logging.getLogger("uvicorn.error")
+
+# Tabelle -> (Query-Params, Extra-Header) für den Batch-Insert
+_TABLES: Dict[str, Tuple[Optional[Dict[str, Any]], Dict[str, str]]] = {
+    # gleicher cache_key (z. B. force=1) → überschreiben statt 409
+    "prompt_cache": ({"on_conflict": "cache_key"}, {"Prefer": "resolution=merge-duplicates,return=minimal"}),
+    "usage_log": (None, {"Prefer": "return=minimal"}),
+}
+
+RETRIES = 2
+RETRY_DELAY = 0.5
+
+
+class WriteBehind:
+    def __init__(self, max_size: int, batch_max: int, flush_ms: int):
+        self.batch_max = max(1, batch_max)
+        self.flush_s = max(0, flush_ms) / 1000.0
+        self._q: "asyncio.Queue[Tuple[str, Dict[str, Any]]]" = asyncio.Queue(maxsize=max(1, max_size))
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+        self.last_error: Optional[str] = None
+
+    # ---- Lifecycle ----------------------------------------------------------
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._stopping = False
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self, timeout: float) -> None:
+        """Queue leeren (max. timeout Sekunden), dann Flusher beenden."""
+        if self._task is None:
+            return
+        self._stopping = True
+        try:
+            await asyncio.wait_for(self._q.join(), timeout)
+        except asyncio.TimeoutError:
+            left = self._q.qsize()
+            self.dropped += left
+            logger.warning("[writebehind] drain timeout, %s rows dropped", left)
+        self._task.cancel()
+        try:
+            await self._task
+        except (asyncio.CancelledError, Exception):
+            pass
+        self._task = None
+
+    # ---- Enqueue (nie blockierend) ------------------------------------------
+    def enqueue(self, table: str, row: Dict[str, Any]) -> bool:
+        try:
+            self.start()  # lazy, falls der Lifespan nicht lief (Skripte/Tests)
+        except RuntimeError:
+            pass
+        try:
+            self._q.put_nowait((table, row))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+        self.enqueued += 1
+        return True
+
+    def cache_insert(self, entry: Dict[str, Any]) -> bool:
+        # LRU (+ geteilte Stufe) sofort, DB im Hintergrund. Multi-Row-Inserts brauchen
+        # in jeder Zeile dieselben Spalten → variants immer mitschicken.
+        entry.setdefault("variants", None)
+        prompt_lru.put(entry["cache_key"], entry.get("output") or "", entry.get("model"), entry.get("variants"))
+        shared_put(entry["cache_key"], entry.get("output") or "", entry.get("model"), entry.get("variants"))
+        return self.enqueue("prompt_cache", entry)
+
+    def log_usage(self, user_id: str, event: str, meta: Optional[Dict[str, Any]] = None) -> bool:
+        return self.enqueue("usage_log", {"user_id": user_id, "event": event, "meta": meta or {}})
+
+    # ---- Flusher ------------------------------------------------------------
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._q.get()]
+            deadline = loop.time() + self.flush_s
+            while len(batch) < self.batch_max:
+                try:
+                    batch.append(self._q.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                remaining = deadline - loop.time()
+                if remaining <= 0 or self._stopping:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._q.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self._flush(batch)
+            finally:
+                for _ in batch:
+                    self._q.task_done()
+
+    async def _flush(self, batch: List[Tuple[str, Dict[str, Any]]]) -> None:
+        by_table: Dict[str, List[Dict[str, Any]]] = {}
+        for table, row in batch:
+            by_table.setdefault(table, []).append(row)
+        # Upsert darf eine Zeile nur einmal treffen ("cannot affect row a second time")
+        # → pro Konflikt-Spalte nur die letzte Zeile behalten (z. B. force=1 zweimal im Fenster)
+        for table, rows in by_table.items():
+            col = (_TABLES.get(table, (None, {}))[0] or {}).get("on_conflict")
+            if col:
+                by_table[table] = list({r.get(col): r for r in rows}.values())
+
+        for table, rows in by_table.items():
+            params, headers = _TABLES.get(table, (None, {"Prefer": "return=minimal"}))
+            for attempt in range(RETRIES):
+                try:
+                    await supa._post(f"/rest/v1/{table}", rows, params=params, extra_headers=headers)
+                    self.written += len(rows)
+                    self.batches += 1
+                    break
+                except Exception as e:
+                    self.last_error = f"{table}: {str(e)[:200]}"
+                    if attempt + 1 < RETRIES:
+                        await asyncio.sleep(RETRY_DELAY)
+            else:
+                self.failed += len(rows)
+                logger.warning("[writebehind] %s rows for %s failed: %s", len(rows), table, self.last_error)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "depth": self._q.qsize(),
+            "max": self._q.maxsize,
+            "running": self._task is not None and not self._task.done(),
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "last_error": self.last_error,
+        }
+
+
+write_behind = WriteBehind(settings.WRITE_QUEUE_MAX, settings.WRITE_BATCH_MAX, settings.WRITE_FLUSH_MS)
@@ -0,0 +1,121 @@
+# scripts/bench_ratelimit_middleware.py
+# Zweck: Overhead pro Request der Rate-Limit-Middleware messen – ohne Middleware,
+# alte BaseHTTPMiddleware-Variante (gleicher GCRA-Limiter) und reine ASGI-Middleware.
+# Ruft die ASGI-Apps direkt auf (kein Netzwerk/Server), JSON- und Streaming-Endpoint.
+#
+#   cd backend && python -m scripts.bench_ratelimit_middleware [requests]
+
+from __future__ import annotations
+import asyncio
+import os
+import sys
+import time
+
+# app.supa verlangt die Env beim Import; der Benchmark macht keine Supabase-Calls
+os.environ.setdefault("SUPABASE_URL", "http://localhost")
+os.environ.setdefault("SUPABASE_SERVICE_ROLE", "bench")
+
+from starlette.applications import Starlette
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+from app.middleware_ratelimit import RateLimitMiddleware
+from app import ratelimit
+from app.ratelimit import GCRALimiter
+
+BIG = 10**9  # Limits so hoch, dass nie 429 kommt – gemessen wird nur der Overhead
+
+
+async def ping(_request):
+    return JSONResponse({"ok": True})
+
+
+async def stream(_request):
+    async def gen():
+        for i in range(10):
+            yield f"data: {i}\n\n"
+    return StreamingResponse(gen(), media_type="text/event-stream")
+
+
+def make_app() -> Starlette:
+    return Starlette(routes=[Route("/ping", ping), Route("/stream", stream)])
+
+
+class LegacyRateLimitMiddleware(BaseHTTPMiddleware):
+    """Vorherige Variante (BaseHTTPMiddleware) zum Vergleich, gleicher Limiter."""
+
+    def __init__(self, app, per_sec=2, per_min=60):
+        super().__init__(app)
+        self.sec = GCRALimiter(per_sec, 1.0)
+        self.min = GCRALimiter(per_min, 60.0)
+
+    async def dispatch(self, request, call_next):
+        auth = request.headers.get("authorization", "")
+        ident = auth[-20:] if auth.startswith("Bearer ") else (request.client.host if request.client else "anon")
+        if not (await self.sec.hit(ident)).allowed:
+            return JSONResponse({"detail": "Rate limit exceeded"}, status_code=429)
+        d_min = await self.min.hit(ident)
+        if not d_min.allowed:
+            return JSONResponse({"detail": "Rate limit exceeded"}, status_code=429)
+        response = await call_next(request)
+        for k, v in d_min.headers().items():
+            response.headers.setdefault(k, v)
+        return response
+
+
+async def call(app, path: str, i: int) -> int:
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+        "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"",
+        "root_path": "", "headers": [(b"host", b"bench")],
+        "client": (f"10.0.{i % 250}.{i % 7}", 1234), "server": ("bench", 80),
+    }
+    sent = False
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await asyncio.sleep(3600)  # wie ein Client, der offen bleibt
+        return {"type": "http.disconnect"}
+
+    status = 0
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(scope, receive, send)
+    return status
+
+
+async def bench(app, path: str, n: int) -> float:
+    for i in range(200):  # Warm-up
+        await call(app, path, i)
+    t0 = time.perf_counter()
+    for i in range(n):
+        assert await call(app, path, i) == 200
+    return (time.perf_counter() - t0) / n * 1e6
+
+
+async def main(n: int) -> None:
+    ratelimit.PLAN_BUDGETS["anon"] = BIG
+    variants = {
+        "none": make_app(),
+        "BaseHTTPMiddleware": LegacyRateLimitMiddleware(make_app(), per_sec=BIG, per_min=BIG),
+        "pure ASGI": RateLimitMiddleware(make_app(), per_sec=BIG),
+    }
+    for path in ("/ping", "/stream"):
+        base = None
+        print(f"{path}  ({n} requests)")
+        for name, app in variants.items():
+            us = await bench(app, path, n)
+            base = us if base is None else base
+            print(f"  {name:<20} {us:8.1f} µs/req   overhead {us - base:+7.1f} µs")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000))
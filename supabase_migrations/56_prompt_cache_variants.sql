@@ -0,0 +1,4 @@
+-- 56_prompt_cache_variants.sql
+-- Strukturierte Varianten (string[]) zusätzlich zum gecachten Text
+alter table public.prompt_cache
+  add column if not exists variants jsonb;
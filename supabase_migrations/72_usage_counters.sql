@@ -0,0 +1,123 @@
+-- 72_usage_counters.sql
+-- Monatszähler pro User (Generierungen, Cache-Hits, Referrals, Tokens) statt Zeilen zu zählen.
+-- Trigger auf usage_log/referrals erhöhen sie atomar in derselben Transaktion;
+-- statement-level, damit ein Batch-Insert (Write-Behind) nur 1 Upsert pro User/Monat kostet.
+-- rebuild_usage_counters() baut die Zähler aus der Historie neu auf (Backfill/Cron).
+
+create table if not exists public.usage_counters (
+  user_id uuid not null references auth.users(id) on delete cascade,
+  month date not null,                         -- erster Tag des Monats (UTC)
+  generations int not null default 0,          -- usage_log.event = 'generate' (zählt gegen Credits)
+  cache_hits int not null default 0,           -- usage_log.event = 'generate_cache_hit'
+  referrals int not null default 0,            -- referrals.referrer_user_id
+  tokens_in bigint not null default 0,
+  tokens_out bigint not null default 0,
+  updated_at timestamptz not null default now(),
+  primary key (user_id, month)
+);
+
+alter table public.usage_counters enable row level security;
+
+drop policy if exists "counters own_read" on public.usage_counters;
+create policy "counters own_read"
+  on public.usage_counters for select
+  using (auth.uid() = user_id);
+
+-- usage_log → generations / cache_hits / tokens
+create or replace function public.usage_counters_from_log()
+returns trigger language plpgsql security definer as $$
+begin
+  insert into public.usage_counters as c (user_id, month, generations, cache_hits, tokens_in, tokens_out)
+  select user_id,
+         date_trunc('month', coalesce(created_at, now()) at time zone 'utc')::date,
+         count(*) filter (where event = 'generate'),
+         count(*) filter (where event = 'generate_cache_hit'),
+         coalesce(sum(case when meta->>'tokens_in'  ~ '^\d+$' then (meta->>'tokens_in')::bigint end), 0),
+         coalesce(sum(case when meta->>'tokens_out' ~ '^\d+$' then (meta->>'tokens_out')::bigint end), 0)
+  from new_rows
+  where user_id is not null and event in ('generate', 'generate_cache_hit')
+  group by 1, 2
+  on conflict (user_id, month) do update set
+    generations = c.generations + excluded.generations,
+    cache_hits  = c.cache_hits  + excluded.cache_hits,
+    tokens_in   = c.tokens_in   + excluded.tokens_in,
+    tokens_out  = c.tokens_out  + excluded.tokens_out,
+    updated_at  = now();
+  return null;
+end; $$;
+
+drop trigger if exists usage_log_counters on public.usage_log;
+create trigger usage_log_counters
+  after insert on public.usage_log
+  referencing new table as new_rows
+  for each statement execute function public.usage_counters_from_log();
+
+-- referrals → referrals (beim Werber)
+create or replace function public.usage_counters_from_referrals()
+returns trigger language plpgsql security definer as $$
+begin
+  insert into public.usage_counters as c (user_id, month, referrals)
+  select referrer_user_id,
+         date_trunc('month', coalesce(created_at, now()) at time zone 'utc')::date,
+         count(*)
+  from new_rows
+  where referrer_user_id is not null
+  group by 1, 2
+  on conflict (user_id, month) do update set
+    referrals  = c.referrals + excluded.referrals,
+    updated_at = now();
+  return null;
+end; $$;
+
+drop trigger if exists referrals_counters on public.referrals;
+create trigger referrals_counters
+  after insert on public.referrals
+  referencing new table as new_rows
+  for each statement execute function public.usage_counters_from_referrals();
+
+-- Backfill: Zähler eines Monats (oder aller Monate, p_month null) aus usage_log/referrals neu aufbauen.
+-- Sperrt die Quelltabellen kurz, damit parallel eingefügte Zeilen nicht doppelt/gar nicht zählen.
+create or replace function public.rebuild_usage_counters(p_month date default null)
+returns int language plpgsql security definer as $$
+declare
+  m date := date_trunc('month', p_month)::date;
+  n int;
+begin
+  lock table public.usage_log, public.referrals in share row exclusive mode;
+
+  delete from public.usage_counters where m is null or month = m;
+
+  with agg as (
+    select user_id,
+           date_trunc('month', created_at at time zone 'utc')::date as month,
+           count(*) filter (where event = 'generate') as generations,
+           count(*) filter (where event = 'generate_cache_hit') as cache_hits,
+           0::bigint as referrals,
+           coalesce(sum(case when meta->>'tokens_in'  ~ '^\d+$' then (meta->>'tokens_in')::bigint end), 0) as tokens_in,
+           coalesce(sum(case when meta->>'tokens_out' ~ '^\d+$' then (meta->>'tokens_out')::bigint end), 0) as tokens_out
+    from public.usage_log
+    where user_id is not null and event in ('generate', 'generate_cache_hit')
+      and (m is null or (created_at >= m::timestamp at time zone 'utc' and created_at < (m + interval '1 month') at time zone 'utc'))
+    group by 1, 2
+    union all
+    select referrer_user_id,
+           date_trunc('month', created_at at time zone 'utc')::date,
+           0, 0, count(*), 0, 0
+    from public.referrals
+    where referrer_user_id is not null
+      and (m is null or (created_at >= m::timestamp at time zone 'utc' and created_at < (m + interval '1 month') at time zone 'utc'))
+    group by 1, 2
+  )
+  insert into public.usage_counters (user_id, month, generations, cache_hits, referrals, tokens_in, tokens_out)
+  select user_id, month, sum(generations), sum(cache_hits), sum(referrals), sum(tokens_in), sum(tokens_out)
+  from agg
+  group by 1, 2;
+
+  get diagnostics n = row_count;
+  return n;
+end; $$;
+
+revoke execute on function public.rebuild_usage_counters(date) from public, anon, authenticated;
+
+-- Einmaliger Backfill
+select public.rebuild_usage_counters(null);
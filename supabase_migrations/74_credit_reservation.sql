@@ -0,0 +1,142 @@
+-- 74_credit_reservation.sql
+-- Atomare Credit-Reservierung für /generate (1 RPC statt Lesen-dann-Schreiben).
+-- reserve_credit() prüft das Monatslimit (monthly_credit_limit + Referral-Bonus) gegen
+-- usage_counters + offene Reservierungen und legt unter Zeilensperre eine Reservierung
+-- mit Zeitstempel an. Aufgelöst wird sie über den usage_log-Eintrag des Requests
+-- (meta.reservation_id, unabhängig vom Monat des Eintrags) oder release_credit().
+-- Geht beides verloren (Write-Behind voll/Absturz, abgebrochener Request), verfällt sie
+-- nach p_ttl_s Sekunden: ältere Reservierungen zählen nicht mehr und werden beim
+-- nächsten reserve_credit() des Users gelöscht.
+-- credit_status() liefert dieselbe Sicht (limit/used) ohne zu reservieren.
+-- Benötigt 72_usage_counters.sql.
+
+create table if not exists public.credit_reservations (
+  id uuid primary key default gen_random_uuid(),
+  user_id uuid not null references auth.users(id) on delete cascade,
+  month date not null,                         -- Monat, gegen dessen Limit reserviert wurde
+  reserved_at timestamptz not null default now()
+);
+
+create index if not exists credit_reservations_user_month_idx
+  on public.credit_reservations (user_id, month, reserved_at);
+
+-- nur Service-Role (keine Policies)
+alter table public.credit_reservations enable row level security;
+
+-- Gemeinsame Sicht für reserve_credit()/credit_status():
+-- Limit wie /me/limits (Basis, Default 50, + 20 je 3 Referrals, pro/team praktisch unbegrenzt),
+-- used = Generierungen + nicht verfallene Reservierungen.
+create or replace function public.credit_view(p_user uuid, p_month date, p_ttl_s int default 300)
+returns jsonb language plpgsql stable security definer as $$
+declare
+  v_limit int;
+  v_plan text;
+  v_refs int;
+  v_gens int;
+  v_open int;
+begin
+  select monthly_credit_limit, lower(coalesce(plan, 'free')) into v_limit, v_plan
+  from public.users_public where user_id = p_user;
+  if v_limit is null or v_limit <= 0 then
+    v_limit := 50;
+  end if;
+
+  select coalesce(referrals, 0), coalesce(generations, 0) into v_refs, v_gens
+  from public.usage_counters where user_id = p_user and month = p_month;
+
+  select count(*) into v_open
+  from public.credit_reservations
+  where user_id = p_user and month = p_month
+    and reserved_at > now() - make_interval(secs => p_ttl_s);
+
+  v_limit := v_limit + 20 * (coalesce(v_refs, 0) / 3);
+  if v_plan in ('pro', 'team') then
+    v_limit := greatest(v_limit, 10000);
+  end if;
+
+  return jsonb_build_object(
+    'limit', v_limit, 'used', coalesce(v_gens, 0) + v_open, 'reserved', v_open,
+    'remaining', greatest(v_limit - coalesce(v_gens, 0) - v_open, 0), 'month', p_month
+  );
+end; $$;
+
+create or replace function public.credit_status(p_user uuid, p_ttl_s int default 300)
+returns jsonb language sql stable security definer as $$
+  select public.credit_view(p_user, date_trunc('month', now() at time zone 'utc')::date, p_ttl_s);
+$$;
+
+create or replace function public.reserve_credit(p_user uuid, p_ttl_s int default 300)
+returns jsonb language plpgsql security definer as $$
+declare
+  v_month date := date_trunc('month', now() at time zone 'utc')::date;
+  v_view jsonb;
+  v_used int;
+  v_limit int;
+  v_id uuid;
+begin
+  insert into public.usage_counters (user_id, month) values (p_user, v_month)
+  on conflict (user_id, month) do nothing;
+
+  -- Zeilensperre serialisiert parallele Reservierungen desselben Users
+  perform 1 from public.usage_counters
+  where user_id = p_user and month = v_month
+  for update;
+
+  -- verfallene (nie aufgelöste) Reservierungen aufräumen
+  delete from public.credit_reservations
+  where user_id = p_user and reserved_at <= now() - make_interval(secs => p_ttl_s);
+
+  v_view := public.credit_view(p_user, v_month, p_ttl_s);
+  v_limit := (v_view->>'limit')::int;
+  v_used := (v_view->>'used')::int;
+  if v_used < v_limit then
+    insert into public.credit_reservations (user_id, month) values (p_user, v_month)
+    returning id into v_id;
+    v_used := v_used + 1;
+  end if;
+
+  return jsonb_build_object(
+    'ok', v_id is not null, 'reservation', v_id, 'limit', v_limit, 'used', v_used,
+    'remaining', greatest(v_limit - v_used, 0), 'month', v_month
+  );
+end; $$;
+
+create or replace function public.release_credit(p_reservation uuid)
+returns void language sql security definer as $$
+  delete from public.credit_reservations where id = p_reservation;
+$$;
+
+-- nur Service-Role (Backend), sonst könnte jeder für fremde User reservieren/lesen
+revoke execute on function public.credit_view(uuid, date, int) from public, anon, authenticated;
+revoke execute on function public.credit_status(uuid, int) from public, anon, authenticated;
+revoke execute on function public.reserve_credit(uuid, int) from public, anon, authenticated;
+revoke execute on function public.release_credit(uuid) from public, anon, authenticated;
+
+-- usage_log-Trigger (aus 72) erweitert: Einträge mit meta.reservation_id lösen die Reservierung auf
+create or replace function public.usage_counters_from_log()
+returns trigger language plpgsql security definer as $$
+begin
+  delete from public.credit_reservations r
+  using new_rows n
+  where n.event in ('generate', 'generate_cache_hit')
+    and n.meta->>'reservation_id' ~ '^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$'
+    and r.id = (n.meta->>'reservation_id')::uuid;
+
+  insert into public.usage_counters as c (user_id, month, generations, cache_hits, tokens_in, tokens_out)
+  select user_id,
+         date_trunc('month', coalesce(created_at, now()) at time zone 'utc')::date,
+         count(*) filter (where event = 'generate'),
+         count(*) filter (where event = 'generate_cache_hit'),
+         coalesce(sum(case when meta->>'tokens_in'  ~ '^\d+$' then (meta->>'tokens_in')::bigint end), 0),
+         coalesce(sum(case when meta->>'tokens_out' ~ '^\d+$' then (meta->>'tokens_out')::bigint end), 0)
+  from new_rows
+  where user_id is not null and event in ('generate', 'generate_cache_hit')
+  group by 1, 2
+  on conflict (user_id, month) do update set
+    generations = c.generations + excluded.generations,
+    cache_hits  = c.cache_hits  + excluded.cache_hits,
+    tokens_in   = c.tokens_in   + excluded.tokens_in,
+    tokens_out  = c.tokens_out  + excluded.tokens_out,
+    updated_at  = now();
+  return null;
+end; $$;
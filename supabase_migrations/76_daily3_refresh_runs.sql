@@ -0,0 +1,18 @@
+-- 76_daily3_refresh_runs.sql
+-- Checkpoint für den Cron-Job /daily3/refresh_all: 1 Zeile pro Tag (UTC).
+-- cursor = letzte fertig bearbeitete user_id (Keyset-Paging über users_public),
+-- lease_until verhindert parallele Läufe; ein abgebrochener Lauf macht am Cursor weiter.
+
+create table if not exists public.daily3_refresh_runs (
+  run_date date primary key,
+  cursor uuid,
+  processed int not null default 0,
+  failed int not null default 0,
+  done boolean not null default false,
+  lease_until timestamptz,
+  started_at timestamptz not null default now(),
+  updated_at timestamptz not null default now()
+);
+
+-- nur Service-Role (keine Policies)
+alter table public.daily3_refresh_runs enable row level security;
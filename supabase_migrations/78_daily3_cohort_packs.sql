@@ -0,0 +1,18 @@
+-- 78_daily3_cohort_packs.sql
+-- daily3 pro Kohorte statt pro User: User mit gleicher (Nische, Zielgruppe, Ton)
+-- teilen sich pro Tag einen Pool an Packs (1 LLM-Call pro Kohorte). Jeder User
+-- bekommt daraus eine deterministisch gemischte Auswahl (siehe app/daily3.py).
+
+create table if not exists public.daily3_cohort_packs (
+  cohort_key text not null,        -- sha1(normalisiert niche|target|tone)[:16]
+  day date not null,               -- UTC
+  niche text,
+  target text,
+  tone text,
+  packs jsonb not null,            -- [{hook, script, caption, hashtags}, ...]
+  created_at timestamptz not null default now(),
+  primary key (cohort_key, day)
+);
+
+-- nur Service-Role (keine Policies)
+alter table public.daily3_cohort_packs enable row level security;